@@ -1,48 +1,149 @@
+import datetime
+import decimal
 import logging
 import re
-from typing import Dict, Iterator, List, Optional, Tuple
+import threading
+import uuid
+from typing import Dict, Hashable, Iterator, List, Optional, Set, Tuple
 
+import duckdb
 import pyarrow as pa
 import sqlglot
 
-from buenavista.core import BVType, Connection, QueryResult, Session
+from buenavista.cache import LRUCache
+from buenavista.core import (
+    BVType,
+    BulkLoad,
+    Connection,
+    QueryResult,
+    Session,
+    SessionPool,
+)
+from buenavista.rewrite import TextRules
+from buenavista.statements import (
+    Statement,
+    StatementKind,
+    classify,
+    count_parameters,
+    replace_parameters,
+)
 
 
 logger = logging.getLogger(__name__)
 
-LIKE_ESCAPE_PATTERN = re.compile(r"(?i)(\s+)LIKE(\s+)(\w+)")
-ARRAY_UPPER_CURR_SCHEMA_ESCAPE_PATTERN = re.compile(
-        r"(?i)(\s+)array_upper(\s*)\((\s*)current_schemas(\s*)\((true|false)(\s*)\)(\s*),(\s*)\d(\s*)\)(\s*)\)"
-    )
-ARRAY_UPPER_ESCAPE_PATTERN = re.compile(r"(?i)(\s+)array_upper(\s*)\(")
-
-
-def _escape_match(group, replacement, replace):
-    def _escape(match):
-        token = match.group(group)
-        if replacement is not None:
-            return token.replace(token, replacement)
-        return token.replace(token, replace(token))
-    return _escape
-
-
-def _escape_unsupported_postgres_functions(query) -> str:
-    def _replace_array_upper_with_curr_schemas_cb(token):
-        if token.__contains__("TRUE") or token.__contains__("true"):
-            return " json_array_length(current_schemas(true))::BIGINT) "
-        else:
-            return " json_array_length(current_schemas(false))::BIGINT) "
-
-    def _escape_like_match(token):
-        return " LIKE " + token.replace(token, f"'{token}'")
-
-    query = ARRAY_UPPER_CURR_SCHEMA_ESCAPE_PATTERN.sub(_escape_match(0, None, _replace_array_upper_with_curr_schemas_cb), query)
-
-    query = ARRAY_UPPER_ESCAPE_PATTERN.sub(_escape_match(1, " json_array_length(", None), query)
-
-    query = LIKE_ESCAPE_PATTERN.sub(_escape_match(1, None, _escape_like_match), query)
-
-    return query
+# The DuckDB types of parameter values, subclasses first
+PARAM_TYPES = [
+    (bool, "BOOLEAN"),
+    (int, "BIGINT"),
+    (float, "DOUBLE"),
+    (decimal.Decimal, "DECIMAL(38, 10)"),
+    (str, "VARCHAR"),
+    (bytes, "BLOB"),
+    (datetime.datetime, "TIMESTAMP"),
+    (datetime.date, "DATE"),
+    (datetime.time, "TIME"),
+    (uuid.UUID, "UUID"),
+]
+
+# Queries calling these functions are never served from a ResultCache
+VOLATILE_PATTERN = re.compile(
+    r"(?i)\b(random|setseed|uuid|gen_random_uuid|nextval|currval|now|today|"
+    r"current_date|current_time|current_timestamp|localtime|localtimestamp|"
+    r"get_current_time|get_current_timestamp|transaction_timestamp)\b"
+)
+# Utility statements that only change session state
+SESSION_COMMANDS = {"", "SET", "RESET", "USE"}
+# DDL that creates objects only the session's cursor can see
+TEMP_PATTERN = re.compile(r"(?i)\bTEMP(ORARY)?\b")
+
+
+def _current_schemas_length(match) -> str:
+    arg = "true" if match.group(1).lower() == "true" else "false"
+    return f" json_array_length(current_schemas({arg}))::BIGINT) "
+
+
+# Rewrites of the SQL that Postgres clients and tools send into SQL that DuckDB
+# runs, all applied in a single pass by DuckDBSession.rewrite_sql
+POSTGRES_REWRITES = TextRules()
+POSTGRES_REWRITES.regex(
+    "array_upper_current_schemas",
+    r"\s+array_upper\s*\(\s*current_schemas\s*\((true|false)\s*\)\s*,\s*\d\s*\)\s*\)",
+    _current_schemas_length,
+    re.IGNORECASE,
+)
+POSTGRES_REWRITES.regex(
+    "array_upper", r"\s+array_upper\s*\(", " json_array_length(", re.IGNORECASE
+)
+POSTGRES_REWRITES.regex(
+    "like_identifier",
+    r"(\s+)LIKE\s+\w+",
+    lambda m: f" LIKE '{m.group(1)}'",
+    re.IGNORECASE,
+)
+# psql's \l
+POSTGRES_REWRITES.prefix(
+    "list_databases",
+    """SELECT d.datname AS "Name", pg_catalog.PG_GET_USERBYID(d.datdba)""",
+    """SELECT d.datname AS "Name", 'NA' AS "Owner", 'UTF-8' AS "Encoding", 
+            'en_US.utf8' AS "Collate", 'en_US.utf8' AS "Ctype", '' AS "Access privileges" FROM pg_catalog.pg_database
+             AS d ORDER BY 1""",
+)
+# Inspecting the owner of a relation
+POSTGRES_REWRITES.literal(
+    "relation_owner",
+    'pg_catalog.PG_GET_USERBYID(c.relowner) AS "Owner"',
+    "'NA' as Owner",
+)
+POSTGRES_REWRITES.regex("prepare_from", r"PREPARE\s+(\w+)\s+FROM", r"PREPARE \1 AS")
+POSTGRES_REWRITES.statement(
+    "show_search_path",
+    "SHOW search_path",
+    "SELECT current_setting('search_path') as search_path",
+)
+POSTGRES_REWRITES.statement(
+    "show_transaction_isolation",
+    "SHOW TRANSACTION ISOLATION LEVEL",
+    "SELECT 'read committed' as transaction_isolation",
+)
+POSTGRES_REWRITES.statement("begin_read_only", "BEGIN READ ONLY", "BEGIN")
+POSTGRES_REWRITES.statement(
+    "max_index_keys",
+    "SELECT setting FROM pg_catalog.pg_settings WHERE name='max_index_keys'",
+    "SELECT 32 as setting",
+)
+POSTGRES_REWRITES.regex("regclass_cast", r"::(?:regclass|REGCLASS)", "::string")
+POSTGRES_REWRITES.literal("regclass_as", "AS REGCLASS", "AS STRING")
+POSTGRES_REWRITES.regex("regtype_regproc_cast", r"::(?:regtype|regproc)", "")
+POSTGRES_REWRITES.literal(
+    "pg_get_expr",
+    "pg_get_expr(ad.adbin, ad.adrelid, true)",
+    "pg_get_expr(ad.adbin, ad.adrelid)",
+)
+POSTGRES_REWRITES.regex(
+    "current_schemas", r"pg_catalog\.(current_schemas|CURRENT_SCHEMAS)", r"\1"
+)
+POSTGRES_REWRITES.literal(
+    "generate_series", "pg_catalog.generate_series", "generate_series"
+)
+
+
+def _null_literal(value) -> str:
+    """A NULL of the DuckDB type of the parameter value."""
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        return "CAST(NULL AS TIMESTAMPTZ)"
+    for cls, type_name in PARAM_TYPES:
+        if isinstance(value, cls):
+            return f"CAST(NULL AS {type_name})"
+    return "NULL"
+
+
+def _may_write(stmt: Statement) -> bool:
+    """Whether the statement may change the results of queries in other sessions."""
+    if stmt.kind == StatementKind.QUERY:
+        return False
+    elif stmt.kind == StatementKind.TRANSACTION:
+        return stmt.command == "COMMIT"
+    return stmt.command not in SESSION_COMMANDS
 
 
 def to_bvtype(t: pa.DataType) -> BVType:
@@ -87,26 +188,19 @@ def to_bvtype(t: pa.DataType) -> BVType:
 class RecordBatchIterator(Iterator[List[Optional[str]]]):
     def __init__(self, rbr: pa.RecordBatchReader):
         self.rbr = rbr
+        self.batch_rows = iter([])
 
     def __iter__(self):
-        try:
-            self.rb = self.rbr.read_next_batch()
-        except StopIteration:
-            self.rb = None
-        self.i = 0
         return self
 
     def __next__(self) -> List:
-        if self.rb is None:
-            raise StopIteration
-        if self.i >= self.rb.num_rows:
-            self.rb = self.rbr.read_next_batch()
-            self.i = 0
-        ret = []
-        for col in self.rb.columns:
-            ret.append(col[self.i].as_py())
-        self.i += 1
-        return ret
+        while True:
+            row = next(self.batch_rows, None)
+            if row is not None:
+                return list(row)
+            # Convert a whole batch at a time instead of calling as_py() per cell
+            rb = self.rbr.read_next_batch()
+            self.batch_rows = zip(*[col.to_pylist() for col in rb.columns])
 
 
 class DuckDBQueryResult(QueryResult):
@@ -144,16 +238,131 @@ class DuckDBQueryResult(QueryResult):
         else:
             return iter([])
 
+    def batches(self, size: int = 1024) -> Iterator[List[pa.Array]]:
+        if self.rbr:
+            for rb in self.rbr:
+                yield rb.columns
+
     def status(self) -> str:
         return self._status
 
 
+class ResultCache:
+    """A cache of query results shared by the sessions of a DuckDBConnection.
+
+    Results are stored as Arrow tables in an LRU cache bounded by their total size
+    in bytes, and are captured as they are streamed to the client, so a result
+    is only cached once it has been read to the end. Any statement that may write
+    to the database invalidates the whole cache.
+    """
+
+    def __init__(
+        self,
+        maxbytes: int = 256 * 1024 * 1024,
+        ttl: Optional[float] = 300.0,
+        max_entry_bytes: Optional[int] = None,
+    ):
+        self.entries = LRUCache(maxbytes=maxbytes, ttl=ttl, sizeof=lambda t: t.nbytes)
+        self.max_entry_bytes = max_entry_bytes or maxbytes // 8
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[pa.Table]:
+        return self.entries.get(key)
+
+    def put(self, key: Hashable, table: pa.Table, generation: int):
+        # Drop results that were computed before the last invalidation
+        with self._lock:
+            if generation == self.generation:
+                self.entries.put(key, table)
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return self.entries.stats()
+
+
+class DuckDBBulkLoad(BulkLoad):
+    """Loads Arrow tables into a DuckDB table by registering each of them as a view
+    and inserting from it, in a transaction of its own unless one is open."""
+
+    VIEW = "__bv_bulk_load"
+
+    def __init__(self, session: "DuckDBSession", table: str, columns: Optional[str]):
+        self.session = session
+        self.cursor = session.cursor()
+        schema = (
+            self.cursor.execute(f"SELECT {columns or '*'} FROM {table} LIMIT 0")
+            .fetch_record_batch()
+            .schema
+        )
+        self._columns = [(f.name, to_bvtype(f.type)) for f in schema]
+        target = f"{table} ({columns})" if columns else table
+        self.insert = f"INSERT INTO {target} SELECT * FROM {self.VIEW}"
+        self.own_txn = not session.in_transaction()
+        if self.own_txn:
+            self.cursor.begin()
+        self.rowcount = 0
+
+    def columns(self) -> List[Tuple[str, BVType]]:
+        return self._columns
+
+    def append(self, batch: pa.Table) -> int:
+        self.cursor.register(self.VIEW, batch)
+        try:
+            count = self.cursor.execute(self.insert).fetchone()[0]
+        finally:
+            self.cursor.unregister(self.VIEW)
+        self.rowcount += count
+        return count
+
+    def finish(self) -> int:
+        if self.own_txn:
+            self.cursor.commit()
+        if self.session.result_cache is not None:
+            self.session.result_cache.invalidate()
+        return self.rowcount
+
+    def abort(self):
+        if self.own_txn:
+            self.cursor.rollback()
+
+
 class DuckDBSession(Session):
-    def __init__(self, cursor):
+    # The rewrites applied to the SQL text before it is run
+    rewrites: TextRules = POSTGRES_REWRITES
+
+    def __init__(
+        self,
+        cursor,
+        result_cache: Optional[ResultCache] = None,
+        statement_cache: Optional[LRUCache] = None,
+        max_prepared: int = 256,
+        config_params: Optional[Set[str]] = None,
+    ):
         super().__init__()
         self._cursor = cursor
         self.in_txn = False
-        self.refresh_config()
+        self.result_cache = result_cache
+        # Maps SQL text to its rewritten form and the normalized (lowercased) SQL
+        # used to classify it; shared by the sessions of a connection
+        if statement_cache is None:
+            statement_cache = LRUCache(maxsize=1024)
+        self.statement_cache = statement_cache
+        # Named prepared statements: name -> (sql, rewritten sql, classification,
+        # the statement as parsed by DuckDB or None if it could not be parsed)
+        self.prepared = LRUCache(maxsize=max_prepared)
+        self.search_path = None
+        self.executions = 0
+        # Whether the client changed state of the cursor that reset() can't restore
+        self.modified = False
+        # The names of the database's settings, shared by a connection's sessions
+        self.config_params = config_params if config_params is not None else set()
+        if config_params is None:
+            self.refresh_config()
 
     def cursor(self):
         return self._cursor
@@ -161,166 +370,253 @@ class DuckDBSession(Session):
     def close(self):
         self._cursor.close()
 
+    def interrupt(self):
+        self._cursor.interrupt()
+
+    def reset(self) -> bool:
+        if self.modified:
+            return False
+        # A transaction may be open without in_txn, e.g. by an unfinished bulk load
+        try:
+            self._cursor.execute("ROLLBACK")
+        except duckdb.TransactionException:
+            pass
+        self.in_txn = False
+        self.prepared.clear()
+        self.search_path = None
+        return True
+
     def refresh_config(self):
-        self.config_params = set(
-            [
-                r[0]
-                for r in self._cursor.execute(
-                    "SELECT name FROM duckdb_settings()"
-                ).fetchall()
-            ]
-        )
+        # Extensions only ever add settings, so the shared set is updated in place
+        self.config_params |= {
+            r[0]
+            for r in self._cursor.execute("SELECT name FROM duckdb_settings()").fetchall()
+        }
 
     def load_df_function(self, table: str):
         return self._cursor.query(f"select * from {table}")
 
     def rewrite_sql(self, sql: str) -> str:
-        print(f"original sql:\n{sql}")
-        # self._cursor.execute(
-        #     "SELECT * FROM duckdb_secrets()"
-        # ).fetchall()
-        # use some regex to replace certain unsupported postgres functions
-        sql = _escape_unsupported_postgres_functions(sql)
-        print(f"rewrite sql:\n{sql}")
-        if sql.startswith("""SELECT d.datname AS "Name", pg_catalog.PG_GET_USERBYID(d.datdba)"""):
-            sql = """SELECT d.datname AS "Name", 'NA' AS "Owner", 'UTF-8' AS "Encoding", 
-            'en_US.utf8' AS "Collate", 'en_US.utf8' AS "Ctype", '' AS "Access privileges" FROM pg_catalog.pg_database
-             AS d ORDER BY 1"""
-        # removing calls to inspect user using standard postgres function to return NA
-        sql = sql.replace("pg_catalog.PG_GET_USERBYID(c.relowner) AS \"Owner\"", "'NA' as Owner")
-        sql = sql.replace("pg_catalog.PG_GET_USERBYID(c.relowner) AS \"Owner\"", "'NA' as Owner")
-        if match := re.search(r"PREPARE\s+(\w+)\s+FROM", sql):
-            stmt = match.group(1)
-            target = f"PREPARE {stmt} FROM"
-            replace = f"PREPARE {stmt} AS"
-            return sql.replace(target, replace)
+        sql = self.rewrites.apply(sql)
         if sql.startswith("SET "):
+            # Settings that DuckDB does not have are ignored
             tokens = sql.split()
-            if tokens[1].lower() in self.config_params:
-                return sql
-            else:
+            if tokens[1].lower() not in self.config_params:
                 return ""
-        elif sql == "SHOW search_path":
-            return "SELECT current_setting('search_path') as search_path"
-        elif sql == "SHOW TRANSACTION ISOLATION LEVEL":
-            return "SELECT 'read committed' as transaction_isolation"
-        elif sql == "BEGIN READ ONLY":
-            return "BEGIN"
-        elif (
-            sql
-            == "SELECT setting FROM pg_catalog.pg_settings WHERE name='max_index_keys'"
-        ):
-            return "SELECT 32 as setting"
-        elif "::regclass" in sql:
-            return sql.replace("::regclass", "::string")
-        elif "::REGCLASS" in sql:
-            return sql.replace("::REGCLASS", "::string")
-        elif "AS REGCLASS" in sql:
-            return sql.replace("AS REGCLASS", "AS STRING")
-        elif "::regtype" in sql:
-            return sql.replace("::regtype", "")
-        elif "::regproc" in sql:
-            return sql.replace("::regproc", "")
-        elif "pg_get_expr(ad.adbin, ad.adrelid, true)" in sql:
-            return sql.replace(
-                "pg_get_expr(ad.adbin, ad.adrelid, true)",
-                "pg_get_expr(ad.adbin, ad.adrelid)",
-            )
-        elif "pg_catalog.current_schemas" in sql:
-            return sql.replace("pg_catalog.current_schemas", "current_schemas")
-        elif "pg_catalog.CURRENT_SCHEMAS" in sql:
-            return sql.replace("pg_catalog.CURRENT_SCHEMAS", "CURRENT_SCHEMAS")
-        elif "pg_catalog.generate_series" in sql:
-            return sql.replace("pg_catalog.generate_series", "generate_series")
         return sql
 
     def in_transaction(self) -> bool:
         return self.in_txn
 
-    def execute_sql(self, sql: str, params=None) -> QueryResult:
-        status = ""
+    def bulk_load(self, table: str, columns: Optional[str] = None) -> BulkLoad:
+        self.executions += 1
+        return DuckDBBulkLoad(self, table, columns)
+
+    def refresh_search_path(self):
+        self.search_path = self._cursor.execute(
+            "SELECT current_database(), current_schema(), current_setting('search_path')"
+        ).fetchone()
+
+    def _cache_key(self, sql: str, params) -> Optional[Hashable]:
+        if self.search_path is None:
+            self.refresh_search_path()
+        if params:
+            params = tuple(tuple(p) if isinstance(p, list) else p for p in params)
+        key = (sql, params or None, self.search_path)
         try:
-            lsql = sqlglot.parse_one(sql).sql(comments=False)
-        except:
-            # TODO: log this
-            lsql = sql
-
-        lsql = lsql.lower()
-        if self.in_txn:
-            if "commit" in lsql:
-                self.in_txn = False
-                status = "COMMIT"
-            elif "rollback" in lsql:
-                self.in_txn = False
-                status = "ROLLBACK"
-            elif "begin" in lsql or "start transaction" in lsql:
-                return DuckDBQueryResult(status="BEGIN")
-        elif "begin" in lsql or "start transaction" in lsql:
-            lsql = "begin"
-            self.in_txn = True
-            status = "BEGIN"
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _tee(
+        self, key: Hashable, rbr: pa.RecordBatchReader, generation: int
+    ) -> pa.RecordBatchReader:
+        """Streams the batches of rbr while collecting them into the result cache,
+        unless the cache was invalidated since generation, read before the query ran."""
+        execution = self.executions
+
+        def batches():
+            captured, nbytes = [], 0
+            for rb in rbr:
+                if captured is not None:
+                    nbytes += rb.nbytes
+                    if nbytes > self.result_cache.max_entry_bytes:
+                        captured = None
+                    else:
+                        captured.append(rb)
+                yield rb
+            # A reader is silently cut short when its cursor runs another statement
+            if captured is not None and execution == self.executions:
+                table = pa.Table.from_batches(captured, schema=rbr.schema)
+                self.result_cache.put(key, table, generation)
+
+        return pa.RecordBatchReader.from_batches(rbr.schema, batches())
+
+    def prepare_sql(self, sql: str) -> Tuple[str, Statement]:
+        """Returns the rewritten SQL and the classification of the statement."""
+        prepared = self.statement_cache.get(sql)
+        if prepared is None:
+            prepared = (self.rewrite_sql(sql), classify(sql))
+            self.statement_cache.put(sql, prepared)
+        return prepared
 
+    def execute_sql(self, sql: str, params=None) -> QueryResult:
         logger.debug("Original SQL: %s", sql)
-        sql = self.rewrite_sql(sql)
+        sql, stmt = self.prepare_sql(sql)
         logger.debug("Rewritten SQL: %s", sql)
-        if params:
-            self._cursor.execute(sql, params)
-        else:
-            self._cursor.execute(sql)
+        return self._execute(sql, stmt, params, sql)
+
+    def execute_prepared(self, name: str, sql: str, params=None) -> QueryResult:
+        entry = self.prepared.get(name)
+        if entry is None or entry[0] != sql:
+            rewritten, stmt = self.prepare_sql(sql)
+            try:
+                parsed = self._cursor.extract_statements(rewritten)
+            except duckdb.Error:
+                parsed = []
+            # Executing the parsed statement skips DuckDB's parser on every call
+            entry = (sql, rewritten, stmt, parsed[0] if len(parsed) == 1 else None)
+            self.prepared.put(name, entry)
+        _, rewritten, stmt, parsed = entry
+        return self._execute(
+            rewritten, stmt, params, rewritten if parsed is None else parsed
+        )
 
-        if status:
-            return DuckDBQueryResult(status=status)
+    def close_prepared(self, name: str):
+        self.prepared.pop(name)
 
-        rb = None
-        if self._cursor.description:
-            if "load " in lsql:
-                self.refresh_config()
-                status = "LOAD"
-            elif not ("insert " in lsql or "update " in lsql or "delete " in lsql):
-                rb = self._cursor.fetch_record_batch()
-        return DuckDBQueryResult(rb, status)
+    def describe_sql(self, sql: str, params=None) -> Optional[QueryResult]:
+        sql, stmt = self.prepare_sql(sql)
+        if stmt.returns_rows is False:
+            return DuckDBQueryResult(status=stmt.tag())
+        elif stmt.kind != StatementKind.QUERY:
+            return None
+        try:
+            # Relations are lazy: binding one (with NULLs for unknown parameters)
+            # yields its schema, and a false filter keeps DuckDB from scanning
+            # anything (a LIMIT 0 still computes an ungrouped aggregate in full)
+            if len(self._cursor.extract_statements(sql)) != 1:
+                return None
+            # Binding parameters would run the query, so they are replaced by NULLs
+            # of the types of their values
+            if params:
+                literals = [_null_literal(v) for v in params]
+            else:
+                literals = ["NULL"] * count_parameters(sql)
+            if literals:
+                sql = replace_parameters(sql, literals)
+            schema = self._cursor.sql(sql).filter("false").arrow().schema
+            return DuckDBQueryResult(schema.empty_table().to_reader())
+        except duckdb.InterruptException:
+            # Canceled, rather than something that can only be described by running it
+            raise
+        except Exception as e:
+            logger.debug("Could not describe %s: %s", sql, e)
+            return None
+
+    def _execute(self, sql: str, stmt: Statement, params, query) -> QueryResult:
+        if stmt.kind == StatementKind.TRANSACTION:
+            if stmt.command == "BEGIN":
+                if self.in_txn:
+                    return DuckDBQueryResult(status="BEGIN")
+                self.in_txn = True
+            else:
+                self.in_txn = False
+
+        cache_key = None
+        if (
+            self.result_cache is not None
+            and not self.in_txn
+            and stmt.kind == StatementKind.QUERY
+            and not VOLATILE_PATTERN.search(sql)
+        ):
+            cache_key = self._cache_key(sql, params)
+            if cache_key is not None:
+                table = self.result_cache.get(cache_key)
+                if table is not None:
+                    return DuckDBQueryResult(table.to_reader())
+
+        if cache_key is not None:
+            # Writes that finish while the query runs may not be in its results
+            generation = self.result_cache.generation
+        self.executions += 1
+        if params:
+            self._cursor.execute(query, params)
+        else:
+            self._cursor.execute(query)
+
+        if self.result_cache is not None and _may_write(stmt):
+            self.result_cache.invalidate()
+        if stmt.command in SESSION_COMMANDS:
+            self.search_path = None
+            # SETs of settings DuckDB doesn't have are rewritten to nothing
+            self.modified = self.modified or bool(sql)
+        elif stmt.command == "PREPARE" or (
+            stmt.kind == StatementKind.DDL and TEMP_PATTERN.search(sql)
+        ):
+            self.modified = True
+        elif stmt.command == "LOAD":
+            # Extensions add settings, which changes how SET is rewritten
+            self.refresh_config()
+            self.statement_cache.clear()
+            self.prepared.clear()
+
+        returns_rows = stmt.returns_rows
+        if returns_rows is None:
+            returns_rows = self._cursor.description is not None
+        if returns_rows:
+            rb = self._cursor.fetch_record_batch()
+            if cache_key is not None:
+                rb = self._tee(cache_key, rb, generation)
+            return DuckDBQueryResult(rb, stmt.tag())
+        elif stmt.kind == StatementKind.DML:
+            # DuckDB returns the number of affected rows as a single "Count" row
+            row = self._cursor.fetchone() if self._cursor.description else None
+            return DuckDBQueryResult(status=stmt.tag(row[0] if row else 0))
+        return DuckDBQueryResult(status=stmt.tag())
 
 
 class DuckDBConnection(Connection):
-    def __init__(self, db):
+    def __init__(
+        self,
+        db,
+        result_cache: Optional[ResultCache] = None,
+        session_pool: Optional[SessionPool] = None,
+    ):
         super().__init__()
         self.db = db
+        self.result_cache = result_cache
+        self.statement_cache = LRUCache(maxsize=1024)
+        # The names of the database's settings, loaded by the first session
+        self.config_params: Optional[Set[str]] = None
+        self.session_pool = session_pool if session_pool is not None else SessionPool()
+        self.session_pool.start(self.new_session)
 
     def parameters(self) -> Dict[str, str]:
         return {
             "server_version": "9.3.duckdb",
             "client_encoding": "UTF8",
             "DateStyle": "ISO",
+            "standard_conforming_strings": "on",
         }
 
+    def concurrency(self) -> Optional[int]:
+        # Each statement runs on all of DuckDB's threads
+        cursor = self.db.cursor()
+        try:
+            return int(cursor.execute("SELECT current_setting('threads')").fetchone()[0])
+        finally:
+            cursor.close()
+
     def new_session(self) -> Session:
         cursor = self.db.cursor()
         cursor.execute("SET search_path='main'")
-        return DuckDBSession(cursor)
-
-
-# if __name__ == '__main__':
-#     def _replace_cb(token):
-#         if token.__contains__("TRUE") or token.__contains__("true"):
-#             return " json_array_length(current_schemas(true))::BIGINT "
-#         else:
-#             return " json_array_length(current_schemas(false))::BIGINT "
-#
-#     ARRAY_UPPER_ESCAPE = re.compile(r"(\s+)(?i)array_upper(\s*)\(")
-#     sql = "select * from generate_series(1, ARRAY_UppER(current_schemas(false), 1)) as s(r)"
-#     print(ARRAY_UPPER_ESCAPE.sub(_escape_match(1, " json_array_length(", None), sql))
-#     # sql = "select * from generate_series(1, ARRAY_UPPER (current_schemas(false), 1)) as s(r)"
-#     # print(ARRAY_UPPER_ESCAPE.sub(_escape_match(1, " json_array_length("), sql))
-#     # sql = "select * from generate_series(1, ARRAY_UPPER" \
-#     #       "(current_schemas(false), 1)) as s(r)"
-#     # print(ARRAY_UPPER_ESCAPE.sub(_escape_match(1, " json_array_length("), sql))
-#
-#     sql = "select * from generate_series(1, ARRAY_UPPER" \
-#           "(current_schemas(false), 1)) as s(r)"
-#     ARRAY_UPPER_CURR_SCHEMA_ESCAPE = re.compile(
-#         r"(?i)(\s+)array_upper(\s*)\((\s*)current_schemas(\s*)\((true|false)(\s*)\)(\s*),(\s*)\d(\s*)\)(\s*)\)"
-#     )
-#     print(ARRAY_UPPER_CURR_SCHEMA_ESCAPE.sub(_escape_match(0, None, _replace_cb), sql))
-#     sql = "select * from generate_series(1, ARRAY_UPPER" \
-#           "(current_schemas(TRUE), 1)) as s(r)"
-#     print(ARRAY_UPPER_CURR_SCHEMA_ESCAPE.sub(_escape_match(0, None, _replace_cb), sql))
+        sess = DuckDBSession(
+            cursor,
+            self.result_cache,
+            self.statement_cache,
+            config_params=self.config_params,
+        )
+        self.config_params = sess.config_params
+        return sess
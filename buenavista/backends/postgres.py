@@ -1,11 +1,13 @@
-import io
+import itertools
 import re
-from typing import Any, Dict, Iterator, List, Optional, Tuple
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 import pandas as pd
 import psycopg
+import pyarrow as pa
 from psycopg_pool import ConnectionPool
 
+from buenavista import columnar, pgcopy
 from buenavista.core import BVType, Connection, QueryResult, Session
 
 
@@ -26,12 +28,23 @@ OID_TO_BVTYPE = {
     1700: BVType.DECIMAL,
 }
 
+# Queries that can be run in a server-side cursor (DECLARE ... CURSOR FOR <query>)
+DECLARABLE = re.compile(r"^\s*(\(|(SELECT|VALUES|TABLE|WITH)\b)", re.IGNORECASE)
+STREAM_CURSOR = "bv_stream"
+
+# Errors for queries that look declarable but are not, e.g. multiple statements or
+# data-modifying statements in a WITH clause; these are run without a cursor
+NOT_DECLARABLE = (psycopg.errors.SyntaxError, psycopg.errors.FeatureNotSupported)
+
+# The number of bytes of binary COPY data that load_df_function() decodes at a time
+COPY_CHUNK_BYTES = 8 * 1024 * 1024
+
 
 class PGQueryResult(QueryResult):
     def __init__(
         self,
         fields: List[Tuple[str, BVType]],
-        rows: List[List[Optional[Any]]],
+        rows: Iterable[Sequence[Optional[Any]]],
         status: Optional[str] = None,
     ):
         super().__init__()
@@ -51,18 +64,30 @@ class PGQueryResult(QueryResult):
     def rows(self) -> Iterator[List]:
         return iter(self._rows)
 
+    def close(self):
+        """Stops fetching the rows of a streamed result that was not drained."""
+        if hasattr(self._rows, "close"):
+            self._rows.close()
+
     def status(self):
         return self._status
 
 
 class PGSession(Session):
-    def __init__(self, parent, conn):
+    def __init__(self, parent, conn, batch_size: int = 0):
         super().__init__()
         self.parent = parent
         self.conn = conn
+        self.batch_size = batch_size
         self._cursor = conn.cursor()
+        # The streamed result whose server-side cursor is open, if any
+        self._streaming: Optional[PGQueryResult] = None
+        # Whether the open cursor is in a transaction begun for it (as opposed to
+        # a savepoint in the client's transaction)
+        self._stream_tx = False
 
     def close(self):
+        self.close_stream()
         self._cursor.close()
         self.parent.release(self.conn)
         self.conn = None
@@ -71,8 +96,20 @@ class PGSession(Session):
         return self._cursor
 
     def execute_sql(self, sql: str, params=None) -> QueryResult:
+        self.close_stream()
         if params:
             sql = re.sub(r"\$\d+", r"%s", sql)
+        if self.batch_size > 0 and DECLARABLE.match(sql):
+            rows = self._stream(sql, params)
+            try:
+                description = next(rows)
+            except NOT_DECLARABLE:
+                pass
+            else:
+                res = self.to_query_result(description, rows, None)
+                self._streaming = res
+                return res
+        if params:
             self._cursor.execute(sql, params)
         else:
             self._cursor.execute(sql)
@@ -84,17 +121,67 @@ class PGSession(Session):
             res = PGQueryResult([], [], status=status)
         return res
 
+    def _stream(self, sql: str, params=None) -> Iterator:
+        """Runs a query in a server-side cursor, yielding its description and then
+        its rows, fetching batch_size of them at a time. The cursor is closed, and
+        its transaction or savepoint ended, once the rows are drained or the
+        generator is closed."""
+        self._stream_tx = not self.in_transaction()
+        try:
+            with self.conn.transaction():
+                with self.conn.cursor(STREAM_CURSOR) as cursor:
+                    cursor.execute(sql, params)
+                    yield cursor.description
+                    while rows := cursor.fetchmany(self.batch_size):
+                        yield from rows
+        finally:
+            self._stream_tx = False
+
+    def close_stream(self):
+        """Closes the cursor of the last streamed result if it was not drained, which
+        must happen before the connection runs anything else."""
+        if self._streaming is not None:
+            streaming, self._streaming = self._streaming, None
+            streaming.close()
+
+    def interrupt(self):
+        # Sends the server a cancel request for the connection's running statement
+        self.conn.cancel()
+
     def in_transaction(self) -> bool:
+        if self._stream_tx:
+            return False
         return self.conn.info.transaction_status != psycopg.pq.TransactionStatus.IDLE
 
     def load_df_function(self, table: str):
-        copy_query = f"COPY {table} TO STDOUT WITH CSV DELIMITER ',' HEADER"
-        out = io.StringIO()
-        with self._cursor.copy(copy_query) as copy:
+        """Loads a table into a DataFrame with a binary COPY, decoding its data into
+        Arrow arrays COPY_CHUNK_BYTES at a time by the types of its columns."""
+        self.close_stream()
+        self._cursor.execute(f"SELECT * FROM {table} LIMIT 0")
+        names = [d[0] for d in self._cursor.description]
+        oids = [d[1] for d in self._cursor.description]
+        chunks = []
+        with self._cursor.copy(f"COPY {table} TO STDOUT (FORMAT binary)") as copy:
+            messages, size, header = [], 0, True
             while data := copy.read():
-                out.write(str(data, "utf8"))
-        out.seek(0)
-        return pd.read_csv(out)
+                if header:
+                    data = bytes(data)
+                    data = data[pgcopy.binary_header_size(data) :]
+                    header = False
+                elif data == pgcopy.BINARY_TRAILER:
+                    continue
+                if data:
+                    messages.append(data)
+                    size += len(data)
+                if size >= COPY_CHUNK_BYTES:
+                    columns, rest = columnar.decode_copy_tuples(messages, oids)
+                    chunks.append(columns)
+                    messages, size = ([rest], len(rest)) if rest else ([], 0)
+            columns, rest = columnar.decode_copy_tuples(messages, oids)
+            chunks.append(columns)
+            if rest:
+                raise ValueError("COPY data ended in the middle of a row")
+        return _to_dataframe(names, oids, chunks)
 
     def to_query_result(self, description, rows, status) -> QueryResult:
         fields = []
@@ -105,15 +192,46 @@ class PGSession(Session):
         return PGQueryResult(fields, rows, status)
 
 
+def _to_dataframe(names: List[str], oids: List[int], chunks: List[List]) -> pd.DataFrame:
+    """Assembles the column chunks decoded from a binary COPY into a DataFrame. The
+    Arrow table is converted with self_destruct, freeing each column once converted."""
+    arrays, arrow_names, objects = [], [], []
+    for j, (name, oid) in enumerate(zip(names, oids)):
+        parts = [chunk[j] for chunk in chunks]
+        arrow_type = columnar.copy_arrow_type(oid)
+        if arrow_type is None:
+            objects.append((j, name, list(itertools.chain.from_iterable(parts))))
+        else:
+            arrays.append(pa.chunked_array(parts, arrow_type))
+            arrow_names.append(name)
+    chunks.clear()
+    table = pa.Table.from_arrays(arrays, names=arrow_names)
+    del arrays
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
+    if objects and not arrow_names:
+        df = pd.DataFrame(index=pd.RangeIndex(len(objects[0][2])))
+    for j, name, values in objects:
+        df.insert(j, name, pd.Series(values, index=df.index, dtype=object), True)
+    return df
+
+
 class PGConnection(Connection):
-    def __init__(self, conninfo="", **kwargs):
+    """Proxies a Postgres server through a pool of connections, one per session.
+
+    Queries are streamed from server-side cursors batch_size rows at a time rather
+    than fetched in full; a batch_size of 0 fetches every result in full.
+    """
+
+    def __init__(self, conninfo="", batch_size: int = 1000, **kwargs):
         super().__init__()
+        self.batch_size = batch_size
         self.pool = ConnectionPool(psycopg.conninfo.make_conninfo(conninfo, **kwargs))
 
     def new_session(self) -> Session:
         conn = self.pool.getconn()
         conn.autocommit = True
-        return PGSession(self, conn)
+        return PGSession(self, conn, self.batch_size)
 
     def release(self, conn):
         self.pool.putconn(conn)
@@ -0,0 +1,92 @@
+import collections
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class LRUCache:
+    """A thread-safe LRU cache bounded by number of entries and/or total size in bytes,
+    with an optional time-to-live for its entries."""
+
+    def __init__(
+        self,
+        maxsize: Optional[int] = None,
+        maxbytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+        sizeof: Callable[[Any], int] = lambda v: 0,
+    ):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any):
+        size = self.sizeof(value)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, expires)
+            self.nbytes += size
+            while (self.maxsize is not None and len(self._entries) > self.maxsize) or (
+                self.maxbytes is not None and self.nbytes > self.maxbytes
+            ):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._entries:
+                return default
+            return self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _lookup(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+            self._remove(key)
+            return None
+        return entry
+
+    def _remove(self, key: Hashable) -> Any:
+        value, size, _ = self._entries.pop(key)
+        self.nbytes -= size
+        return value
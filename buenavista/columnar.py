@@ -0,0 +1,554 @@
+"""Vectorized encoding of Arrow record batches into PG wire protocol DataRow messages.
+
+Every column of a batch is first encoded into a flat payload of cell bytes plus an
+array of cell lengths (-1 for NULLs) using Arrow compute kernels and numpy, and the
+DataRow messages for the whole batch are then assembled into a single buffer with
+scatter operations instead of a Python loop over the cells. The bytes produced are
+the same as the ones produced by the per-value converters in `BVTYPE_TO_PGTYPE`.
+
+The same text and binary cell encodings back the data of COPY ... TO STDOUT, and
+the data of COPY ... FROM STDIN is parsed into Arrow tables with pyarrow's CSV reader.
+The tuples of a binary COPY ... TO STDOUT from an upstream server are decoded back
+into Arrow arrays the same way, a column at a time.
+"""
+import re
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+
+from . import pgcopy, pgtypes
+from .core import BVType
+
+DATA_ROW = ord("D")
+COPY_DATA = ord("d")
+
+# Days/microseconds between the Unix epoch and the Postgres epoch (2000-01-01)
+PG_EPOCH_DAYS = 10957
+PG_EPOCH_MICROS = PG_EPOCH_DAYS * 86400 * 1000000
+
+# Python's isoformat() omits the fractional part when microseconds are zero
+TRAILING_ZERO_MICROS = r"\.000000$"
+
+# Bounds the size of the temporary index arrays used when scattering payloads
+SCATTER_ROWS = 16384
+
+_TO_MICROS = {"s": (1000000, 1), "ms": (1000, 1), "us": (1, 1), "ns": (1, 1000)}
+
+# A (payload, lengths) pair: the concatenated bytes of the non-NULL cells of a
+# column and the length of every cell, with -1 marking a NULL
+EncodedColumn = Tuple[np.ndarray, np.ndarray]
+
+# The per-value converter from BVTYPE_TO_PGTYPE and whether its output is a str
+Fallback = Tuple[Callable, bool]
+
+
+def is_arrow(columns: List) -> bool:
+    """Whether a chunk from QueryResult.batches() is made of Arrow arrays."""
+    return bool(columns) and isinstance(columns[0], pa.Array)
+
+
+def _valid(arr: pa.Array) -> np.ndarray:
+    if arr.null_count == 0:
+        return np.ones(len(arr), dtype=bool)
+    return arr.is_valid().to_numpy(zero_copy_only=False)
+
+
+def _values(arr: pa.Array, dtype=None) -> np.ndarray:
+    if arr.null_count:
+        arr = arr.fill_null(0 if not pa.types.is_boolean(arr.type) else False)
+    values = arr.to_numpy(zero_copy_only=False)
+    return values.astype(dtype) if dtype else values
+
+
+def _from_strings(arr: pa.Array) -> EncodedColumn:
+    """Encodes a (large_)string or (large_)binary array from its raw buffers."""
+    n = len(arr)
+    bufs = arr.buffers()
+    wide = pa.types.is_large_string(arr.type) or pa.types.is_large_binary(arr.type)
+    offsets = np.frombuffer(bufs[1], dtype=np.int64 if wide else np.int32)
+    offsets = offsets[arr.offset : arr.offset + n + 1].astype(np.int64)
+    if bufs[2] is None or n == 0:
+        data = np.zeros(0, dtype=np.uint8)
+    else:
+        data = np.frombuffer(bufs[2], dtype=np.uint8)[offsets[0] : offsets[-1]]
+    raw = np.diff(offsets)
+    valid = _valid(arr)
+    if arr.null_count:
+        data = data[np.repeat(valid, raw)]
+    return data, np.where(valid, raw, -1)
+
+
+def _from_fixed(values: np.ndarray, valid: np.ndarray, dtype: str) -> EncodedColumn:
+    """Encodes fixed-width numeric values in the given (big-endian) dtype."""
+    out = np.ascontiguousarray(values[valid], dtype=dtype)
+    return out.view(np.uint8), np.where(valid, out.itemsize, -1)
+
+
+def _from_padded(values: np.ndarray, valid: np.ndarray) -> EncodedColumn:
+    """Encodes a NUL-padded fixed-width bytes ('S') array."""
+    n = len(values)
+    width = values.dtype.itemsize
+    cells = values.view(np.uint8).reshape(n, width)
+    keep = cells != 0
+    keep[~valid] = False
+    return cells[keep], np.where(valid, keep.sum(axis=1), -1)
+
+
+def _from_python(arr: pa.Array, fallback: Fallback) -> EncodedColumn:
+    """Encodes a column with the per-value converter from BVTYPE_TO_PGTYPE."""
+    converter, do_encode = fallback
+    cells = []
+    lengths = np.empty(len(arr), dtype=np.int64)
+    for i, v in enumerate(arr.to_pylist()):
+        if v is None:
+            lengths[i] = -1
+        else:
+            v = converter(v)
+            if do_encode:
+                v = v.encode("utf-8")
+            cells.append(v)
+            lengths[i] = len(v)
+    return np.frombuffer(b"".join(cells), dtype=np.uint8), lengths
+
+
+def text_array(arr: pa.Array, bvtype: BVType) -> Optional[pa.Array]:
+    """The text representation of the values of an array as a string (or binary) array,
+    if it can be computed with Arrow kernels; NULLs are kept as NULLs."""
+    t = arr.type
+    if bvtype == BVType.TEXT and (pa.types.is_string(t) or pa.types.is_large_string(t)):
+        return arr
+    elif bvtype in (BVType.BIGINT, BVType.INTEGER) and pa.types.is_integer(t):
+        return pc.cast(arr, pa.string())
+    elif bvtype == BVType.FLOAT and pa.types.is_floating(t):
+        # numpy's float64 -> str conversion matches Python's repr()
+        values = _values(arr, np.float64).astype("S32")
+        return pa.array(values, pa.binary(), mask=~_valid(arr))
+    elif bvtype == BVType.BOOL and pa.types.is_boolean(t):
+        return pc.cast(arr, pa.string())
+    elif bvtype == BVType.DATE and pa.types.is_date32(t):
+        return pc.cast(arr, pa.string())
+    elif bvtype == BVType.TIME and pa.types.is_time64(t) and t.unit == "us":
+        s = pc.cast(arr, pa.string())
+        return pc.replace_substring_regex(s, TRAILING_ZERO_MICROS, "")
+    elif (
+        bvtype == BVType.TIMESTAMP
+        and pa.types.is_timestamp(t)
+        and t.unit == "us"
+        and t.tz is None
+    ):
+        s = pc.cast(arr, pa.string())
+        return pc.replace_substring_regex(s, TRAILING_ZERO_MICROS, "")
+    return None
+
+
+def _encode_text(arr: pa.Array, bvtype: BVType) -> Optional[EncodedColumn]:
+    if bvtype == BVType.FLOAT and pa.types.is_floating(arr.type):
+        # Skips building an Arrow array of the padded strings
+        return _from_padded(_values(arr, np.float64).astype("S32"), _valid(arr))
+    s = text_array(arr, bvtype)
+    return _from_strings(s) if s is not None else None
+
+
+def _encode_binary(arr: pa.Array, bvtype: BVType) -> Optional[EncodedColumn]:
+    t = arr.type
+    if bvtype == BVType.TEXT and (pa.types.is_string(t) or pa.types.is_large_string(t)):
+        return _from_strings(arr)
+    elif bvtype == BVType.BYTES and (pa.types.is_binary(t) or pa.types.is_large_binary(t)):
+        return _from_strings(arr)
+    elif bvtype == BVType.BIGINT and pa.types.is_int64(t):
+        return _from_fixed(_values(arr), _valid(arr), ">i8")
+    elif bvtype == BVType.INTEGER and pa.types.is_integer(t) and t.bit_width <= 32:
+        dtype = ">u4" if pa.types.is_unsigned_integer(t) else ">i4"
+        return _from_fixed(_values(arr), _valid(arr), dtype)
+    elif bvtype == BVType.FLOAT and pa.types.is_floating(t):
+        return _from_fixed(_values(arr, np.float64), _valid(arr), ">f8")
+    elif bvtype == BVType.BOOL and pa.types.is_boolean(t):
+        return _from_fixed(_values(arr), _valid(arr), "u1")
+    elif bvtype == BVType.DATE and pa.types.is_date32(t):
+        days = _values(arr.view(pa.int32()), np.int64) - PG_EPOCH_DAYS
+        return _from_fixed(days, _valid(arr), ">i4")
+    elif bvtype == BVType.TIME and pa.types.is_time(t):
+        mul, div = _TO_MICROS[t.unit]
+        width = pa.int64() if pa.types.is_time64(t) else pa.int32()
+        micros = _values(arr.view(width), np.int64) * mul // div
+        return _from_fixed(micros, _valid(arr), ">i8")
+    elif bvtype == BVType.TIMESTAMP and pa.types.is_timestamp(t):
+        mul, div = _TO_MICROS[t.unit]
+        micros = _values(arr.view(pa.int64())) * mul // div - PG_EPOCH_MICROS
+        return _from_fixed(micros, _valid(arr), ">i8")
+    return None
+
+
+def encode_column(
+    arr: pa.Array, bvtype: BVType, fmt: int, fallback: Fallback
+) -> EncodedColumn:
+    if fmt == 0:
+        encoded = _encode_text(arr, bvtype)
+    else:
+        encoded = _encode_binary(arr, bvtype)
+    if encoded is None:
+        encoded = _from_python(arr, fallback)
+    return encoded
+
+
+def _scatter(out: np.ndarray, positions: np.ndarray, values: np.ndarray):
+    width = values.dtype.itemsize
+    cells = np.ascontiguousarray(values).view(np.uint8).reshape(-1, width)
+    out[positions[:, None] + np.arange(width)] = cells
+
+
+def _encode_rows(
+    columns: List[pa.Array],
+    bvtypes: List[BVType],
+    formats: List[int],
+    fallbacks: List[Fallback],
+    tag: int,
+) -> bytes:
+    n = len(columns[0]) if columns else 0
+    if n == 0:
+        return b""
+    ncols = len(columns)
+    encoded = [
+        encode_column(arr, bvtypes[j], formats[j], fallbacks[j])
+        for j, arr in enumerate(columns)
+    ]
+
+    # Row layout: the message type and an int32 message length, an int16 column
+    # count, then for every column an int32 cell length followed by the cell bytes
+    row_sizes = np.full(n, 7, dtype=np.int64)
+    for _, lengths in encoded:
+        row_sizes += 4 + np.maximum(lengths, 0)
+    row_starts = np.zeros(n, dtype=np.int64)
+    np.cumsum(row_sizes[:-1], out=row_starts[1:])
+    out = np.empty(int(row_sizes.sum()), dtype=np.uint8)
+
+    out[row_starts] = tag
+    _scatter(out, row_starts + 1, (row_sizes - 1).astype(">i4"))
+    _scatter(out, row_starts + 5, np.full(n, ncols, dtype=">i2"))
+
+    pos = row_starts + 7
+    for payload, lengths in encoded:
+        _scatter(out, pos, lengths.astype(">i4"))
+        sizes = np.maximum(lengths, 0)
+        if payload.size:
+            starts = np.zeros(n + 1, dtype=np.int64)
+            np.cumsum(sizes, out=starts[1:])
+            for lo in range(0, n, SCATTER_ROWS):
+                hi = min(lo + SCATTER_ROWS, n)
+                a, b = starts[lo], starts[hi]
+                if a == b:
+                    continue
+                dest = np.repeat(pos[lo:hi] + 4 - starts[lo:hi], sizes[lo:hi])
+                out[dest + np.arange(a, b)] = payload[a:b]
+        pos = pos + 4 + sizes
+    return out.tobytes()
+
+
+def encode_data_rows(
+    columns: List[pa.Array],
+    bvtypes: List[BVType],
+    formats: List[int],
+    fallbacks: List[Fallback],
+) -> bytes:
+    """Encodes the columns of a record batch as a contiguous run of DataRow messages."""
+    return _encode_rows(columns, bvtypes, formats, fallbacks, DATA_ROW)
+
+
+def encode_copy_tuples(
+    columns: List[pa.Array], bvtypes: List[BVType], fallbacks: List[Fallback]
+) -> bytes:
+    """Encodes the columns of a record batch as the tuples of a binary COPY, each in
+    its own CopyData message."""
+    formats = [1] * len(columns)
+    return _encode_rows(columns, bvtypes, formats, fallbacks, COPY_DATA)
+
+
+def _copy_cells(s: pa.Array, copy) -> pa.Array:
+    """Quotes or escapes the text values of a column for a COPY and fills in NULLs."""
+    if pa.types.is_binary(s.type):
+        s = s.view(pa.string())
+    elif not pa.types.is_string(s.type):
+        s = s.cast(pa.string())
+    if copy.csv:
+        special = "[" + re.escape(copy.delimiter + copy.quote) + r"\r\n]|^\\\.$"
+        needs_quotes = pc.match_substring_regex(s, special)
+        needs_quotes = pc.or_(needs_quotes, pc.equal(s, copy.null))
+        if pc.any(needs_quotes).as_py():
+            quoted = s
+            if copy.escape != copy.quote:
+                quoted = pc.replace_substring(quoted, copy.escape, copy.escape * 2)
+            quoted = pc.replace_substring(quoted, copy.quote, copy.escape + copy.quote)
+            quoted = pc.binary_join_element_wise(copy.quote, quoted, copy.quote, "")
+            s = pc.if_else(needs_quotes, quoted, s)
+    else:
+        special = "[" + re.escape("\\\n\r\t" + copy.delimiter) + "]"
+        if pc.any(pc.match_substring_regex(s, special)).as_py():
+            s = pc.replace_substring(s, "\\", "\\\\")
+            for c, esc in (("\n", "\\n"), ("\r", "\\r"), ("\t", "\\t")):
+                s = pc.replace_substring(s, c, esc)
+            if copy.delimiter not in "\\\n\r\t":
+                s = pc.replace_substring(s, copy.delimiter, "\\" + copy.delimiter)
+    return s.fill_null(copy.null)
+
+
+def encode_copy_text(
+    columns: List[pa.Array], bvtypes: List[BVType], fallbacks: List[Callable], copy
+) -> bytes:
+    """Encodes the columns of a record batch as the lines of a text or CSV COPY, each
+    in its own CopyData message."""
+    n = len(columns[0]) if columns else 0
+    if n == 0:
+        return b""
+    cells = []
+    for arr, bvtype, fallback in zip(columns, bvtypes, fallbacks):
+        s = text_array(arr, bvtype)
+        if s is None:
+            values = [None if v is None else fallback(v) for v in arr.to_pylist()]
+            s = pa.array(values, pa.string())
+        cells.append(_copy_cells(s, copy))
+    lines = pc.binary_join_element_wise(*cells, copy.delimiter)
+    lines = pc.binary_join_element_wise(lines, "", "\n")
+    payload, lengths = _from_strings(lines)
+
+    sizes = lengths + 5
+    starts = np.zeros(n, dtype=np.int64)
+    np.cumsum(sizes[:-1], out=starts[1:])
+    out = np.empty(int(sizes.sum()), dtype=np.uint8)
+    out[starts] = COPY_DATA
+    _scatter(out, starts + 1, (lengths + 4).astype(">i4"))
+    body = np.ones(out.size, dtype=bool)
+    body[(starts[:, None] + np.arange(5)).ravel()] = False
+    out[body] = payload
+    return out.tobytes()
+
+
+def _strings_table(data: bytes, names: List[str], copy) -> pa.Table:
+    # An empty line is a row with an empty value (NULL in the CSV format)
+    parse_options = pcsv.ParseOptions(delimiter=copy.delimiter, ignore_empty_lines=False)
+    if copy.csv:
+        parse_options.quote_char = copy.quote
+        parse_options.double_quote = copy.escape == copy.quote
+        parse_options.escape_char = copy.escape if copy.escape != copy.quote else False
+        parse_options.newlines_in_values = True
+    else:
+        parse_options.quote_char = False
+        parse_options.double_quote = False
+    convert_options = pcsv.ConvertOptions(
+        column_types={name: pa.string() for name in names},
+        null_values=[copy.null],
+        strings_can_be_null=True,
+        quoted_strings_can_be_null=False,
+    )
+    return pcsv.read_csv(
+        pa.py_buffer(data),
+        read_options=pcsv.ReadOptions(column_names=names),
+        parse_options=parse_options,
+        convert_options=convert_options,
+    )
+
+
+def copy_decoder(copy, oids: List[int]) -> "pgcopy.CopyDecoder":
+    """The decoder for the data of a COPY ... FROM STDIN into columns of the given
+    types. Text and CSV values are left as strings for the backend to cast."""
+    names = [f"c{i}" for i in range(len(oids))]
+
+    if copy.binary:
+        decoder = pgtypes.param_decoder(tuple(oids), (1,) * len(oids))
+
+        def decode(data: bytes):
+            rows, used, done = pgcopy.decode_binary_tuples(data, decoder)
+            if not rows:
+                return None, used, done
+            columns = [pa.array(list(values)) for values in zip(*rows)]
+            return pa.table(columns, names=names), used, done
+
+        return decode
+
+    escaped_delimiter = ("\\" + copy.delimiter).encode("utf-8")
+
+    def decode(data: bytes):
+        if not data:
+            return None, 0, False
+        if not copy.csv and escaped_delimiter in data:
+            rows = pgcopy.parse_text_rows(data, copy)
+            if any(len(row) != len(names) for row in rows):
+                raise ValueError(f"COPY rows must have {len(names)} columns")
+            columns = [pa.array(list(v), pa.string()) for v in zip(*rows)]
+            return pa.table(columns, names=names), len(data), False
+        table = _strings_table(data, names, copy)
+        if not copy.csv:
+            for i, col in enumerate(table.columns):
+                if pc.any(pc.match_substring(col, "\\")).as_py():
+                    values = [
+                        None if v is None else pgcopy.unescape_text(v)
+                        for v in col.to_pylist()
+                    ]
+                    table = table.set_column(i, names[i], pa.array(values, pa.string()))
+        return table, len(data), False
+
+    return decode
+
+
+# The binary COPY cells that are decoded straight into Arrow arrays: OID -> the
+# big-endian dtype and Arrow type of fixed-width values, and the offset that moves
+# dates and timestamps from the Postgres epoch to the Unix epoch
+COPY_FIXED = {
+    16: ("u1", pa.bool_(), 0),
+    20: (">i8", pa.int64(), 0),
+    21: (">i2", pa.int16(), 0),
+    23: (">i4", pa.int32(), 0),
+    26: (">u4", pa.uint32(), 0),
+    700: (">f4", pa.float32(), 0),
+    701: (">f8", pa.float64(), 0),
+    1082: (">i4", pa.date32(), PG_EPOCH_DAYS),
+    1083: (">i8", pa.time64("us"), 0),
+    1114: (">i8", pa.timestamp("us"), PG_EPOCH_MICROS),
+    1184: (">i8", pa.timestamp("us", tz="UTC"), PG_EPOCH_MICROS),
+}
+
+# OID -> the Arrow type of variable-width values and the number of leading bytes
+# to skip in every cell (the format version of jsonb)
+COPY_VARLEN = {
+    17: (pa.binary(), 0),
+    18: (pa.string(), 0),
+    19: (pa.string(), 0),
+    25: (pa.string(), 0),
+    114: (pa.string(), 0),
+    1042: (pa.string(), 0),
+    1043: (pa.string(), 0),
+    3802: (pa.string(), 1),
+}
+
+# Lets fixed-width values be gathered for NULL cells at the end of the data too
+_COPY_PADDING = bytes(8)
+
+
+def copy_arrow_type(oid: int) -> Optional[pa.DataType]:
+    """The Arrow type that decode_copy_tuples() decodes a column into, or None if its
+    values are decoded into a list of Python values."""
+    if oid in COPY_FIXED:
+        return COPY_FIXED[oid][1]
+    elif oid in COPY_VARLEN:
+        return COPY_VARLEN[oid][0]
+    return None
+
+
+def _gather(buf: np.ndarray, positions: np.ndarray, dtype: str) -> np.ndarray:
+    width = np.dtype(dtype).itemsize
+    cells = buf[positions[:, None] + np.arange(width)]
+    values = cells.view(dtype).ravel()
+    return values.astype(values.dtype.newbyteorder("="))
+
+
+def _gather_cells(buf: np.ndarray, starts: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """Concatenates the variable-width cells at the starts, SCATTER_ROWS at a time."""
+    n = len(starts)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    out = np.empty(int(offsets[-1]), dtype=np.uint8)
+    for lo in range(0, n, SCATTER_ROWS):
+        hi = min(lo + SCATTER_ROWS, n)
+        a, b = offsets[lo], offsets[hi]
+        if a == b:
+            continue
+        src = np.repeat(starts[lo:hi] - offsets[lo:hi], sizes[lo:hi])
+        out[a:b] = buf[src + np.arange(a, b)]
+    return out
+
+
+def _decode_fixed(
+    buf: np.ndarray, cells: np.ndarray, lengths: np.ndarray, oid: int
+) -> Optional[pa.Array]:
+    dtype, arrow_type, epoch = COPY_FIXED[oid]
+    nulls = lengths < 0
+    if not np.all((lengths == np.dtype(dtype).itemsize) | nulls):
+        return None
+    values = _gather(buf, cells, dtype)
+    if dtype == "u1":
+        values = values != 0
+    elif epoch:
+        values = (values.astype(np.int64) + epoch).astype(values.dtype)
+    arr = pa.array(values, mask=nulls if nulls.any() else None)
+    return arr if arr.type == arrow_type else arr.view(arrow_type)
+
+
+def _decode_varlen(
+    buf: np.ndarray, cells: np.ndarray, lengths: np.ndarray, oid: int
+) -> pa.Array:
+    arrow_type, skip = COPY_VARLEN[oid]
+    valid = lengths >= 0
+    sizes = np.where(valid, lengths - skip, 0)
+    data = _gather_cells(buf, cells + skip, sizes)
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int32)
+    np.cumsum(sizes, out=offsets[1:])
+    validity = None
+    if not valid.all():
+        validity = pa.py_buffer(np.packbits(valid, bitorder="little"))
+    buffers = [validity, pa.py_buffer(offsets), pa.py_buffer(data)]
+    return pa.Array.from_buffers(arrow_type, len(sizes), buffers)
+
+
+def _decode_tuples(
+    data: bytes, starts: np.ndarray, ends: np.ndarray, oids: List[int]
+) -> Optional[List]:
+    """Decodes the tuples that fill the given ranges of the data column by column, or
+    returns None if they don't fill them exactly."""
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if not np.all(ends - starts >= 2):
+        return None
+    if not np.all(_gather(buf, starts, ">i2") == len(oids)):
+        return None
+    pos = starts + 2
+    columns = []
+    for oid in oids:
+        if np.any(pos + 4 > ends):
+            return None
+        lengths = _gather(buf, pos, ">i4").astype(np.int64)
+        cells = pos + 4
+        pos = cells + np.maximum(lengths, 0)
+        if np.any(pos > ends):
+            return None
+        if oid in COPY_FIXED:
+            arr = _decode_fixed(buf, cells, lengths, oid)
+            if arr is None:
+                return None
+        elif oid in COPY_VARLEN:
+            arr = _decode_varlen(buf, cells, lengths, oid)
+        else:
+            decode = pgtypes.binary_decoder(oid)
+            arr = [
+                None if n < 0 else decode(data[c : c + n])
+                for c, n in zip(cells.tolist(), lengths.tolist())
+            ]
+        columns.append(arr)
+    return columns if np.array_equal(pos, ends) else None
+
+
+def decode_copy_tuples(messages: List[bytes], oids: List[int]) -> Tuple[List, bytes]:
+    """Decodes the tuples of a binary COPY ... TO STDOUT from the CopyData messages
+    that follow its header into one column per type OID: an Arrow array of the
+    copy_arrow_type() or, for other types, a list of the values decoded by pgtypes.
+
+    Servers send every tuple in its own message, which lets each column be decoded
+    for all of the tuples at once; other framings are decoded tuple by tuple.
+    Returns the columns and the bytes of any incomplete tuple at the end.
+    """
+    sizes = np.fromiter(map(len, messages), dtype=np.int64, count=len(messages))
+    ends = np.cumsum(sizes)
+    data = b"".join([*messages, _COPY_PADDING])
+    columns = _decode_tuples(data, ends - sizes, ends, oids)
+    if columns is not None:
+        return columns, b""
+
+    data = data[: -len(_COPY_PADDING)]
+    decoder = pgtypes.param_decoder(tuple(oids), (1,) * len(oids))
+    rows, used, _ = pgcopy.decode_binary_tuples(data, decoder)
+    columns = []
+    for j, oid in enumerate(oids):
+        values = [row[j] for row in rows]
+        arrow_type = copy_arrow_type(oid)
+        columns.append(values if arrow_type is None else pa.array(values, arrow_type))
+    return columns, data[used:]
@@ -1,8 +1,11 @@
 import enum
+import itertools
 import json
 import re
+import threading
+import time
 import uuid
-from typing import Any, Dict, Iterator, List, Optional, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
 
 
 class BVType(enum.Enum):
@@ -43,10 +46,52 @@ class QueryResult:
     def rows(self) -> Iterator[List]:
         raise NotImplementedError
 
+    def batches(self, size: int = 1024) -> Iterator[List[Sequence]]:
+        """Yields the results in column-major chunks, one sequence of values per column.
+
+        Backends with a columnar representation (e.g., Arrow arrays) should override
+        this; the default implementation transposes chunks of rows().
+        """
+        if not self.column_count():
+            return
+        rows = iter(self.rows())
+        while chunk := list(itertools.islice(rows, size)):
+            yield list(zip(*chunk))
+
     def status(self) -> str:
         raise NotImplementedError
 
 
+class BulkLoad:
+    """Appends batches of rows to a table, e.g. for a COPY ... FROM STDIN.
+
+    The batches are Arrow tables whose columns are in the order of columns();
+    their values may be strings for the backend to cast to the column types.
+    """
+
+    def columns(self) -> List[Tuple[str, BVType]]:
+        raise NotImplementedError
+
+    def append(self, batch) -> int:
+        """Appends a batch of rows, returning the number of rows appended."""
+        raise NotImplementedError
+
+    def finish(self) -> int:
+        """Completes the load, returning the total number of rows appended."""
+        raise NotImplementedError
+
+    def abort(self):
+        """Discards the rows appended so far, if the backend can."""
+        raise NotImplementedError
+
+
+def to_pylist(column: Sequence) -> List:
+    """Materializes a column chunk returned by QueryResult.batches() as a list."""
+    if hasattr(column, "to_pylist"):
+        return column.to_pylist()
+    return list(column)
+
+
 class Session:
     def __init__(self):
         self.id = uuid.uuid4()
@@ -60,31 +105,220 @@ class Session:
     def execute_sql(self, sql: str, params=None) -> QueryResult:
         raise NotImplementedError
 
+    def execute_prepared(self, name: str, sql: str, params=None) -> QueryResult:
+        """Executes the SQL of a named prepared statement, which clients usually run
+        many times; backends may compile it once and reuse it until it is closed."""
+        return self.execute_sql(sql, params)
+
+    def close_prepared(self, name: str):
+        pass
+
+    def describe_sql(self, sql: str, params=None) -> Optional[QueryResult]:
+        """Returns a QueryResult that describes the columns the SQL would return for
+        the given parameters (if any) without running it, or None if the SQL can
+        only be described by running it."""
+        return None
+
     def in_transaction(self) -> bool:
         raise NotImplementedError
 
+    def interrupt(self):
+        """Asks the statement the session is running to stop; called from a thread
+        other than the one running it. Backends that can't interrupt ignore it."""
+        pass
+
+    def reset(self) -> bool:
+        """Restores the state of the session when it is returned to a SessionPool,
+        returning whether it can be reused by another client."""
+        return True
+
+    def bulk_load(self, table: str, columns: Optional[str] = None) -> BulkLoad:
+        """Starts loading rows into the (optionally comma-separated) columns of a table."""
+        raise NotImplementedError
+
     def load_df_function(self, table: str):
         raise NotImplementedError
 
 
+class SessionPool:
+    """Reuses the sessions of a Connection across clients.
+
+    At most max_size sessions exist at a time: a client that asks for one while all
+    of them are in use waits up to timeout seconds for one to be released, and gets
+    a TimeoutError if none is. The first min_size sessions are created when the pool
+    is started and kept while idle; the others are closed once they have been idle
+    for max_idle seconds, which is checked whenever a session is acquired or
+    released (or reap() is called). Released sessions are reset() before they are
+    reused, and closed if they can't be.
+    """
+
+    def __init__(
+        self,
+        min_size: int = 0,
+        max_size: Optional[int] = None,
+        timeout: Optional[float] = 30.0,
+        max_idle: Optional[float] = 300.0,
+    ):
+        if max_size is not None and max_size < max(min_size, 1):
+            raise ValueError("max_size must be at least 1 and at least min_size")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.factory: Optional[Callable[[], Session]] = None
+        # (release time, session) pairs, the most recently released last
+        self.idle: List[Tuple[float, Session]] = []
+        self.size = 0
+        self.closed = False
+        self.hits = self.misses = self.timeouts = self.reaped = 0
+        self._cond = threading.Condition()
+
+    def start(self, factory: Callable[[], Session]):
+        """Sets the function that creates new sessions and creates min_size of them."""
+        self.factory = factory
+        sessions = [factory() for _ in range(self.min_size - self.size)]
+        with self._cond:
+            now = time.monotonic()
+            self.idle.extend((now, sess) for sess in sessions)
+            self.size += len(sessions)
+
+    def acquire(self) -> Session:
+        sess, expired = None, []
+        try:
+            with self._cond:
+                expired = self._expired()
+                deadline = None if self.timeout is None else time.monotonic() + self.timeout
+                while not self.idle and self._full():
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self.timeouts += 1
+                        raise TimeoutError(
+                            f"No session became available within {self.timeout}s"
+                        )
+                    self._cond.wait(remaining)
+                if self.idle:
+                    sess = self.idle.pop()[1]
+                    self.hits += 1
+                else:
+                    self.size += 1
+                    self.misses += 1
+        finally:
+            for old in expired:
+                old.close()
+        if sess is None:
+            try:
+                sess = self.factory()
+            except BaseException:
+                self._discard()
+                raise
+        return sess
+
+    def release(self, session: Session, reuse: bool = True):
+        """Returns a session to the pool, or closes it if reuse is False (e.g. when it
+        may still be running a query)."""
+        try:
+            reuse = reuse and not self.closed and session.reset()
+        except Exception:
+            reuse = False
+        if not reuse:
+            self._discard()
+            session.close()
+            return
+        with self._cond:
+            self.idle.append((time.monotonic(), session))
+            expired = self._expired()
+            self._cond.notify()
+        for old in expired:
+            old.close()
+
+    def reap(self) -> int:
+        """Closes the sessions that have been idle for too long, returning how many."""
+        with self._cond:
+            expired = self._expired()
+        for old in expired:
+            old.close()
+        return len(expired)
+
+    def close(self):
+        """Closes the idle sessions; sessions in use are closed when released."""
+        with self._cond:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.size -= len(idle)
+            self._cond.notify_all()
+        for _, sess in idle:
+            sess.close()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "size": self.size,
+                "idle": len(self.idle),
+                "in_use": self.size - len(self.idle),
+                "hits": self.hits,
+                "misses": self.misses,
+                "timeouts": self.timeouts,
+                "reaped": self.reaped,
+            }
+
+    def _full(self) -> bool:
+        return self.max_size is not None and self.size >= self.max_size
+
+    def _discard(self):
+        with self._cond:
+            self.size -= 1
+            self._cond.notify()
+
+    def _expired(self) -> List[Session]:
+        """Removes the sessions that have been idle for longer than max_idle, keeping
+        min_size sessions in all; must be called with the lock held."""
+        if self.max_idle is None:
+            return []
+        cutoff = time.monotonic() - self.max_idle
+        count = 0
+        # The sessions that were released first come first
+        while (
+            count < len(self.idle)
+            and self.idle[count][0] <= cutoff
+            and self.size - count > self.min_size
+        ):
+            count += 1
+        if count == 0:
+            return []
+        expired = [sess for _, sess in self.idle[:count]]
+        del self.idle[:count]
+        self.size -= count
+        self.reaped += count
+        self._cond.notify(count)
+        return expired
+
+
 class Connection:
     """Translation layer from an upstream data source into the BV representation of a query result."""
 
     def __init__(self):
         self._sessions = {}
+        # Reuses sessions across clients when set by the subclass
+        self.session_pool: Optional[SessionPool] = None
 
     def create_session(self) -> Session:
-        sess = self.new_session()
+        if self.session_pool is not None:
+            sess = self.session_pool.acquire()
+        else:
+            sess = self.new_session()
         self._sessions[sess.id] = sess
         return sess
 
     def get_session(self, id: int) -> Optional[Session]:
         return self._sessions.get(id)
 
-    def close_session(self, session: Session):
+    def close_session(self, session: Session, reuse: bool = True):
         if session and session.id in self._sessions:
             del self._sessions[session.id]
-            session.close()
+            if self.session_pool is not None:
+                self.session_pool.release(session, reuse)
+            else:
+                session.close()
 
     def new_session(self) -> Session:
         raise NotImplementedError
@@ -92,6 +326,11 @@ class Connection:
     def parameters(self) -> Dict[str, str]:
         return {}
 
+    def concurrency(self) -> Optional[int]:
+        """The number of statements the backend can usefully run at once, or None
+        if it isn't limited."""
+        return None
+
 
 class Extension:
     @classmethod
@@ -1,3 +1,4 @@
+import concurrent.futures
 import os
 import re
 
@@ -6,7 +7,7 @@ from fastapi import FastAPI
 
 from .. import bv_dialects, rewrite
 from ..backends.duckdb import DuckDBConnection
-from ..http import main
+from ..http import context, main
 
 #### Rewriter setup/config
 
@@ -156,6 +157,29 @@ if __name__ == "__main__":
     if "BUENAVISTA_PORT" in os.environ:
         bv_port = int(os.environ["BUENAVISTA_PORT"])
 
+    conn = DuckDBConnection(db)
+    sessions = context.SessionPool(
+        conn,
+        max_sessions=int(os.getenv("BUENAVISTA_MAX_SESSIONS", "64")),
+        max_per_user=int(os.getenv("BUENAVISTA_MAX_USER_SESSIONS", "0")) or None,
+    )
+    queries = context.QueryRegistry(
+        page_rows=int(os.getenv("BUENAVISTA_PAGE_ROWS", "10000")),
+    )
+    executor = None
+    if os.getenv("BUENAVISTA_QUERY_WORKERS"):
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=int(os.environ["BUENAVISTA_QUERY_WORKERS"])
+        )
+    timeout = float(os.getenv("BUENAVISTA_QUERY_TIMEOUT", "0")) or None
     app = FastAPI()
-    main.quacko(app, DuckDBConnection(db), rewriter)
+    main.quacko(
+        app,
+        conn,
+        rewriter,
+        sessions=sessions,
+        queries=queries,
+        executor=executor,
+        timeout=timeout,
+    )
     uvicorn.run(app, host=bv_host, port=bv_port, log_level="info")
@@ -4,7 +4,8 @@ from typing import Tuple
 import json
 import duckdb
 
-from buenavista.backends.duckdb import DuckDBConnection
+from buenavista.backends.duckdb import DuckDBConnection, ResultCache
+from buenavista.core import SessionPool
 from buenavista import bv_dialects, postgres, rewrite
 from utils.pg_duck_migrations import PgDuckMigrations
 from utils.utils import stack_spec_file
@@ -23,10 +24,20 @@ rewriter = DuckDBPostgresRewriter(bv_dialects.BVPostgres(), bv_dialects.BVDuckDB
 
 
 def create(
-        ddb: duckdb.DuckDBPyConnection, host_addr: Tuple[str, int], auth: dict = None
-) -> postgres.BuenaVistaServer:
+        ddb: duckdb.DuckDBPyConnection,
+        host_addr: Tuple[str, int],
+        auth: dict = None,
+        use_asyncio: bool = False,
+        result_cache: ResultCache = None,
+        session_pool: SessionPool = None,
+):
+    conn = DuckDBConnection(ddb, result_cache, session_pool)
+    if use_asyncio:
+        return postgres.AsyncBuenaVistaServer(
+            host_addr, conn, rewriter=rewriter, auth=auth
+        )
     bu_server = postgres.BuenaVistaServer(
-        host_addr, DuckDBConnection(ddb), rewriter=rewriter, auth=auth
+        host_addr, conn, rewriter=rewriter, auth=auth
     )
     return bu_server
 
@@ -111,7 +122,27 @@ if __name__ == "__main__":
         s_port = int(os.environ["PG_PORT"])
 
     address = (s_host, s_port)
-    server = create(db, address)
+    use_asyncio = os.environ.get("PG_ASYNCIO", "").lower() in ("1", "true")
+    result_cache = None
+    if "RESULT_CACHE_MB" in os.environ:
+        result_cache = ResultCache(
+            maxbytes=int(os.environ["RESULT_CACHE_MB"]) * 1024 * 1024,
+            ttl=float(os.environ.get("RESULT_CACHE_TTL", "300")),
+        )
+    max_sessions = os.environ.get("SESSION_POOL_MAX")
+    session_pool = SessionPool(
+        min_size=int(os.environ.get("SESSION_POOL_MIN", "0")),
+        max_size=int(max_sessions) if max_sessions else None,
+        timeout=float(os.environ.get("SESSION_POOL_TIMEOUT", "30")),
+        max_idle=float(os.environ.get("SESSION_IDLE_TIMEOUT", "300")),
+    )
+    server = create(
+        db,
+        address,
+        use_asyncio=use_asyncio,
+        result_cache=result_cache,
+        session_pool=session_pool,
+    )
     ip, port = server.server_address
     log.info(f"Listening on {ip}:{port}")
 
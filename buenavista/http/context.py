@@ -1,8 +1,11 @@
+import itertools
 import logging
-import queue
+import re
+import threading
+import time
 import uuid
 from collections import defaultdict
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
 
 from fastapi import Request
 
@@ -10,6 +13,9 @@ from ..core import Connection, Session, QueryResult
 
 logger = logging.getLogger(__name__)
 
+# Statements that may change the catalog or schema a session is using
+SESSION_PATTERN = re.compile(r"^\s*(USE|SET|RESET)\b", re.IGNORECASE)
+
 
 class Headers:
     def __init__(self, req: Request):
@@ -34,38 +40,206 @@ class Headers:
 
 
 class SessionPool:
-    def __init__(self):
-        self.pool = queue.SimpleQueue()
-        self.txns = {}
-
-    def acquire(self, conn: Connection, txn_id: Optional[Any] = None) -> Session:
-        if txn_id in self.txns:
-            return self.txns[txn_id]
-        else:
-            try:
-                sess = self.pool.get(block=False)
-            except queue.Empty:
-                sess = conn.create_session()
-            return sess
+    """The sessions of the HTTP frontend's users.
+
+    A request borrows a session of its user for its duration, and a request that
+    starts a transaction leaves the session with the transaction until a later
+    request ends it. At most max_sessions sessions exist in all (and at most
+    max_per_user for any user); a request that finds its user's limit reached
+    waits up to timeout seconds for one of the user's sessions to be released,
+    taking over an idle session of another user if only the overall limit was
+    reached, and fails with a TimeoutError otherwise. Sessions that have been idle
+    for idle_ttl seconds, and transactions that no request has used for txn_ttl
+    seconds, are closed (rolling the transactions back) whenever a session is
+    acquired or released.
+    """
 
-    def release(self, sess: Session, txn_id: Optional[Any] = None):
-        if txn_id:
-            self.txns[txn_id] = sess
-        else:
-            self.pool.put(sess)
+    def __init__(
+        self,
+        conn: Connection,
+        max_sessions: Optional[int] = 64,
+        max_per_user: Optional[int] = None,
+        timeout: Optional[float] = 30.0,
+        idle_ttl: Optional[float] = 300.0,
+        txn_ttl: Optional[float] = 3600.0,
+    ):
+        self.conn = conn
+        self.max_sessions = max_sessions
+        self.max_per_user = max_per_user
+        self.timeout = timeout
+        self.idle_ttl = idle_ttl
+        self.txn_ttl = txn_ttl
+        # user -> (release time, session) pairs, the most recently released last
+        self.idle: Dict[str, List[Tuple[float, Session]]] = defaultdict(list)
+        # transaction id -> (user, session, last used time)
+        self.txns: Dict[str, Tuple[str, Session, float]] = {}
+        self.counts: Dict[str, int] = defaultdict(int)
+        # session id -> the catalog/schema a request last switched the session to
+        self.targets: Dict[Any, str] = {}
+        self.total = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.metrics = dict.fromkeys(
+            ("created", "reused", "timeouts", "evicted", "idle_expired", "txns_expired"),
+            0,
+        )
+        self._cond = threading.Condition()
 
+    def acquire(self, user: str, txn_id: Optional[str] = None) -> Session:
+        if txn_id is not None:
+            with self._cond:
+                entry = self.txns.pop(txn_id, None)
+                if entry is None:
+                    raise ValueError(f"Unknown or expired transaction: {txn_id}")
+                self.in_use += 1
+                return entry[1]
 
-class Context:
-    POOLS = defaultdict(SessionPool)
+        expired = []
+        try:
+            with self._cond:
+                expired = self._expired()
+                deadline = None if self.timeout is None else time.monotonic() + self.timeout
+                while True:
+                    if self.idle[user]:
+                        sess = self.idle[user].pop()[1]
+                        self.in_use += 1
+                        self.metrics["reused"] += 1
+                        return sess
+                    if self._has_room(user) or self._evict_idle(user, expired):
+                        self.counts[user] += 1
+                        self.total += 1
+                        self.in_use += 1
+                        break
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self.metrics["timeouts"] += 1
+                        raise TimeoutError(
+                            f"No session became available for {user} within {self.timeout}s"
+                        )
+                    self.waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self.waiting -= 1
+        finally:
+            self._close(expired)
+
+        try:
+            sess = self.conn.create_session()
+        except BaseException:
+            with self._cond:
+                self._forget(user)
+                self.in_use -= 1
+                self._cond.notify_all()
+            raise
+        self.metrics["created"] += 1
+        return sess
+
+    def release(self, sess: Session, user: str, txn_id: Optional[str] = None):
+        with self._cond:
+            now = time.monotonic()
+            self.in_use -= 1
+            if txn_id is not None:
+                self.txns[txn_id] = (user, sess, now)
+            else:
+                self.idle[user].append((now, sess))
+            expired = self._expired()
+            self._cond.notify_all()
+        self._close(expired)
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "sessions": self.total,
+                "in_use": self.in_use,
+                "idle": sum(len(idle) for idle in self.idle.values()),
+                "transactions": len(self.txns),
+                "waiting": self.waiting,
+                "users": sum(1 for count in self.counts.values() if count),
+                **self.metrics,
+            }
+
+    def _has_room(self, user: str) -> bool:
+        if self.max_per_user is not None and self.counts[user] >= self.max_per_user:
+            return False
+        return self.max_sessions is None or self.total < self.max_sessions
+
+    def _evict_idle(self, user: str, evicted: List[Session]) -> bool:
+        """Makes room for a session by evicting the longest-idle session of another
+        user, if the overall limit is all that was reached."""
+        if self.max_per_user is not None and self.counts[user] >= self.max_per_user:
+            return False
+        candidates = [(idle[0][0], u) for u, idle in self.idle.items() if idle]
+        if not candidates:
+            return False
+        _, victim = min(candidates)
+        evicted.append(self.idle[victim].pop(0)[1])
+        self._forget(victim)
+        self.metrics["evicted"] += 1
+        return True
 
-    def __init__(self, conn: Connection, req: Request):
+    def _forget(self, user: str):
+        self.counts[user] -= 1
+        self.total -= 1
+        if not self.counts[user]:
+            del self.counts[user]
+
+    def _expired(self) -> List[Session]:
+        """Removes the sessions whose idle or transaction TTL has passed; must be
+        called with the lock held."""
+        now = time.monotonic()
+        expired = []
+        if self.idle_ttl is not None:
+            for user, idle in list(self.idle.items()):
+                count = 0
+                while count < len(idle) and now - idle[count][0] >= self.idle_ttl:
+                    count += 1
+                for _, sess in idle[:count]:
+                    expired.append(sess)
+                    self._forget(user)
+                del idle[:count]
+                if not idle:
+                    del self.idle[user]
+                self.metrics["idle_expired"] += count
+        if self.txn_ttl is not None:
+            for txn_id, (user, sess, used) in list(self.txns.items()):
+                if now - used >= self.txn_ttl:
+                    logger.info("Rolling back abandoned transaction %s", txn_id)
+                    del self.txns[txn_id]
+                    expired.append(sess)
+                    self._forget(user)
+                    self.metrics["txns_expired"] += 1
+        if expired:
+            self._cond.notify_all()
+        return expired
+
+    def _close(self, sessions: List[Session]):
+        for sess in sessions:
+            self.targets.pop(sess.id, None)
+            try:
+                self.conn.close_session(sess)
+            except Exception as e:
+                logger.warning("Error closing session: %s", e)
+
+
+class Context:
+    def __init__(self, pool: SessionPool, req: Request):
         self.h = Headers(req)
         self.txn_id = self.h.get("Transaction-Id")
         if self.txn_id == "NONE":
             self.txn_id = None
-        self.pool = self.POOLS[self.h.get("User", "default")]
-        self._sess = self.pool.acquire(conn, self.txn_id)
+        self.user = self.h.get("User", "default")
+        self.pool = pool
+        self._sess = None
+
+    def open(self):
+        """Acquires the session for the request, which may wait for one to be
+        released."""
+        self._sess = self.pool.acquire(self.user, self.txn_id)
 
+    def use_target(self):
+        """Switches the session to the requested catalog and schema, unless an
+        earlier request already left it there."""
         # Use a target catalog/schema, if specified
         use_target = None
         if catalog := self.h.get("Catalog"):
@@ -78,11 +252,14 @@ class Context:
                 use_target += f".{schema}"
             else:
                 use_target = schema
-        if use_target:
+        if use_target and self.pool.targets.get(self._sess.id) != use_target:
             self._sess.execute_sql(f"USE {use_target}")
+            self.pool.targets[self._sess.id] = use_target
 
     def execute_sql(self, sql: str) -> QueryResult:
         logger.debug(f"TXN %s: %s", self.txn_id, sql)
+        if SESSION_PATTERN.match(sql):
+            self.pool.targets.pop(self._sess.id, None)
         qr = self._sess.execute_sql(sql)
         ends_in_txn = self._sess.in_transaction()
         logger.debug("FINISH IN TXN: %s", ends_in_txn)
@@ -97,11 +274,157 @@ class Context:
         return qr
 
     def close(self):
-        self.pool.release(self._sess, self.txn_id)
-        self._sess = None
+        if self._sess is not None:
+            self.pool.release(self._sess, self.user, self.txn_id)
+            self._sess = None
 
     def session(self) -> Session:
         return self._sess
 
     def headers(self) -> Dict:
         return self.h.write
+
+
+# The metadata of a response to a client and the rows of data to send with it
+Response = Tuple[Any, Optional[List[Sequence]]]
+
+QUEUED, RUNNING, FINISHED, FAILED, CANCELED = (
+    "QUEUED",
+    "RUNNING",
+    "FINISHED",
+    "FAILED",
+    "CANCELED",
+)
+EXCEEDED_TIME_LIMIT = "EXCEEDED_TIME_LIMIT"
+
+
+class Query:
+    """A statement submitted to the HTTP frontend, whose results the client fetches
+    a page at a time by following the nextUri of each response.
+
+    The query keeps its context (and so its session) until the last page has been
+    served or it fails or is canceled. Responses are numbered by token, and the last
+    response is kept so that a client retrying a request gets the same page again.
+    """
+
+    def __init__(self, id: str, sql: str, ctx: Context):
+        self.id = id
+        self.sql = sql
+        self.ctx = ctx
+        self.state = QUEUED
+        self.started = time.time()
+        self.touched = time.monotonic()
+        self.token = 0
+        self.rows = 0
+        # Why the query was interrupted (CANCELED or EXCEEDED_TIME_LIMIT), if it was
+        self.interrupted: Optional[str] = None
+        self.columns = None
+        self.response: Optional[Response] = None
+        self.lock = threading.Lock()
+        self._pages: Optional[Iterator[List[Sequence]]] = None
+        self._next = None
+
+    def start(self, columns: List[Any], pages: Iterator[List[Sequence]]):
+        """Starts serving the pages of the result, reading one page ahead to know
+        whether there are more."""
+        self.state = RUNNING
+        self.columns = columns
+        self._pages = pages
+        self._next = next(pages, None)
+
+    def next_page(self) -> Tuple[Optional[List[Sequence]], bool]:
+        """Returns the next page of rows and whether any pages follow it; the query
+        is finished once the last page is returned."""
+        page, self._next = self._next, next(self._pages, None)
+        if page:
+            self.rows += len(page)
+        if self._next is None:
+            self.finish(FINISHED)
+        return page, self._next is not None
+
+    def done(self) -> bool:
+        return self.state in (FINISHED, FAILED, CANCELED)
+
+    def finish(self, state: str):
+        """Ends the query, releasing its session if it is still running."""
+        if not self.done():
+            self.state = state
+            self._pages = self._next = None
+            self.ctx.close()
+
+    def cancel(self):
+        with self.lock:
+            self.finish(CANCELED)
+
+    def interrupt(self, reason: str):
+        """Stops whatever the query is running for a request, from another thread;
+        a request that hasn't started yet gives up as soon as it does."""
+        self.interrupted = reason
+        if not self.done() and (sess := self.ctx.session()) is not None:
+            sess.interrupt()
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "queryId": self.id,
+            "state": self.state,
+            "user": self.ctx.user,
+            "query": self.sql,
+            "processedRows": self.rows,
+        }
+
+
+class QueryRegistry:
+    """The queries of the HTTP frontend, by id.
+
+    Results are served in pages of at most page_rows rows. A query that no request
+    has touched for abandon_timeout seconds is canceled if it is still running and
+    forgotten; this happens whenever a query is started or a page is fetched.
+    """
+
+    def __init__(self, page_rows: int = 10000, abandon_timeout: float = 300.0):
+        self.page_rows = page_rows
+        self.abandon_timeout = abandon_timeout
+        self.queries: Dict[str, Query] = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def create(self, sql: str, ctx: Context) -> Query:
+        with self._lock:
+            # Trino-style ids: the time of submission and a sequence number
+            id = "%s_%05d_bv" % (
+                time.strftime("%Y%m%d_%H%M%S", time.gmtime()),
+                next(self._seq) % 100000,
+            )
+            query = Query(id, sql, ctx)
+            self.queries[id] = query
+            return query
+
+    def get(self, id: str) -> Optional[Query]:
+        with self._lock:
+            return self.queries.get(id)
+
+    def reap(self) -> int:
+        """Cancels and forgets the queries that have been abandoned by their clients,
+        returning how many were removed."""
+        cutoff = time.monotonic() - self.abandon_timeout
+        with self._lock:
+            stale = [q for q in self.queries.values() if q.touched < cutoff]
+        removed = 0
+        for query in stale:
+            # A query whose page is being fetched right now is not abandoned
+            if not query.lock.acquire(blocking=False):
+                continue
+            try:
+                if not query.done():
+                    logger.info("Canceling abandoned query %s", query.id)
+                    query.finish(CANCELED)
+                with self._lock:
+                    self.queries.pop(query.id, None)
+                removed += 1
+            finally:
+                query.lock.release()
+        return removed
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [q.info() for q in self.queries.values()]
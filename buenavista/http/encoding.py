@@ -0,0 +1,61 @@
+"""JSON encoding of the HTTP frontend's responses.
+
+The metadata of a response (its id, columns, stats and so on) is serialized from
+its pydantic model, but the rows of data, which are most of the response, are
+written straight from the converted column values with orjson (if it is
+installed, and the standard json module otherwise) and streamed to the client
+in chunks.
+"""
+import datetime
+import json
+from typing import Any, Iterator, List, Optional, Sequence
+
+try:
+    import orjson
+except ImportError:  # orjson is only installed with the http extra
+    orjson = None
+
+from .schemas import BaseResult
+
+# The number of rows serialized into each chunk of a streamed response
+ROWS_PER_CHUNK = 1000
+
+
+def _default(obj: Any) -> Any:
+    # The values fastapi's jsonable_encoder would have given the types neither
+    # encoder handles natively
+    if isinstance(obj, bytes):
+        return obj.decode()
+    elif isinstance(obj, datetime.timedelta):
+        return obj.total_seconds()
+    return str(obj)
+
+
+if orjson is not None:
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_default)
+
+else:
+    _encoder = json.JSONEncoder(
+        separators=(",", ":"), ensure_ascii=False, default=_default
+    )
+
+    def dumps(obj: Any) -> bytes:
+        return _encoder.encode(obj).encode("utf-8")
+
+
+def encode_result(
+    result: BaseResult, data: Optional[List[Sequence]] = None
+) -> Iterator[bytes]:
+    """Yields the JSON of the result with the given rows as its data in chunks."""
+    head = result.model_dump_json(by_alias=True, exclude={"data"}).encode("utf-8")
+    if data is None:
+        yield head
+        return
+    # Splice the rows into the end of the metadata object
+    yield head[:-1] + b',"data":['
+    for start in range(0, len(data), ROWS_PER_CHUNK):
+        chunk = dumps(data[start : start + ROWS_PER_CHUNK])
+        yield (b"," if start else b"") + chunk[1:-1]
+    yield b"]}"
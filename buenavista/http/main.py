@@ -3,26 +3,52 @@ import concurrent.futures
 import functools
 import logging
 import time
-from typing import List, Optional
+from typing import Any, Callable, Iterator, List, Optional, Sequence, Tuple
 
 from fastapi import FastAPI, Request, Response
-from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse
 
-from . import context, schemas, type_mapping
-from ..core import Connection, Extension, Session, QueryResult
+from . import context, encoding, schemas, type_mapping
+from ..core import Connection, Extension, Session, QueryResult, to_pylist
 from ..rewrite import Rewriter
 
 logger = logging.getLogger(__name__)
 
+USER_CANCELED = "USER_CANCELED"
+
+# Trino's codes and types for the errors with names, and their Postgres SQLSTATEs
+ERROR_CODES = {
+    USER_CANCELED: (3, "USER_ERROR", "57014"),
+    context.EXCEEDED_TIME_LIMIT: (131075, "INSUFFICIENT_RESOURCES", "57014"),
+}
+
 
 def quacko(
     app: FastAPI,
     conn: Connection,
     rewriter: Optional[Rewriter] = None,
     extensions: List[Extension] = [],
+    sessions: Optional[context.SessionPool] = None,
+    queries: Optional[context.QueryRegistry] = None,
+    executor: Optional[concurrent.futures.Executor] = None,
+    timeout: Optional[float] = None,
 ):
-    pool = concurrent.futures.ThreadPoolExecutor()
+    if sessions is None:
+        sessions = context.SessionPool(conn)
+    if queries is None:
+        queries = context.QueryRegistry()
+    # Statements run on a dedicated executor, by default one worker for each
+    # statement the backend can run at once
+    if executor is None:
+        workers = conn.concurrency() or sessions.max_sessions or 32
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="bv-http-query"
+        )
+    # Waiting for a session and canceling queries happen on another executor, so
+    # that neither waits behind (or holds up) the statements
+    waiters = concurrent.futures.ThreadPoolExecutor(
+        max_workers=sessions.max_sessions or 32, thread_name_prefix="bv-http-wait"
+    )
     start_time = time.time()
     extensions_lookup = {e.type(): e for e in extensions}
 
@@ -37,88 +63,237 @@ def quacko(
             "uptime": f"{uptime_minutes:.2f} minutes",
         }
 
+    @app.get("/v1/sessions")
+    async def session_stats():
+        return sessions.stats()
+
+    @app.get("/v1/query")
+    async def list_queries():
+        return queries.list()
+
     @app.post("/v1/statement")
     async def statement(req: Request) -> Response:
         # TODO: check user, do stuff with it
-        ctxt = context.Context(conn, req)
+        ctxt = context.Context(sessions, req)
         raw_query = await req.body()
-        query = raw_query.decode("utf-8")
-        logger.info("HTTP Query: %s", query)
+        query = queries.create(raw_query.decode("utf-8"), ctxt)
+        logger.info("HTTP Query %s: %s", query.id, query.sql)
         loop = asyncio.get_running_loop()
-        result = await loop.run_in_executor(
-            pool, functools.partial(_execute, ctxt, query)
+        try:
+            await loop.run_in_executor(waiters, _open, query)
+        except Exception as e:
+            query.finish(context.FAILED)
+            # No session was available in time
+            result, data = _error_result(
+                query, e, retriable=isinstance(e, TimeoutError)
+            )
+        else:
+            result, data = await _run(
+                query, functools.partial(_start, query, str(req.base_url))
+            )
+        return _response(result, data, ctxt.headers())
+
+    @app.get("/v1/statement/executing/{query_id}/{token}")
+    async def statement_page(query_id: str, token: int, req: Request) -> Response:
+        query = queries.get(query_id)
+        if query is None:
+            return Response(status_code=410)
+        response = await _run(
+            query, functools.partial(_page, query, token, str(req.base_url))
         )
-        return JSONResponse(content=jsonable_encoder(result), headers=ctxt.headers())
+        if response is None:
+            return Response(status_code=410)
+        return _response(*response)
+
+    @app.delete("/v1/statement/executing/{query_id}/{token}")
+    async def cancel_statement(query_id: str, token: int) -> Response:
+        if query := queries.get(query_id):
+            logger.info("Canceling query %s", query_id)
+            query.interrupt(context.CANCELED)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(waiters, query.cancel)
+        return Response(status_code=204)
 
-    def _execute(ctx: context.Context, query: str) -> schemas.BaseResult:
-        start = round(time.time() * 1000)
-        id = f"{start_time}_{start}"
+    async def _run(query: context.Query, fn: Callable):
+        """Runs a request of the query on the executor, interrupting it if it takes
+        longer than the timeout."""
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(executor, fn)
+        if timeout is None:
+            return await future
         try:
-            if req := Extension.check_json(query):
-                method = req.get("method")
-                extension = extensions_lookup.get(method)
-                if not extension:
-                    raise Exception("Unknown method: " + str(method))
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            logger.info("Interrupting query %s after %ss", query.id, timeout)
+            query.interrupt(context.EXCEEDED_TIME_LIMIT)
+            try:
+                return await future
+            finally:
+                # A request that finished before the interrupt leaves the query as is
+                query.interrupted = None
+
+    def _open(query: context.Query):
+        # Abandoned queries may be holding the sessions this one is waiting for
+        queries.reap()
+        query.ctx.open()
+
+    def _start(query: context.Query, base_url: str) -> context.Response:
+        ctx, sql = query.ctx, query.sql
+        with query.lock:
+            try:
+                if query.interrupted:
+                    raise Exception("Query was interrupted before it started")
+                ctx.use_target()
+                if req := Extension.check_json(sql):
+                    method = req.get("method")
+                    extension = extensions_lookup.get(method)
+                    if not extension:
+                        raise Exception("Unknown method: " + str(method))
+                    else:
+                        qr = extension.apply(req.get("params"), ctx.session())
                 else:
-                    qr = extension.apply(req.get("params"), ctx.session())
-            else:
-                if rewriter:
-                    query = rewriter.rewrite(query)
-                qr = ctx.execute_sql(query)
-
-            logger.debug(
-                f"Query %s has %d columns in response", query, qr.column_count()
-            )
-            cols, data, update_type = _convert_query_result(qr)
-
-            return schemas.QueryResult(
-                id=id,
-                info_uri="http://127.0.0.1/info",
-                columns=cols,
-                data=data,
-                update_type=update_type,
-                stats=schemas.StatementStats(
-                    state="COMPLETE",
-                    elapsed_time_millis=(round(time.time() * 1000) - start),
-                ),
-            )
-        except Exception as e:
-            return schemas.ErrorResult(
-                id=id,
-                info_uri="http://127.0.0.1/info",
-                error=schemas.QueryError(
-                    message=f"Received error '{e}' executing query {query}",
-                    error_code=-1,
-                    retriable=False,
-                ),
-                stats=schemas.StatementStats(
-                    state="ERROR",
-                    elapsed_time_millis=(round(time.time() * 1000) - start),
-                ),
-            )
-        finally:
-            ctx.close()
+                    if rewriter:
+                        sql = rewriter.rewrite(sql)
+                    qr = ctx.execute_sql(sql)
+
+                logger.debug(
+                    f"Query %s has %d columns in response", sql, qr.column_count()
+                )
+                query.start(*_result_pages(qr, queries.page_rows))
+                return _next_result(query, base_url)
+            except Exception as e:
+                return _failed(query, e)
+
+    def _page(
+        query: context.Query, token: int, base_url: str
+    ) -> Optional[context.Response]:
+        queries.reap()
+        with query.lock:
+            query.touched = time.monotonic()
+            if token == query.token - 1 and query.response is not None:
+                # The client is retrying the last request
+                return query.response
+            if query.state == context.CANCELED:
+                return _error_result(query, "Query was canceled", USER_CANCELED)
+            if token != query.token or query.done():
+                return None
+            try:
+                if query.interrupted:
+                    raise Exception("Query was interrupted")
+                return _next_result(query, base_url)
+            except Exception as e:
+                return _failed(query, e)
+
+    def _failed(query: context.Query, e: Exception) -> context.Response:
+        if query.interrupted == context.CANCELED:
+            query.finish(context.CANCELED)
+            return _error_result(query, "Query was canceled", USER_CANCELED)
+        query.finish(context.FAILED)
+        if query.interrupted == context.EXCEEDED_TIME_LIMIT:
+            message = f"Query exceeded the maximum execution time of {timeout}s"
+            return _error_result(query, message, context.EXCEEDED_TIME_LIMIT)
+        return _error_result(query, e)
+
+    def _next_result(query: context.Query, base_url: str) -> context.Response:
+        page, more = query.next_page()
+        query.token += 1
+        result = schemas.QueryResult(
+            id=query.id,
+            info_uri="http://127.0.0.1/info",
+            next_uri=(
+                f"{base_url}v1/statement/executing/{query.id}/{query.token}"
+                if more
+                else None
+            ),
+            columns=query.columns,
+            stats=_stats(query),
+        )
+        query.response = (result, page)
+        return query.response
+
+    def _error_result(
+        query: context.Query, e: Any, name: Optional[str] = None, retriable=False
+    ) -> context.Response:
+        code, error_type, sql_state = ERROR_CODES.get(name, (-1, None, None))
+        result = schemas.ErrorResult(
+            id=query.id,
+            info_uri="http://127.0.0.1/info",
+            error=schemas.QueryError(
+                message=f"Received error '{e}' executing query {query.sql}",
+                sql_state=sql_state,
+                error_code=code,
+                error_name=name,
+                error_type=error_type,
+                retriable=retriable,
+            ),
+            stats=_stats(query),
+        )
+        query.response = (result, None)
+        return query.response
+
 
+def _response(
+    result: schemas.BaseResult, data: Optional[List[Sequence]], headers=None
+) -> Response:
+    return StreamingResponse(
+        encoding.encode_result(result, data),
+        media_type="application/json",
+        headers=headers,
+    )
 
-def _convert_query_result(qr: QueryResult):
+
+def _stats(query: context.Query) -> schemas.StatementStats:
+    return schemas.StatementStats(
+        state=query.state,
+        processed_rows=query.rows,
+        elapsed_time_millis=round((time.time() - query.started) * 1000),
+    )
+
+
+def _result_pages(
+    qr: QueryResult, page_rows: int
+) -> Tuple[List[schemas.Column], Iterator[List[Sequence]]]:
+    """Returns the Trino columns of the result and a lazy iterator over its rows,
+    converted to Trino's representation a column at a time, in pages of at most
+    page_rows rows."""
     # Special handling for DESCRIBE-style results for reasons
     if qr.column_count() == 6:
         if qr.column(0)[0] == "column_name" and qr.column(1)[0] == "column_type":
             logger.info("Performing DESCRIBE conversion on QueryResults")
+
+            def describe(columns):
+                names, types = to_pylist(columns[0]), to_pylist(columns[1])
+                return [(n, t, "", "") for n, t in zip(names, types)]
+
             cols = type_mapping.DESCRIBE_COLUMNS
-            data = []
-            for r in qr.rows():
-                data.append([r[0], r[1], "", ""])
-            return cols, data, None
+            return cols, _pages(qr.batches(), describe, page_rows)
 
     cols, converters = [], []
     for i in range(qr.column_count()):
         name, bvtype = qr.column(i)
         ttype, cts = type_mapping.to_trino(bvtype)
         cols.append(schemas.Column(name=name, type=ttype, type_signature=cts))
-        converters.append(type_mapping.type_converter(bvtype))
+        converters.append(type_mapping.column_converter(bvtype))
+
+    def convert(columns):
+        return list(zip(*[converters[i](c) for i, c in enumerate(columns)]))
+
+    return cols, _pages(qr.batches(), convert, page_rows)
+
 
-    data = []
-    for r in qr.rows():
-        data.append([converters[i](v) for i, v in enumerate(r)])
-    return cols, data, None
+def _pages(
+    batches: Iterator[List[Sequence]], convert: Callable, page_rows: int
+) -> Iterator[List[Sequence]]:
+    page = []
+    for columns in batches:
+        # Only convert as many rows of a (possibly large) batch as fit on the page
+        num_rows, start = len(columns[0]), 0
+        while start < num_rows:
+            count = min(page_rows - len(page), num_rows - start)
+            page.extend(convert([c[start : start + count] for c in columns]))
+            start += count
+            if len(page) == page_rows:
+                yield page
+                page = []
+    if page:
+        yield page
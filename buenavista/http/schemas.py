@@ -86,11 +86,12 @@ class BaseResult(CamelModel):
 
 
 class QueryResult(BaseResult):
-    partial_cancel_uri: Optional[HttpUrl]
-    columns: Optional[List[Column]]
-    data: Optional[List[List[Any]]]
-    update_type: Optional[str]
-    update_count: Optional[int]
+    next_uri: Optional[HttpUrl] = None
+    partial_cancel_uri: Optional[HttpUrl] = None
+    columns: Optional[List[Column]] = None
+    data: Optional[List[List[Any]]] = None
+    update_type: Optional[str] = None
+    update_count: Optional[int] = None
 
 
 class ErrorResult(BaseResult):
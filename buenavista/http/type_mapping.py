@@ -1,6 +1,11 @@
-from typing import Callable, List, Tuple
+from typing import Callable, List, Sequence, Tuple
 
-from ..core import BVType
+try:
+    import pyarrow as pa
+except ImportError:  # pyarrow is only installed with the duckdb extra
+    pa = None
+
+from ..core import BVType, to_pylist
 from .schemas import ClientTypeSignature, ClientTypeSignatureParameter, Column
 
 
@@ -45,12 +50,35 @@ TYPE_MAPPING = {
 }
 
 
+STRING_TYPES = (BVType.DECIMAL, BVType.TIMESTAMP, BVType.TIME, BVType.DATE)
+
+# Types whose Arrow string casts are formatted the way str() formats their values
+ARROW_STRING_TYPES = (BVType.DECIMAL, BVType.DATE)
+
+
 def type_converter(bvtype: BVType) -> Callable:
-    if bvtype in (BVType.DECIMAL, BVType.TIMESTAMP, BVType.TIME, BVType.DATE):
-        return lambda x: str(x) if x else None
+    if bvtype in STRING_TYPES:
+        return lambda x: str(x) if x is not None else None
     return lambda x: x
 
 
+def column_converter(bvtype: BVType) -> Callable[[Sequence], List]:
+    """Returns a function that converts a column chunk returned by
+    QueryResult.batches() to the list of its values in Trino's JSON encoding."""
+    if bvtype not in STRING_TYPES:
+        return to_pylist
+
+    convert = type_converter(bvtype)
+
+    def to_strings(column: Sequence) -> List:
+        if pa is not None and bvtype in ARROW_STRING_TYPES:
+            if isinstance(column, (pa.Array, pa.ChunkedArray)):
+                return column.cast(pa.string()).to_pylist()
+        return list(map(convert, to_pylist(column)))
+
+    return to_strings
+
+
 def to_trino(bvtype: BVType) -> Tuple[str, ClientTypeSignature]:
     ret = TYPE_MAPPING.get(bvtype)
     if not ret:
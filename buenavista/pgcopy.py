@@ -0,0 +1,524 @@
+"""Parsing and encoding for the COPY ... TO STDOUT / FROM STDIN statements that are
+served over the PG wire protocol instead of being run by the backend.
+
+COPY statements that read or write files are left to the backend. The encoders
+here work on the per-value converters of `BVTYPE_TO_PGTYPE` for results that are
+not made of Arrow arrays; `columnar` has the vectorized equivalents, as well as
+the decoders that turn the data of a COPY ... FROM STDIN into Arrow tables.
+"""
+import re
+import struct
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+from sqlglot.errors import TokenError
+from sqlglot.tokens import Token, Tokenizer, TokenType
+
+from .core import BulkLoad, to_pylist
+from .pgtypes import INT2, INT4, ParamDecoder
+
+COPY_DATA = b"d"
+
+# The signature, flags field and header extension length of the binary format
+BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+BINARY_TRAILER = struct.pack("!h", -1)
+
+FORMATS = ("text", "csv", "binary")
+# The options of the unparenthesized syntax, and those of them that take a value
+VALUE_OPTIONS = {"DELIMITER", "NULL", "QUOTE", "ESCAPE", "ENCODING"}
+OPTIONS = VALUE_OPTIONS | {"BINARY", "CSV", "HEADER", "FORCE"}
+FORCE_WORDS = {"QUOTE", "NOT", "NULL"}
+TRUE_VALUES = {"true", "on", "1", "t", "yes"}
+
+_COPY_PREFIX = re.compile(r"^\s*copy\b", re.IGNORECASE)
+# Characters that are backslash-escaped in the text format
+_TEXT_ESCAPES = {"\\": "\\\\", "\n": "\\n", "\r": "\\r", "\t": "\\t"}
+_TEXT_UNESCAPE = re.compile(r"\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)", re.DOTALL)
+_UNESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v"}
+
+# A decoder for the data of a COPY ... FROM STDIN: takes a chunk of data and
+# returns a batch of its rows (or None), the number of bytes it consumed and
+# whether it reached the end of the data
+CopyDecoder = Callable[[bytes], Tuple[Any, int, bool]]
+
+
+class CopyStatement:
+    """A COPY statement between a table or query and the client connection."""
+
+    def __init__(
+        self,
+        direction: str,
+        query: Optional[str] = None,
+        table: Optional[str] = None,
+        columns: Optional[str] = None,
+        format: str = "text",
+        delimiter: Optional[str] = None,
+        null: Optional[str] = None,
+        header: bool = False,
+        quote: str = '"',
+        escape: Optional[str] = None,
+    ):
+        if format not in FORMATS:
+            raise ValueError(f"COPY format {format!r} not recognized")
+        self.direction = direction
+        self.query = query
+        self.table = table
+        self.columns = columns
+        self.format = format
+        self.csv = format == "csv"
+        self.delimiter = delimiter or ("," if self.csv else "\t")
+        self.null = null if null is not None else ("" if self.csv else "\\N")
+        self.header = header
+        self.quote = quote
+        self.escape = escape or quote
+        if len(self.delimiter) != 1:
+            raise ValueError("COPY delimiter must be a single one-byte character")
+
+    @property
+    def binary(self) -> bool:
+        return self.format == "binary"
+
+    def select_sql(self) -> str:
+        """The query whose results a COPY ... TO statement sends."""
+        if self.query is not None:
+            return self.query
+        return f"SELECT {self.columns or '*'} FROM {self.table}"
+
+    def __repr__(self):
+        return f"CopyStatement({self.direction}, {self.select_sql()!r}, {self.format})"
+
+
+def parse_copy(sql: str) -> Optional[CopyStatement]:
+    """Parses a COPY ... TO STDOUT or COPY ... FROM STDIN statement, returning None
+    for any other statement (including COPY statements that use files)."""
+    if not _COPY_PREFIX.match(sql):
+        return None
+    try:
+        tokens = [
+            t
+            for t in Tokenizer().tokenize(sql)
+            if t.token_type != TokenType.SEMICOLON
+        ]
+    except TokenError:
+        return None
+
+    query, table, columns = None, None, None
+    if len(tokens) > 1 and tokens[1].token_type == TokenType.L_PAREN:
+        end = _closing_paren(tokens, 1)
+        query = sql[tokens[1].end + 1 : tokens[end].start].strip()
+        i = end + 1
+    else:
+        i = 1
+        while i < len(tokens) and not (
+            tokens[i].token_type == TokenType.L_PAREN
+            or tokens[i].text.upper() in ("TO", "FROM")
+        ):
+            i += 1
+        if i == 1:
+            return None
+        table = sql[tokens[1].start : tokens[i - 1].end + 1]
+        if i < len(tokens) and tokens[i].token_type == TokenType.L_PAREN:
+            end = _closing_paren(tokens, i)
+            columns = sql[tokens[i].end + 1 : tokens[end].start].strip() or None
+            i = end + 1
+
+    if i + 1 >= len(tokens):
+        return None
+    direction = tokens[i].text.upper()
+    target = tokens[i + 1].text.upper()
+    if (direction, target) not in (("TO", "STDOUT"), ("FROM", "STDIN")):
+        return None
+    options = _parse_options(tokens[i + 2 :])
+    return CopyStatement(direction.lower(), query, table, columns, **options)
+
+
+def _closing_paren(tokens: List[Token], start: int) -> int:
+    depth = 0
+    for i in range(start, len(tokens)):
+        if tokens[i].token_type == TokenType.L_PAREN:
+            depth += 1
+        elif tokens[i].token_type == TokenType.R_PAREN:
+            depth -= 1
+            if depth == 0:
+                return i
+    raise ValueError("Unbalanced parentheses in COPY statement")
+
+
+def _parse_options(tokens: List[Token]) -> dict:
+    """Parses both the parenthesized option list, e.g. WITH (FORMAT csv, HEADER),
+    and the older unparenthesized syntax, e.g. WITH CSV HEADER DELIMITER AS ';'."""
+    if tokens and tokens[0].text.upper() == "WITH":
+        tokens = tokens[1:]
+    items = []
+    if tokens and tokens[0].token_type == TokenType.L_PAREN:
+        item = []
+        for token in tokens[1 : _closing_paren(tokens, 0)]:
+            if token.token_type == TokenType.COMMA:
+                items.append(item)
+                item = []
+            else:
+                item.append(token)
+        items.append(item)
+    else:
+        # Split the words into (option, value) items; the old syntax spells the
+        # format as a bare option name and may put an AS before a value
+        i = 0
+        while i < len(tokens):
+            name = tokens[i].text.upper()
+            i += 1
+            if name in ("BINARY", "CSV"):
+                items.append([_word("FORMAT"), _word(name)])
+            elif name in VALUE_OPTIONS:
+                if i < len(tokens) and tokens[i].text.upper() == "AS":
+                    i += 1
+                items.append([_word(name)] + tokens[i : i + 1])
+                i += 1
+            elif name == "FORCE":
+                # FORCE QUOTE / FORCE NOT NULL column lists do not change the output
+                while i < len(tokens) and tokens[i].text.upper() in FORCE_WORDS:
+                    i += 1
+                while i < len(tokens) and tokens[i].text.upper() not in OPTIONS:
+                    i += 1
+            else:
+                items.append([_word(name)])
+
+    options = {}
+    for item in items:
+        if not item:
+            continue
+        name = item[0].text.upper()
+        value = item[1].text if len(item) > 1 else None
+        if name == "FORMAT":
+            options["format"] = (value or "").lower()
+        elif name == "HEADER":
+            options["header"] = value is None or value.lower() in TRUE_VALUES
+        elif name in ("DELIMITER", "NULL", "QUOTE", "ESCAPE"):
+            if value is None:
+                raise ValueError(f"COPY option {name} requires a value")
+            options[name.lower()] = value
+        elif name in ("BINARY", "CSV"):
+            options["format"] = name.lower()
+    return options
+
+
+def _word(text: str) -> Token:
+    return Token(TokenType.VAR, text)
+
+
+def _csv_field(value: str, copy: CopyStatement) -> str:
+    if (
+        copy.delimiter in value
+        or copy.quote in value
+        or "\n" in value
+        or "\r" in value
+        or value == copy.null
+        or value == "\\."
+    ):
+        if copy.escape != copy.quote:
+            value = value.replace(copy.escape, copy.escape * 2)
+        value = value.replace(copy.quote, copy.escape + copy.quote)
+        return copy.quote + value + copy.quote
+    return value
+
+
+def _text_field(value: str, copy: CopyStatement) -> str:
+    for c in value:
+        if c in _TEXT_ESCAPES or c == copy.delimiter:
+            break
+    else:
+        return value
+    return "".join(
+        _TEXT_ESCAPES.get(c) or ("\\" + c if c == copy.delimiter else c) for c in value
+    )
+
+
+def _copy_data(data: bytes) -> bytes:
+    return COPY_DATA + struct.pack("!i", len(data) + 4) + data
+
+
+def encode_header(names: Sequence[str], copy: CopyStatement) -> bytes:
+    """The CopyData message with the header line of a CSV COPY."""
+    line = copy.delimiter.join(_csv_field(name, copy) for name in names)
+    return _copy_data((line + "\n").encode("utf-8"))
+
+
+def with_binary_header(messages: bytes) -> bytes:
+    """Prepends the binary format header to the first of a run of CopyData messages,
+    which is where Postgres sends it and clients that parse rows expect it."""
+    end = struct.unpack_from("!i", messages, 1)[0] + 1
+    return _copy_data(BINARY_HEADER + messages[5:end]) + messages[end:]
+
+
+def encode_text_rows(
+    columns: List[Sequence], converters: List[Callable], copy: CopyStatement
+) -> bytes:
+    """Encodes a chunk of column values as the lines of a text or CSV COPY, each in
+    its own CopyData message."""
+    field = _csv_field if copy.csv else _text_field
+    cells_by_column = []
+    for values, converter in zip(columns, converters):
+        cells_by_column.append(
+            [
+                copy.null if v is None else field(converter(v), copy)
+                for v in to_pylist(values)
+            ]
+        )
+    return b"".join(
+        _copy_data((copy.delimiter.join(cells) + "\n").encode("utf-8"))
+        for cells in zip(*cells_by_column)
+    )
+
+
+def encode_binary_tuples(columns: List[Sequence], converters: List[Callable]) -> bytes:
+    """Encodes a chunk of column values as the tuples of a binary COPY, each in its
+    own CopyData message."""
+    cells_by_column = []
+    for values, converter in zip(columns, converters):
+        cells = []
+        for v in to_pylist(values):
+            if v is None:
+                cells.append(b"\xff\xff\xff\xff")
+            else:
+                v = converter(v)
+                cells.append(struct.pack("!i", len(v)) + v)
+        cells_by_column.append(cells)
+    return b"".join(
+        _copy_data(struct.pack("!h", len(cells)) + b"".join(cells))
+        for cells in zip(*cells_by_column)
+    )
+
+
+def _unescape(match: re.Match) -> str:
+    code = match.group(1)
+    if code[0] == "x" and len(code) > 1:
+        return chr(int(code[1:], 16))
+    elif code[0] in "01234567":
+        return chr(int(code, 8))
+    return _UNESCAPES.get(code, code)
+
+
+def unescape_text(value: str) -> str:
+    """Decodes the backslash escapes of a value in the text format."""
+    return _TEXT_UNESCAPE.sub(_unescape, value) if "\\" in value else value
+
+
+def parse_text_rows(data: bytes, copy: CopyStatement) -> List[List[Optional[str]]]:
+    """Parses the lines of a text COPY into rows of strings one character at a
+    time, for data that escapes its delimiter."""
+    rows = []
+    lines = data.decode("utf-8").split("\n")
+    if not lines[-1]:
+        # What follows the newline that ends the last line
+        lines.pop()
+    for line in lines:
+        if line.endswith("\r"):
+            line = line[:-1]
+        fields, start, i = [], 0, 0
+        while i < len(line):
+            if line[i] == "\\":
+                i += 2
+            elif line[i] == copy.delimiter:
+                fields.append(line[start:i])
+                start = i = i + 1
+            else:
+                i += 1
+        fields.append(line[start:])
+        rows.append([None if f == copy.null else unescape_text(f) for f in fields])
+    return rows
+
+
+def decode_binary_tuples(
+    data: bytes, decoder: ParamDecoder
+) -> Tuple[List[List], int, bool]:
+    """Decodes the complete tuples at the start of the data of a binary COPY,
+    returning them along with the number of bytes they take up and whether the
+    trailer that ends the data was reached."""
+    ncols = len(decoder.decoders)
+    rows = []
+    offset, n = 0, len(data)
+    while offset + 2 <= n:
+        count = INT2.unpack_from(data, offset)[0]
+        if count == -1:
+            return rows, n, True
+        elif count != ncols:
+            raise ValueError(f"COPY row has {count} fields, expected {ncols}")
+        # Find the end of the tuple before decoding it, as it may be incomplete
+        end = offset + 2
+        for _ in range(count):
+            if end + 4 > n:
+                return rows, offset, False
+            end += 4 + max(INT4.unpack_from(data, end)[0], 0)
+        if end > n:
+            break
+        rows.append(decoder.decode(data, offset + 2)[0])
+        offset = end
+    return rows, offset, False
+
+
+def binary_header_size(data: bytes) -> int:
+    """The size of the signature, flags and header extension that start the data of
+    a binary COPY, of which at least len(BINARY_HEADER) bytes must be given."""
+    if not data.startswith(BINARY_HEADER[:11]):
+        raise ValueError("COPY file signature not recognized")
+    return len(BINARY_HEADER) + INT4.unpack_from(data, 15)[0]
+
+
+class CopyIn:
+    """The state of a COPY ... FROM STDIN: buffers the CopyData sent by the client
+    and loads it in batches of complete rows every `batch_bytes`."""
+
+    def __init__(
+        self,
+        copy: CopyStatement,
+        loader: BulkLoad,
+        decode: CopyDecoder,
+        batch_bytes: int = 8 * 1024 * 1024,
+    ):
+        self.copy = copy
+        self.loader = loader
+        self.decode = decode
+        self.batch_bytes = batch_bytes
+        self.buf = bytearray()
+        self.header_pending = copy.binary or (copy.csv and copy.header)
+        self.done = False
+        # How much of the buffer was scanned for the ends of CSV rows, the end of
+        # the last complete row in it, and whether the scan ended in quotes
+        self.scanned = self.rows_end = 0
+        self.quoted = False
+        if copy.csv and copy.escape != copy.quote:
+            quote = re.escape(copy.quote.encode("utf-8"))
+            escape = re.escape(copy.escape.encode("utf-8"))
+            other = b"[^%s%s]*" % (quote, escape)
+            quoted = b"%s(?:%s.%s)*" % (other, escape, other)
+            # The rest of a quoted value, up to its closing quote or a trailing escape
+            self._quoted_run = re.compile(quoted, re.S)
+            # Complete rows, starting outside quotes
+            unquoted = b"[^%s\n]*" % quote
+            row = b"%s(?:%s%s%s%s)*\n" % (unquoted, quote, quoted, quote, unquoted)
+            self._rows = re.compile(b"(?:%s)*" % row, re.S)
+
+    def feed(self, data: bytes):
+        if self.done:
+            return
+        self.buf += data
+        if len(self.buf) >= self.batch_bytes:
+            self._load(final=False)
+
+    def finish(self) -> int:
+        """Loads the rest of the data, returning the number of rows loaded."""
+        self._load(final=True)
+        if self.buf:
+            raise ValueError("unexpected end of COPY data")
+        return self.loader.finish()
+
+    def abort(self):
+        self.loader.abort()
+
+    def _load(self, final: bool):
+        if self.header_pending and not self._skip_header(final):
+            return
+        end = len(self.buf) if self.copy.binary or final else self._complete_lines()
+        if not self.copy.binary:
+            # Clients may still end the data with the end-of-data marker line
+            marker = self._end_of_data(end)
+            if marker >= 0:
+                end = marker
+                self.done = True
+        if end:
+            batch, used, done = self.decode(bytes(self.buf[:end]))
+            if batch is not None:
+                self.loader.append(batch)
+            self.done = self.done or done
+            del self.buf[:used]
+            self.scanned = max(self.scanned - used, 0)
+            self.rows_end = max(self.rows_end - used, 0)
+        if self.done:
+            self.buf.clear()
+
+    def _end_of_data(self, end: int) -> int:
+        """The offset of the end-of-data marker line within the first end bytes of
+        the buffer, or -1."""
+        i = self.buf.find(b"\\.", 0, end)
+        while i >= 0:
+            if (i == 0 or self.buf[i - 1] == ord("\n")) and (
+                i + 2 == end or self.buf[i + 2] in b"\r\n"
+            ):
+                return i
+            i = self.buf.find(b"\\.", i + 2, end)
+        return -1
+
+    def _complete_lines(self) -> int:
+        """The length of the complete lines in the buffer."""
+        if not self.copy.csv:
+            return self.buf.rfind(b"\n") + 1
+        # A line ends a row unless it is inside a quoted value; whether the data
+        # is quoted is tracked across calls, so only new data is scanned
+        if self.copy.escape == self.copy.quote:
+            self._scan_quotes()
+        else:
+            self._scan_escaped()
+        return self.rows_end
+
+    def _scan_quotes(self):
+        """Scans data in which every quote starts or ends a quoted value (an escaped
+        quote being a quoted value that ends as another starts)."""
+        quote = self.copy.quote.encode("utf-8")
+        buf, pos, n = self.buf, self.scanned, len(self.buf)
+        self.quoted ^= buf.count(quote, pos, n) % 2 == 1
+        # Walk back from the end to the last line that ends outside quotes
+        quoted, i = self.quoted, n
+        while True:
+            j = buf.rfind(b"\n", pos, i)
+            if j < 0:
+                break
+            quoted ^= buf.count(quote, j + 1, i) % 2 == 1
+            if not quoted:
+                self.rows_end = j + 1
+                break
+            i = j
+        self.scanned = n
+
+    def _scan_escaped(self):
+        """Scans data in which quotes may be escaped by another character."""
+        quote = self.copy.quote.encode("utf-8")[0]
+        buf, pos, n = self.buf, self.scanned, len(self.buf)
+        rows = self._rows
+        while pos < n:
+            if self.quoted:
+                pos = self._quoted_run.match(buf, pos).end()
+                if pos == n or buf[pos] != quote:
+                    # Scan a trailing escape again once what it escapes arrives
+                    break
+                self.quoted = False
+                pos += 1
+            else:
+                if rows is not None:
+                    # Skip the complete rows ahead; the rest of the data is then
+                    # part of a row, so this is only done once
+                    end = rows.match(buf, pos).end()
+                    if end > pos:
+                        self.rows_end = pos = end
+                    rows = None
+                # The row is outside quotes until its next quote
+                pos = buf.find(quote, pos)
+                if pos < 0:
+                    pos = n
+                else:
+                    self.quoted = True
+                    pos += 1
+        self.scanned = pos
+
+    def _skip_header(self, final: bool) -> bool:
+        """Skips the header of the data if it is complete, returning whether it was."""
+        if self.copy.binary:
+            if len(self.buf) < len(BINARY_HEADER):
+                if final and self.buf:
+                    raise ValueError("COPY file signature not recognized")
+                return False
+            end = binary_header_size(self.buf)
+        else:
+            end = self.buf.find(b"\n") + 1 or (len(self.buf) if final else 0)
+        if end == 0 or end > len(self.buf):
+            return False
+        del self.buf[:end]
+        self.header_pending = False
+        return True
@@ -0,0 +1,369 @@
+"""Decoders for the parameter values that clients send in Bind messages, keyed by type OID.
+
+Every decoder takes the raw bytes of a value in either the text (0) or binary (1)
+format and returns the Python value that is passed on to the backend. Parameters
+with an unspecified (0) or unknown type OID are decoded as strings (or lists of
+strings for array literals) in the text format and as unsigned big-endian
+integers in the binary format. Dates and times that Python can't represent, such
+as infinity, are passed on as strings for the backend to cast.
+"""
+import datetime
+import decimal
+import functools
+import re
+import struct
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+INT2 = struct.Struct("!h")
+INT4 = struct.Struct("!i")
+UINT4 = struct.Struct("!I")
+INT8 = struct.Struct("!q")
+FLOAT4 = struct.Struct("!f")
+FLOAT8 = struct.Struct("!d")
+NUMERIC_HEADER = struct.Struct("!hhHh")
+ARRAY_HEADER = struct.Struct("!iiI")
+ARRAY_DIM = struct.Struct("!ii")
+
+PG_EPOCH_ORDINAL = datetime.date(2000, 1, 1).toordinal()
+PG_EPOCH = datetime.datetime(2000, 1, 1)
+PG_EPOCH_TZ = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+
+# The text formats of dates and times, as Postgres sends them
+TEXT_DATE = re.compile(r"(\d{4})-(\d\d)-(\d\d)")
+TEXT_TIME = re.compile(r"(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?")
+TEXT_TIMESTAMP = re.compile(
+    r"(\d{4})-(\d\d)-(\d\d)(?:[ T](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?)?"
+    r"(?:([+-])(\d\d)(?::?(\d\d))?(?::?(\d\d))?)?"
+)
+
+NUMERIC_NEG = 0x4000
+NUMERIC_NAN = 0xC000
+
+UNKNOWN_OIDS = (0, 705)
+TRUE_VALUES = {"t", "true", "y", "yes", "on", "1"}
+
+Decoder = Callable[[bytes], Any]
+
+
+def _unpacker(s: struct.Struct) -> Decoder:
+    unpack = s.unpack
+
+    def _unpack(v):
+        return unpack(v)[0]
+
+    return _unpack
+
+
+def _text(v: bytes) -> str:
+    return str(v, "utf-8")
+
+
+def _text_int(v: bytes) -> int:
+    return int(bytes(v))
+
+
+def _text_float(v: bytes) -> float:
+    return float(bytes(v))
+
+
+def _binary_numeric(v: bytes) -> decimal.Decimal:
+    ndigits, weight, sign, dscale = NUMERIC_HEADER.unpack_from(v)
+    if sign == NUMERIC_NAN:
+        return decimal.Decimal("NaN")
+    # The value is made of base-10000 digits, the first of which is multiplied by
+    # 10000^weight; convert them to decimal digits with dscale fractional digits
+    groups = struct.unpack_from(f"!{ndigits}h", v, NUMERIC_HEADER.size)
+    digits = [int(c) for c in "".join("%04d" % g for g in groups)] or [0]
+    exponent = (weight - ndigits + 1) * 4
+    if exponent > -dscale:
+        digits.extend([0] * (exponent + dscale))
+    elif exponent < -dscale:
+        digits = digits[: len(digits) - (-dscale - exponent)] or [0]
+    return decimal.Decimal((1 if sign == NUMERIC_NEG else 0, tuple(digits), -dscale))
+
+
+def _binary_date(v: bytes) -> datetime.date:
+    return datetime.date.fromordinal(PG_EPOCH_ORDINAL + INT4.unpack(v)[0])
+
+
+def _binary_time(v: bytes) -> datetime.time:
+    micros = INT8.unpack(v)[0]
+    return (datetime.datetime.min + datetime.timedelta(microseconds=micros)).time()
+
+
+def _binary_timestamp(v: bytes) -> datetime.datetime:
+    return PG_EPOCH + datetime.timedelta(microseconds=INT8.unpack(v)[0])
+
+
+def _binary_timestamptz(v: bytes) -> datetime.datetime:
+    return PG_EPOCH_TZ + datetime.timedelta(microseconds=INT8.unpack(v)[0])
+
+
+def _binary_array(v: bytes) -> Optional[List]:
+    ndim, _, elem_oid = ARRAY_HEADER.unpack_from(v)
+    if ndim == 0:
+        return []
+    dims = [ARRAY_DIM.unpack_from(v, ARRAY_HEADER.size + 8 * i)[0] for i in range(ndim)]
+    decode = binary_decoder(elem_oid)
+    offset = ARRAY_HEADER.size + 8 * ndim
+    values = []
+    for _ in range(functools.reduce(lambda a, b: a * b, dims)):
+        n = INT4.unpack_from(v, offset)[0]
+        offset += 4
+        if n < 0:
+            values.append(None)
+        else:
+            values.append(decode(v[offset : offset + n]))
+            offset += n
+    # Fold the flat list of elements into nested lists, innermost dimension first
+    for size in reversed(dims[1:]):
+        values = [values[i : i + size] for i in range(0, len(values), size)]
+    return values
+
+
+def _text_bool(v: bytes) -> bool:
+    return _text(v).lower() in TRUE_VALUES
+
+
+def _text_bytea(v: bytes) -> bytes:
+    v = bytes(v)
+    if v.startswith(b"\\x"):
+        return bytes.fromhex(v[2:].decode("ascii"))
+    # The escape format: backslashes are doubled and other bytes may be escaped
+    # as three octal digits
+    ret = bytearray()
+    i = 0
+    while i < len(v):
+        if v[i : i + 1] == b"\\":
+            if v[i + 1 : i + 2] == b"\\":
+                ret.append(0x5C)
+                i += 2
+            else:
+                ret.append(int(v[i + 1 : i + 4], 8))
+                i += 4
+        else:
+            ret.append(v[i])
+            i += 1
+    return bytes(ret)
+
+
+def _micros(fraction: Optional[str]) -> int:
+    # Postgres trims the trailing zeros of fractions of a second, e.g. ".5"
+    return int(fraction.ljust(6, "0")) if fraction else 0
+
+
+def _text_date(m: re.Match) -> datetime.date:
+    return datetime.date(int(m[1]), int(m[2]), int(m[3]))
+
+
+def _text_time(m: re.Match) -> datetime.time:
+    return datetime.time(int(m[1]), int(m[2]), int(m[3]), _micros(m[4]))
+
+
+def _text_timestamp(m: re.Match) -> datetime.datetime:
+    tz = None
+    if m[8]:
+        # Postgres abbreviates UTC offsets to their hours, e.g. "+02"
+        offset = datetime.timedelta(
+            hours=int(m[9]), minutes=int(m[10] or 0), seconds=int(m[11] or 0)
+        )
+        tz = datetime.timezone(-offset if m[8] == "-" else offset)
+    return datetime.datetime(
+        int(m[1]),
+        int(m[2]),
+        int(m[3]),
+        int(m[4] or 0),
+        int(m[5] or 0),
+        int(m[6] or 0),
+        _micros(m[7]),
+        tz,
+    )
+
+
+def _parsed(pattern: re.Pattern, build: Callable[[re.Match], Any]) -> Decoder:
+    """A text decoder that builds a value from the fields the pattern matches, and
+    passes any other text (e.g. infinity or a BC date) on as a string."""
+
+    def decode(v: bytes) -> Any:
+        s = _text(v)
+        m = pattern.fullmatch(s)
+        if m is not None:
+            try:
+                return build(m)
+            except ValueError:  # e.g. a time of 24:00:00
+                pass
+        return s
+
+    return decode
+
+
+def _parse_text_array(s: str, decode: Decoder) -> List:
+    """Parses a Postgres array literal, such as {1,NULL,"a b"} or {{1,2},{3,4}}."""
+    if s.startswith("["):
+        # Skip explicit dimensions, e.g. "[0:1]={1,2}"
+        s = s[s.index("=") + 1 :]
+    stack: List[List] = []
+    ret: List = []
+    i, n = 0, len(s)
+    while i < n:
+        c = s[i]
+        if c == "{":
+            stack.append([])
+            i += 1
+        elif c == "}":
+            done = stack.pop()
+            if stack:
+                stack[-1].append(done)
+            else:
+                ret = done
+            i += 1
+        elif c == "," or c.isspace():
+            i += 1
+        elif c == '"':
+            i += 1
+            chars = []
+            while s[i] != '"':
+                if s[i] == "\\":
+                    i += 1
+                chars.append(s[i])
+                i += 1
+            stack[-1].append(decode("".join(chars).encode("utf-8")))
+            i += 1
+        else:
+            j = i
+            while j < n and s[j] not in ",}":
+                j += 1
+            token = s[i:j].strip()
+            if token.upper() == "NULL":
+                stack[-1].append(None)
+            else:
+                stack[-1].append(decode(token.encode("utf-8")))
+            i = j
+    return ret
+
+
+# OID -> (text decoder, binary decoder)
+DECODERS: Dict[int, Tuple[Decoder, Decoder]] = {
+    16: (_text_bool, lambda v: v != b"\x00"),
+    17: (_text_bytea, bytes),
+    18: (_text, _text),
+    19: (_text, _text),
+    20: (_text_int, _unpacker(INT8)),
+    21: (_text_int, _unpacker(INT2)),
+    23: (_text_int, _unpacker(INT4)),
+    25: (_text, _text),
+    26: (_text_int, _unpacker(UINT4)),
+    114: (_text, _text),
+    700: (_text_float, _unpacker(FLOAT4)),
+    701: (_text_float, _unpacker(FLOAT8)),
+    1042: (_text, _text),
+    1043: (_text, _text),
+    1082: (_parsed(TEXT_DATE, _text_date), _binary_date),
+    1083: (_parsed(TEXT_TIME, _text_time), _binary_time),
+    1114: (_parsed(TEXT_TIMESTAMP, _text_timestamp), _binary_timestamp),
+    1184: (_parsed(TEXT_TIMESTAMP, _text_timestamp), _binary_timestamptz),
+    1700: (lambda v: decimal.Decimal(_text(v)), _binary_numeric),
+    2950: (lambda v: uuid.UUID(_text(v)), lambda v: uuid.UUID(bytes=bytes(v))),
+    # jsonb is sent as a version byte followed by the JSON text
+    3802: (_text, lambda v: _text(v[1:])),
+}
+
+# Array OID -> element OID
+ARRAY_OIDS = {
+    1000: 16,
+    1001: 17,
+    1002: 18,
+    1003: 19,
+    1005: 21,
+    1007: 23,
+    1009: 25,
+    1014: 1042,
+    1015: 1043,
+    1016: 20,
+    1021: 700,
+    1022: 701,
+    1028: 26,
+    1115: 1114,
+    1182: 1082,
+    1183: 1083,
+    1185: 1184,
+    1231: 1700,
+    199: 114,
+    2951: 2950,
+    3807: 3802,
+}
+
+# The struct codes of the binary types that can be unpacked without conversion
+FIXED_WIDTH = {16: "?", 20: "q", 21: "h", 23: "i", 26: "I", 700: "f", 701: "d"}
+
+
+def _text_unknown(v: bytes):
+    decoded = _text(v)
+    if decoded.startswith("{") and decoded.endswith("}"):
+        return _parse_text_array(decoded, _text)
+    return decoded
+
+
+def _binary_unknown(v: bytes) -> int:
+    return int.from_bytes(v, "big")
+
+
+def text_decoder(oid: int) -> Decoder:
+    if oid in DECODERS:
+        return DECODERS[oid][0]
+    elif oid in ARRAY_OIDS:
+        decode = text_decoder(ARRAY_OIDS[oid])
+        return lambda v: _parse_text_array(_text(v), decode)
+    elif oid in UNKNOWN_OIDS:
+        return _text_unknown
+    return _text
+
+
+def binary_decoder(oid: int) -> Decoder:
+    if oid in DECODERS:
+        return DECODERS[oid][1]
+    elif oid in ARRAY_OIDS:
+        return _binary_array
+    return _binary_unknown
+
+
+class ParamDecoder:
+    """Decodes the parameter values of a Bind message for a list of parameter
+    type OIDs and formats."""
+
+    def __init__(self, oids: Sequence[int], formats: Sequence[int]):
+        self.decoders = [
+            binary_decoder(oid) if fmt else text_decoder(oid)
+            for oid, fmt in zip(oids, formats)
+        ]
+        # When every parameter is a fixed-width binary number, their lengths and
+        # values are unpacked in one call (falling back to one-by-one for NULLs)
+        codes = [FIXED_WIDTH.get(oid) if fmt else None for oid, fmt in zip(oids, formats)]
+        self.fixed = None
+        if codes and all(codes):
+            self.fixed = struct.Struct("!" + "".join("i" + c for c in codes))
+            self.sizes = tuple(struct.calcsize("!" + c) for c in codes)
+
+    def decode(self, data: bytes, offset: int = 0) -> Tuple[List, int]:
+        """Decodes the values that start at the offset in the data, returning them
+        along with the offset just past them."""
+        if self.fixed is not None and len(data) - offset >= self.fixed.size:
+            unpacked = self.fixed.unpack_from(data, offset)
+            if unpacked[0::2] == self.sizes:
+                return list(unpacked[1::2]), offset + self.fixed.size
+        params = []
+        for decode in self.decoders:
+            n = INT4.unpack_from(data, offset)[0]
+            offset += 4
+            if n < 0:
+                params.append(None)
+            else:
+                params.append(decode(data[offset : offset + n]))
+                offset += n
+        return params, offset
+
+
+@functools.lru_cache(maxsize=1024)
+def param_decoder(oids: Tuple[int, ...], formats: Tuple[int, ...]) -> ParamDecoder:
+    return ParamDecoder(oids, formats)
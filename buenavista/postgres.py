@@ -1,20 +1,57 @@
+import asyncio
+import concurrent.futures
+import copy
 import datetime
 import hashlib
 import io
+import itertools
 import json
 import logging
 import os
 import random
+import re
 import socketserver
 import struct
-from typing import Dict, List, Optional
-
-from .core import BVType, Connection, Extension, Session, QueryResult
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from . import pgcopy, pgtypes
+from .core import (
+    BulkLoad,
+    BVType,
+    Connection,
+    Extension,
+    Session,
+    QueryResult,
+    to_pylist,
+)
 from .rewrite import Rewriter
+from .statements import count_parameters, split_statements
+
+try:
+    from . import columnar
+except ImportError:  # numpy/pyarrow are only installed with the duckdb extra
+    columnar = None
 
 logger = logging.getLogger(__name__)
 
 NULL_BYTE = b"\x00"
+NULL_CELL = struct.pack("!i", -1)
+
+# The number of rows encoded at a time into the CopyData messages of a COPY TO
+COPY_CHUNK_ROWS = 65536
+
+# The size of the buffer that coalesces the messages sent to a client
+WRITE_BUFFER_BYTES = 128 * 1024
+
+# The size of the buffer that the messages sent by a client are read into
+READ_BUFFER_BYTES = 64 * 1024
+
+# The type byte and length that start every message after the startup message
+MESSAGE_HEADER = struct.Struct("!BI")
+STARTUP_HEADER = struct.Struct("!II")
+TYPE_CODES = [bytes((i,)) for i in range(256)]
+NUL = re.compile(NULL_BYTE)
 
 
 class ServerResponse:
@@ -25,6 +62,10 @@ class ServerResponse:
     BIND_COMPLETE = b"2"
     CLOSE_COMPLETE = b"3"
     COMMAND_COMPLETE = b"C"
+    COPY_DATA = b"d"
+    COPY_DONE = b"c"
+    COPY_IN_RESPONSE = b"G"
+    COPY_OUT_RESPONSE = b"H"
     DATA_ROW = b"D"
     EMPTY_QUERY_RESPONSE = b"I"
     ERROR_RESPONSE = b"E"
@@ -38,18 +79,38 @@ class ServerResponse:
     ROW_DESCRIPTION = b"T"
 
 
+class QueryCanceled(Exception):
+    """The error reported for a statement that a CancelRequest interrupted."""
+
+    sqlstate = "57014"
+
+    def __init__(self):
+        super().__init__("canceling statement due to user request")
+
+
 class TransactionStatus:
     IDLE = b"I"
     IN_TRANSACTION = b"T"
     IN_FAILED_TRANSACTION = b"E"
 
 
+class StartupCode:
+    """Codes sent in place of a message type by the first message of a connection."""
+
+    PROTOCOL_3 = 196608
+    CANCEL_REQUEST = 80877102
+    SSL_REQUEST = 80877103
+
+
 # Client commands
 class ClientCommand:
     """Byte codes for client commands in the PG wire protocol."""
 
     BIND = b"B"
     CLOSE = b"C"
+    COPY_DATA = b"d"
+    COPY_DONE = b"c"
+    COPY_FAIL = b"f"
     DESCRIBE = b"D"
     EXECUTE = b"E"
     FLUSH = b"H"
@@ -60,6 +121,19 @@ class ClientCommand:
     TERMINATE = b"X"
 
 
+# The messages of the extended query protocol, which may be pipelined: an error
+# in any of them discards the rest of the messages up to the next Sync
+EXTENDED_QUERY_MESSAGES = frozenset(
+    [
+        ClientCommand.BIND,
+        ClientCommand.CLOSE,
+        ClientCommand.DESCRIBE,
+        ClientCommand.EXECUTE,
+        ClientCommand.PARSE,
+    ]
+)
+
+
 def _time_to_microseconds(t):
     # Convert hours, minutes, seconds, and microseconds to microseconds
     hours_to_microseconds = t.hour * 60 * 60 * 1e6
@@ -82,10 +156,25 @@ def _micros_since_2000(dt):
     return int(micros)
 
 
+def _array_to_text(v) -> str:
+    items = []
+    for item in v:
+        if item is None:
+            items.append("NULL")
+        elif isinstance(item, (list, tuple)):
+            items.append(_array_to_text(item))
+        else:
+            item = str(item)
+            if not item or item.upper() == "NULL" or any(c in item for c in '{},"\\ '):
+                item = '"' + item.replace("\\", "\\\\").replace('"', '\\"') + '"'
+            items.append(item)
+    return "{" + ",".join(items) + "}"
+
+
 PG_UNKNOWN = (705, str)
 BVTYPE_TO_PGTYPE = {
     BVType.NULL: (-1, lambda v: None),
-    BVType.ARRAY: (2277, lambda v: "{" + ",".join(v) + "}", None),
+    BVType.ARRAY: (2277, _array_to_text, None),
     BVType.BIGINT: (20, str, lambda r: int.to_bytes(r, 8, "big")),
     BVType.BOOL: (
         16,
@@ -101,13 +190,13 @@ BVTYPE_TO_PGTYPE = {
     BVType.DECIMAL: (1700, str),
     BVType.FLOAT: (701, str, lambda r: struct.pack("!d", r)),
     BVType.INTEGER: (23, str, lambda r: int.to_bytes(r, 4, "big")),
-    BVType.INTEGERARRAY: (1007, lambda v: "{" + ",".join(v) + "}"),
+    BVType.INTEGERARRAY: (1007, _array_to_text),
     BVType.INTERVAL: (
         1186,
         lambda v: f"{v.days} days {v.seconds} seconds {v.microseconds} microseconds",
     ),
     BVType.JSON: (114, lambda v: json.dumps(v)),
-    BVType.STRINGARRAY: (1009, lambda v: "{" + ",".join(v) + "}"),
+    BVType.STRINGARRAY: (1009, _array_to_text),
     BVType.TEXT: (25, str, lambda r: r.encode("utf-8")),
     BVType.TIME: (
         1083,
@@ -122,6 +211,30 @@ BVTYPE_TO_PGTYPE = {
 }
 
 
+def _encode_data_rows(columns: List[Sequence], converters: List) -> bytes:
+    """Encodes a chunk of column values as a contiguous run of DataRow messages."""
+    cells_by_column = []
+    for values, (converter, do_encode) in zip(columns, converters):
+        cells = []
+        for v in to_pylist(values):
+            if v is None:
+                cells.append(NULL_CELL)
+            else:
+                v = converter(v)
+                if do_encode:
+                    v = v.encode("utf-8")
+                cells.append(struct.pack("!i", len(v)) + v)
+        cells_by_column.append(cells)
+    out = []
+    for cells in zip(*cells_by_column):
+        body = b"".join(cells)
+        out.append(
+            struct.pack("!cih", ServerResponse.DATA_ROW, len(body) + 6, len(cells))
+        )
+        out.append(body)
+    return b"".join(out)
+
+
 class BVBuffer(object):
     """A helper for reading and writing bytes in the format the PG wire protocol expects."""
 
@@ -168,6 +281,205 @@ class BVBuffer(object):
         return self.stream.getvalue()
 
 
+def _cstring(payload, offset: int = 0) -> Tuple[str, int]:
+    """Decodes the NUL-terminated string at the offset in a message payload,
+    returning it along with the offset just past its terminator."""
+    end = NUL.search(payload, offset)
+    if end is None:
+        raise Exception("Malformed message: unterminated string")
+    return str(payload[offset : end.start()], "utf-8"), end.end()
+
+
+class MessageReader:
+    """Frames the messages a client sends out of large reads into one reusable buffer.
+
+    Every pipelined message that arrives in a read is framed without reading
+    again, and is returned as a memoryview of its payload in the buffer, which
+    the handlers parse in place with struct.unpack_from and offsets. A payload is
+    only valid until the next message is framed. A message too large for the
+    buffer is read into one of its own.
+
+    Blocking readers fill the buffer with readinto (e.g. a socket's recv_into);
+    the asyncio server feeds it the chunks it reads instead.
+    """
+
+    def __init__(
+        self,
+        readinto: Optional[Callable[[memoryview], int]] = None,
+        size: int = READ_BUFFER_BYTES,
+    ):
+        self.readinto = readinto
+        self.size = size
+        self._reset()
+        # The number of bytes the message being framed needs, counted from start
+        self.need = 0
+
+    def _reset(self):
+        self.buf = bytearray(self.size)
+        self.view = memoryview(self.buf)
+        self.start = self.end = 0
+
+    def frame(self) -> Optional[Tuple[bytes, Optional[memoryview]]]:
+        """Returns the type code and payload of the next message if it has been
+        read in full, and None otherwise."""
+        start = self.start
+        if self.end - start < MESSAGE_HEADER.size:
+            self.need = MESSAGE_HEADER.size
+            return None
+        code, msglen = MESSAGE_HEADER.unpack_from(self.buf, start)
+        end = start + 1 + msglen
+        if end > self.end or msglen < 4:
+            if msglen < 4:
+                raise Exception(f"Invalid message length: {msglen}")
+            self.need = msglen + 1
+            return None
+        self.start = end
+        if msglen == 4:
+            return TYPE_CODES[code], None
+        return TYPE_CODES[code], self.view[start + MESSAGE_HEADER.size : end]
+
+    def frame_startup(self) -> Optional[Tuple[int, memoryview]]:
+        """Returns the code and payload of the next startup (or SSL or cancel)
+        message if it has been read in full, and None otherwise."""
+        start = self.start
+        if self.end - start < STARTUP_HEADER.size:
+            self.need = STARTUP_HEADER.size
+            return None
+        msglen, code = STARTUP_HEADER.unpack_from(self.buf, start)
+        if msglen < STARTUP_HEADER.size:
+            raise Exception(f"Invalid startup message length: {msglen}")
+        self.need = msglen
+        if start + msglen > self.end:
+            return None
+        self.start = start + msglen
+        return code, self.view[start + STARTUP_HEADER.size : self.start]
+
+    def read(self) -> Optional[Tuple[bytes, Optional[memoryview]]]:
+        """Reads the next message, returning None if the client disconnected."""
+        return self._read(self.frame)
+
+    def read_startup(self) -> Optional[Tuple[int, memoryview]]:
+        return self._read(self.frame_startup)
+
+    def _read(self, frame):
+        message = frame()
+        while message is None:
+            n = self.readinto(self._reserve(0))
+            if not n:
+                return None
+            self.end += n
+            message = frame()
+        return message
+
+    def feed(self, data: bytes):
+        """Appends bytes read from the client to the buffer."""
+        self._reserve(len(data))[: len(data)] = data
+        self.end += len(data)
+
+    def _reserve(self, n: int) -> memoryview:
+        # Returns a view of the free space after the buffered bytes, making room
+        # for the rest of the message being framed and for at least n more bytes
+        pending = self.end - self.start
+        if not pending:
+            if len(self.buf) > self.size:
+                # Give up the buffer of a large message once it has been handled
+                self._reset()
+            self.start = self.end = 0
+        need = max(self.need, pending + n, pending + 1)
+        if self.start + need > len(self.buf):
+            if need > len(self.buf):
+                buf = bytearray(need)
+            else:
+                buf = self.buf
+            # A copy, as the pending bytes may overlap where they are moved to
+            buf[:pending] = self.view[self.start : self.end].tobytes()
+            if buf is not self.buf:
+                self.buf, self.view = buf, memoryview(buf)
+            self.start, self.end = 0, pending
+        return self.view[self.end :]
+
+
+class WriteBuffer:
+    """Coalesces the messages written to a client into as few writes as possible.
+
+    Messages are copied into a reusable bytearray, which is written out when it
+    fills up or when flush() is called: once the client is waiting on the server
+    (at ReadyForQuery, or when it sends Flush), or before the connection closes.
+    Messages too large for the buffer are written straight through.
+    """
+
+    def __init__(self, raw, size: int = WRITE_BUFFER_BYTES):
+        self.raw = raw
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.pos = 0
+
+    @property
+    def closed(self) -> bool:
+        return self.raw.closed
+
+    def write(self, data: bytes):
+        end = self.pos + len(data)
+        if end > len(self.buf):
+            self.flush_buffer()
+            if len(data) >= len(self.buf):
+                self.raw.write(data)
+                return
+            end = len(data)
+        self.view[self.pos : end] = data
+        self.pos = end
+
+    def flush_buffer(self):
+        if self.pos:
+            # The raw file is done with the view once write returns
+            self.raw.write(self.view[: self.pos])
+            self.pos = 0
+
+    def flush(self):
+        self.flush_buffer()
+        self.raw.flush()
+
+    def close(self):
+        self.raw.close()
+
+
+class PortalCursor:
+    """A resumable position in the results of a portal, for Execute messages with a
+    row limit that suspend the portal instead of discarding the remaining rows."""
+
+    def __init__(self, query_result: QueryResult):
+        self.query_result = query_result
+        self.batches = iter(query_result.batches())
+        self.pending = None
+        self.exhausted = False
+
+    def fetch(self, limit: int = 0) -> Iterator[List[Sequence]]:
+        """Yields column chunks until the result is exhausted or limit rows are sent."""
+        sent = 0
+        while limit <= 0 or sent < limit:
+            columns = self.pending or next(self.batches, None)
+            self.pending = None
+            if columns is None:
+                self.exhausted = True
+                return
+            num_rows = len(columns[0])
+            if limit > 0 and sent + num_rows > limit:
+                take = limit - sent
+                self.pending = [col[take:] for col in columns]
+                columns = [col[:take] for col in columns]
+                num_rows = take
+            sent += num_rows
+            yield columns
+
+    def detach(self):
+        """Buffers the remaining results in memory, for when another statement is
+        about to run on the session and would invalidate a streaming result."""
+        if self.pending:
+            self.batches = itertools.chain([self.pending], self.batches)
+            self.pending = None
+        self.batches = iter(list(self.batches))
+
+
 class BVContext:
     """Manages the state of a single connection to the server."""
 
@@ -182,9 +494,17 @@ class BVContext:
         self.stmts = {}
         self.portals = {}
         self.result_cache = {}
+        self.descriptions = {}
+        self.cursors = {}
+        self.copy_in: Optional[pgcopy.CopyIn] = None
         self.has_error = False
         self.authenticated = False
         self.salt = None
+        # Whether a message is being handled, and whether a CancelRequest arrived
+        # while it was; guarded by _cancel_lock, as cancels come from other threads
+        self.running = False
+        self.canceled = False
+        self._cancel_lock = threading.Lock()
 
     def get_hashed_password(self, auth: dict) -> str:
         user = self.params["user"]
@@ -195,6 +515,34 @@ class BVContext:
     def mark_error(self):
         self.has_error = True
 
+    def begin(self):
+        with self._cancel_lock:
+            self.running = True
+            self.canceled = False
+
+    def end(self):
+        with self._cancel_lock:
+            self.running = False
+
+    def cancel(self) -> bool:
+        """Interrupts the statement the session is running, if any, returning
+        whether there was one. The connection stays open and usable."""
+        with self._cancel_lock:
+            if not self.running:
+                return False
+            self.canceled = True
+        self.session.interrupt()
+        return True
+
+    def statement_error(self, exception: Exception) -> Exception:
+        """Returns the error to report for a statement that raised the exception,
+        which is the standard one if a CancelRequest interrupted it."""
+        with self._cancel_lock:
+            if self.canceled:
+                self.canceled = False
+                return QueryCanceled()
+        return exception
+
     def transaction_status(self):
         if self.session.in_transaction():
             if self.has_error:
@@ -203,12 +551,36 @@ class BVContext:
                 return TransactionStatus.IN_TRANSACTION
         return TransactionStatus.IDLE
 
-    def execute_sql(self, sql: str, params=None, result_fmt=None) -> QueryResult:
+    def execute_sql(
+        self, sql: str, params=None, result_fmt=None, stmt: Optional[str] = None
+    ) -> QueryResult:
+        # Running a statement on the session ends any results it is still streaming
+        for cursor in self.cursors.values():
+            cursor.detach()
         logger.info("Input SQL: " + sql)
         if self.rewriter:
             sql = self.rewriter.rewrite(sql)
             logger.info("Rewritten SQL: " + sql)
-        qr = self.session.execute_sql(sql, params)
+        if stmt:
+            qr = self.session.execute_prepared(stmt, sql, params)
+        else:
+            qr = self.session.execute_sql(sql, params)
+        return self._with_result_format(qr, result_fmt)
+
+    def split_query(self, sql: str) -> List[str]:
+        """Splits the SQL of a simple query into its statements, which are run one
+        at a time with execute_sql."""
+        if self.rewriter:
+            return self.rewriter.split(sql)
+        return split_statements(sql)
+
+    def bulk_load(self, table: str, columns: Optional[str]) -> BulkLoad:
+        for cursor in self.cursors.values():
+            cursor.detach()
+        logger.info("Bulk load into: " + table)
+        return self.session.bulk_load(table, columns)
+
+    def _with_result_format(self, qr: QueryResult, result_fmt) -> QueryResult:
         if qr.has_results():
             if result_fmt and len(result_fmt) != qr.column_count():
                 qr.result_format = [result_fmt[0]] * qr.column_count()
@@ -216,44 +588,103 @@ class BVContext:
                 qr.result_format = result_fmt
         return qr
 
+    def _describe(self, name: str, params=None) -> Optional[QueryResult]:
+        """Describes the results of a statement without running it, if the session
+        supports it. The result types of a statement may depend on the types of its
+        parameters, so descriptions are kept per statement and parameter types
+        until the statement is closed."""
+        descriptions = self.descriptions.setdefault(name, {})
+        key = tuple(type(p) for p in params) if params else None
+        if key not in descriptions:
+            sql, _ = self.stmts[name]
+            if self.rewriter:
+                sql = self.rewriter.rewrite(sql)
+            for cursor in self.cursors.values():
+                cursor.detach()
+            descriptions[key] = self.session.describe_sql(sql, params)
+        return descriptions[key]
+
+    def portal(self, name: str) -> Tuple[str, Dict[str, str], List[int]]:
+        """The statement, parameters and result formats a portal was bound with."""
+        if name not in self.portals:
+            raise Exception(f"portal \"{name}\" does not exist")
+        return self.portals[name]
+
     def describe_portal(self, name: str) -> QueryResult:
-        stmt, params, result_fmt = self.portals[name]
+        stmt, params, result_fmt = self.portal(name)
+        description = self._describe(stmt, params)
+        if description is not None:
+            return self._with_result_format(copy.copy(description), result_fmt)
         sql, param_oids = self.stmts[stmt]
-        # todo: parse params? LIMIT 0?
-        query_result = self.execute_sql(sql=sql, params=params, result_fmt=result_fmt)
+        query_result = self.execute_sql(sql, params, result_fmt, stmt)
         self.result_cache[name] = query_result
         return query_result
 
     def describe_statement(self, name: str) -> QueryResult:
+        description = self._describe(name)
+        if description is not None:
+            return description
         sql, param_oids = self.stmts[name]
-        # TODO: create default params from param_oids
         return self.execute_sql(sql)
 
+    def param_oids(self, name: str) -> List[int]:
+        """The type OIDs of the parameters of a statement that were given in Parse."""
+        if name not in self.stmts:
+            raise Exception(f"prepared statement \"{name}\" does not exist")
+        return self.stmts[name][1]
+
+    def parameter_types(self, name: str) -> List[int]:
+        """The type OIDs of the parameters of a statement, as given by the client."""
+        sql, param_oids = self.stmts[name]
+        count = max(len(param_oids), count_parameters(sql))
+        oids = list(param_oids) + [0] * (count - len(param_oids))
+        return [oid or PG_UNKNOWN[0] for oid in oids]
+
     def execute_portal(self, name: str) -> QueryResult:
         if name in self.result_cache:
             query_result = self.result_cache[name]
             del self.result_cache[name]
             return query_result
         else:
-            stmt, params, result_fmt = self.portals[name]
+            stmt, params, result_fmt = self.portal(name)
             sql, param_oids = self.stmts[stmt]
             # parse the params?
-            qr = self.execute_sql(sql=sql, params=params, result_fmt=result_fmt)
+            qr = self.execute_sql(sql, params, result_fmt, stmt)
             return qr
 
+    def portal_cursor(self, name: str) -> PortalCursor:
+        """Returns the live cursor for a portal, executing the portal if needed."""
+        cursor = self.cursors.get(name)
+        if cursor is None:
+            cursor = PortalCursor(self.execute_portal(name))
+            self.cursors[name] = cursor
+        return cursor
+
+    def close_cursor(self, name: str):
+        self.cursors.pop(name, None)
+
     def add_statement(self, name: str, sql: str, param_oids: List[int]):
+        if name in self.stmts:
+            self.session.close_prepared(name)
+        self.descriptions.pop(name, None)
         self.stmts[name] = (sql, param_oids)
 
     def close_statement(self, name: str):
-        del self.stmts[name]
+        # Closing a statement or portal that does not exist is not an error
+        if self.stmts.pop(name, None) is not None:
+            self.session.close_prepared(name)
+        self.descriptions.pop(name, None)
 
     def add_portal(
         self, name: str, stmt: str, params: Dict[str, str], result_formats: List[int]
     ):
         self.portals[name] = (stmt, params, result_formats)
+        self.close_cursor(name)
 
     def close_portal(self, name: str):
-        del self.portals[name]
+        self.portals.pop(name, None)
+        self.result_cache.pop(name, None)
+        self.close_cursor(name)
 
     def flush(self):
         pass
@@ -261,84 +692,145 @@ class BVContext:
     def sync(self):
         if self.has_error:
             self.has_error = False
+        # Portals do not outlive the (possibly implicit) transaction they ran in
+        if not self.session.in_transaction():
+            self.portals.clear()
+            self.result_cache.clear()
+            self.cursors.clear()
 
 
 class BuenaVistaHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        # finish() flushes anything still buffered when the connection ends
+        self.wfile = WriteBuffer(self.wfile)
+
     def handle(self):
-        self.r = BVBuffer(self.rfile)
+        # Reads straight from the socket, bypassing the buffering of self.rfile
+        self.r = MessageReader(self.request.recv_into)
         ctx = None
         try:
             ctx = self.handle_startup(self.server.conn)
             if ctx:
-                self.server.ctxts[ctx.process_id] = ctx
+                self.register_context(ctx)
             while ctx:
-                type_code = self.r.read_byte()
-                if not type_code or type_code == ClientCommand.TERMINATE:
+                message = self.r.read()
+                if message is None or message[0] == ClientCommand.TERMINATE:
                     # we're done
                     break
-
-                msglen = self.r.read_uint32()
-                if msglen > 4:
-                    payload = self.r.read_bytes(msglen - 4)
-                else:
-                    payload = None
-
-                if not ctx.authenticated:
-                    if type_code == ClientCommand.PASSWORD_MESSAGE:
-                        self.handle_md5_password(ctx, payload)
-                    else:
-                        raise Exception("Not authenticated")
-                elif type_code == ClientCommand.QUERY:
-                    self.handle_query(ctx, payload)
-                elif type_code == ClientCommand.PARSE:
-                    self.handle_parse(ctx, payload)
-                elif type_code == ClientCommand.BIND:
-                    self.handle_bind(ctx, payload)
-                elif type_code == ClientCommand.DESCRIBE:
-                    self.handle_describe(ctx, payload)
-                elif type_code == ClientCommand.EXECUTE:
-                    self.handle_execute(ctx, payload)
-                elif type_code == ClientCommand.CLOSE:
-                    self.handle_close(ctx, payload)
-                elif type_code == ClientCommand.SYNC:
-                    ctx.sync()
-                    self.send_ready_for_query(ctx)
-                elif type_code == ClientCommand.FLUSH:
-                    ctx.flush()
-                else:
-                    raise Exception("Unknown type_code: %s" % type_code)
+                self.dispatch(ctx, *message)
         except Exception as e:
             logger.exception(e)
             self.send_error(e)
 
         if ctx:
-            self.server.conn.close_session(ctx.session)
-            del self.server.ctxts[ctx.process_id]
+            self.close_context(ctx)
             ctx = None
 
-    def handle_startup(self, conn: Connection) -> BVContext:
-        msglen = self.r.read_uint32() - 4
-        code = self.r.read_uint32()
-        if code == 80877103:  ## SSL request
-            self.send_notice()
-            return self.handle_startup(conn)
-        elif code == 196608:  # Protocol 3.0
-            msg = [
-                x.decode("utf-8")
-                for x in self.r.read_bytes(msglen - 4).split(NULL_BYTE)
-            ]
+    def dispatch(
+        self, ctx: BVContext, type_code: bytes, payload: Optional[memoryview]
+    ):
+        # A CancelRequest only interrupts a statement while a message is handled
+        ctx.begin()
+        try:
+            self.handle_message(ctx, type_code, payload)
+        finally:
+            ctx.end()
+
+    def handle_message(
+        self, ctx: BVContext, type_code: bytes, payload: Optional[memoryview]
+    ):
+        if not ctx.authenticated:
+            if type_code == ClientCommand.PASSWORD_MESSAGE:
+                self.handle_md5_password(ctx, payload)
+            else:
+                raise Exception("Not authenticated")
+        elif type_code == ClientCommand.SYNC:
+            ctx.sync()
+            self.send_ready_for_query(ctx)
+        elif type_code == ClientCommand.FLUSH:
+            ctx.flush()
+            self.wfile.flush()
+        elif ctx.has_error:
+            logger.debug("Discarding %s until Sync after an error", type_code)
+        elif type_code in EXTENDED_QUERY_MESSAGES:
+            try:
+                self.handle_extended_query(ctx, type_code, payload)
+            except Exception as e:
+                logger.exception(e)
+                self.send_error(ctx.statement_error(e), ctx)
+        elif type_code == ClientCommand.QUERY:
+            self.handle_query(ctx, payload)
+        elif type_code == ClientCommand.COPY_DATA:
+            self.handle_copy_data(ctx, payload)
+        elif type_code == ClientCommand.COPY_DONE:
+            self.handle_copy_done(ctx)
+        elif type_code == ClientCommand.COPY_FAIL:
+            self.handle_copy_fail(ctx, payload)
+        else:
+            raise Exception("Unknown type_code: %s" % type_code)
+
+    def handle_extended_query(
+        self, ctx: BVContext, type_code: bytes, payload: Optional[memoryview]
+    ):
+        # Nothing is sent for these until a Sync or Flush arrives, so a client can
+        # pipeline any number of them in a single round trip
+        if type_code == ClientCommand.PARSE:
+            self.handle_parse(ctx, payload)
+        elif type_code == ClientCommand.BIND:
+            self.handle_bind(ctx, payload)
+        elif type_code == ClientCommand.DESCRIBE:
+            self.handle_describe(ctx, payload)
+        elif type_code == ClientCommand.EXECUTE:
+            self.handle_execute(ctx, payload)
+        elif type_code == ClientCommand.CLOSE:
+            self.handle_close(ctx, payload)
+
+    def register_context(self, ctx: BVContext):
+        with self.server.ctxts_lock:
+            self.server.ctxts[ctx.process_id] = ctx
+
+    def close_context(self, ctx: BVContext):
+        if ctx.copy_in is not None:
+            # The client went away in the middle of a COPY FROM STDIN
+            copy_in, ctx.copy_in = ctx.copy_in, None
+            try:
+                copy_in.abort()
+            except Exception as e:
+                logger.warning("Failed to abort COPY: %s", e)
+        self.server.conn.close_session(ctx.session)
+        with self.server.ctxts_lock:
+            self.server.ctxts.pop(ctx.process_id, None)
+
+    def handle_startup(self, conn: Connection) -> Optional[BVContext]:
+        while True:
+            startup = self.r.read_startup()
+            if startup is None:
+                return None
+            code, payload = startup
+            if code == StartupCode.SSL_REQUEST:
+                self.send_notice()
+                continue
+            return self.process_startup(conn, code, payload)
+
+    def process_startup(
+        self, conn: Connection, code: int, payload: memoryview
+    ) -> Optional[BVContext]:
+        if code == StartupCode.PROTOCOL_3:
+            msg = str(payload, "utf-8").rstrip("\x00").split("\x00")
             params = dict(zip(msg[::2], msg[1::2]))
             logger.info("Client connection params: %s", params)
             ctx = BVContext(conn.create_session(), self.server.rewriter, params)
             self.send_auth_request(ctx)
             return ctx
-        elif code == 80877102:  ## Cancel request
-            process_id, secret_key = self.r.read_uint32(), self.r.read_uint32()
-            ctx = self.server.ctxts.get(process_id)
+        elif code == StartupCode.CANCEL_REQUEST:
+            process_id, secret_key = struct.unpack_from("!II", payload)
+            with self.server.ctxts_lock:
+                ctx = self.server.ctxts.get(process_id)
             if ctx and ctx.secret_key == secret_key:
-                self.server.conn.close_session(ctx.session)
-                del self.server.ctxts[ctx.process_id]
-                ctx = None
+                # The running statement fails with a QueryCanceled error
+                if ctx.cancel():
+                    logger.info("Canceled the running statement of %d", process_id)
             return None
         else:
             raise Exception(f"Unsupported startup message: {code}")
@@ -361,15 +853,17 @@ class BuenaVistaHandler(socketserver.StreamRequestHandler):
             struct.pack("!cii", ServerResponse.AUTHENTICATION_REQUEST, 12, 5)
         )
         self.wfile.write(ctx.salt)
+        self.wfile.flush()
 
-    def handle_md5_password(self, ctx: BVContext, payload: bytes):
-        client_side = payload.decode("utf-8").rstrip("\x00")
+    def handle_md5_password(self, ctx: BVContext, payload: memoryview):
+        client_side = str(payload, "utf-8").rstrip("\x00")
         server_side = ctx.get_hashed_password(self.server.auth)
         if client_side == server_side:
             self.send_authentication_ok()
             self.handle_post_auth(ctx)
         else:
             self.send_error("Invalid password")
+            self.wfile.flush()
 
     def handle_post_auth(self, ctx: BVContext):
         self.send_parameter_status(self.server.conn.parameters())
@@ -378,9 +872,9 @@ class BuenaVistaHandler(socketserver.StreamRequestHandler):
         ctx.authenticated = True
         return
 
-    def handle_query(self, ctx: BVContext, payload: bytes):
+    def handle_query(self, ctx: BVContext, payload: memoryview):
         logger.debug("Handle query")
-        decoded = payload.decode("utf-8").rstrip("\x00")
+        decoded = str(payload, "utf-8").rstrip("\x00")
         try:
             # JSON payloads signal that we should use extensions
             if req := Extension.check_json(decoded):
@@ -390,15 +884,33 @@ class BuenaVistaHandler(socketserver.StreamRequestHandler):
                     raise Exception("Unknown method: " + str(method))
                 else:
                     query_result = extension.apply(req.get("params"), ctx.session)
+                    self.send_query_result(query_result, decoded)
             else:
-                query_result = ctx.execute_sql(decoded)
+                stmts = ctx.split_query(decoded)
+                if not stmts:
+                    self.send_empty_query()
+                # Each statement runs once the results of the one before it are
+                # sent, and an error skips the rest of them
+                for i, sql in enumerate(stmts):
+                    if copy_stmt := pgcopy.parse_copy(sql):
+                        if copy_stmt.direction == "from":
+                            if i < len(stmts) - 1:
+                                raise Exception(
+                                    "COPY FROM STDIN must be the last statement of a query"
+                                )
+                            # Ready for query is sent once the client is done sending data
+                            self.handle_copy_in(ctx, copy_stmt)
+                            return
+                        self.handle_copy_out(ctx, copy_stmt)
+                    else:
+                        self.send_query_result(ctx.execute_sql(sql), sql)
         except Exception as e:
-            self.send_error(e)
-            self.send_ready_for_query(ctx)
-            return
+            self.send_error(ctx.statement_error(e))
+        self.send_ready_for_query(ctx)
 
+    def send_query_result(self, query_result: QueryResult, sql: str):
         if not query_result:
-            raise Exception("No query result for query: " + decoded)
+            raise Exception("No query result for query: " + sql)
         elif query_result.has_results():
             self.send_row_description(query_result)
             row_count = self.send_data_rows(query_result)
@@ -406,124 +918,173 @@ class BuenaVistaHandler(socketserver.StreamRequestHandler):
         else:
             status = query_result.status()
             self.send_command_complete(f"{status}\x00")
+
+    def handle_copy_out(self, ctx: BVContext, copy_stmt: pgcopy.CopyStatement):
+        query_result = ctx.execute_sql(copy_stmt.select_sql())
+        if not query_result or not query_result.has_results():
+            raise Exception("COPY query must return rows")
+        row_count = self.send_copy_out(query_result, copy_stmt)
+        self.send_command_complete(f"COPY {row_count}\x00")
+
+    def handle_copy_in(self, ctx: BVContext, copy_stmt: pgcopy.CopyStatement):
+        if copy_stmt.table is None:
+            raise Exception("COPY FROM STDIN requires a table")
+        elif columnar is None:
+            raise Exception("COPY FROM STDIN requires pyarrow")
+        loader = ctx.bulk_load(copy_stmt.table, copy_stmt.columns)
+        oids = [BVTYPE_TO_PGTYPE.get(t, PG_UNKNOWN)[0] for _, t in loader.columns()]
+        decoder = columnar.copy_decoder(copy_stmt, oids)
+        ctx.copy_in = pgcopy.CopyIn(copy_stmt, loader, decoder)
+        fmt = 1 if copy_stmt.binary else 0
+        self.wfile.write(
+            struct.pack(
+                f"!cibh{len(oids)}h",
+                ServerResponse.COPY_IN_RESPONSE,
+                7 + 2 * len(oids),
+                fmt,
+                len(oids),
+                *([fmt] * len(oids)),
+            )
+        )
+        # The client waits for CopyInResponse before it sends any data
+        self.wfile.flush()
+
+    def handle_copy_data(self, ctx: BVContext, payload: Optional[memoryview]):
+        # Data that arrives after a failed COPY is ignored
+        if ctx.copy_in is None or not payload:
+            return
+        try:
+            ctx.copy_in.feed(payload)
+        except Exception as e:
+            self.end_copy_in(ctx, ctx.statement_error(e))
+
+    def handle_copy_done(self, ctx: BVContext):
+        if ctx.copy_in is None:
+            return
+        try:
+            row_count = ctx.copy_in.finish()
+        except Exception as e:
+            self.end_copy_in(ctx, ctx.statement_error(e))
+            return
+        ctx.copy_in = None
+        self.send_command_complete(f"COPY {row_count}\x00")
+        self.send_ready_for_query(ctx)
+
+    def handle_copy_fail(self, ctx: BVContext, payload: Optional[memoryview]):
+        if ctx.copy_in is None:
+            return
+        message = str(payload or b"", "utf-8").rstrip("\x00")
+        self.end_copy_in(ctx, Exception(f"COPY from stdin failed: {message}"))
+
+    def end_copy_in(self, ctx: BVContext, exception: Exception):
+        try:
+            ctx.copy_in.abort()
+        except Exception as e:
+            logger.warning("Could not abort COPY: %s", e)
+        ctx.copy_in = None
+        self.send_error(exception)
         self.send_ready_for_query(ctx)
 
-    def handle_parse(self, ctx: BVContext, payload: bytes):
+    def handle_parse(self, ctx: BVContext, payload: memoryview):
         logger.debug("Handling parse")
-        ba = bytearray(payload)
-        stmt_idx = ba.index(NULL_BYTE)
-        stmt = ba[:stmt_idx].decode("utf-8")
-        query_idx = ba.index(NULL_BYTE, stmt_idx + 1)
-        sql = ba[stmt_idx + 1 : query_idx].decode("utf-8")
+        stmt, offset = _cstring(payload)
+        sql, offset = _cstring(payload, offset)
         logger.debug("Parsed statement: %s", sql)
-        buf = BVBuffer(io.BytesIO(ba[query_idx + 1 :]))
-        num_params = buf.read_int16()
-        param_oids = []
-        for i in range(num_params):
-            param_oids.append(buf.read_int32())
+        num_params = struct.unpack_from("!h", payload, offset)[0]
+        param_oids = list(struct.unpack_from(f"!{num_params}i", payload, offset + 2))
         ctx.add_statement(stmt, sql, param_oids)
         self.send_parse_complete()
 
-    def handle_bind(self, ctx: BVContext, payload: bytes):
+    def handle_bind(self, ctx: BVContext, payload: memoryview):
         logger.debug("Handling bind")
-        ba = bytearray(payload)
-        portal_idx = ba.index(NULL_BYTE)
-        portal = ba[:portal_idx].decode("utf-8")
-        stmt_idx = ba.index(NULL_BYTE, portal_idx + 1)
-        stmt = ba[portal_idx + 1 : stmt_idx].decode("utf-8")
-        buf = BVBuffer(io.BytesIO(ba[stmt_idx + 1 :]))
+        portal, offset = _cstring(payload)
+        stmt, offset = _cstring(payload, offset)
         # First param format stuff...
-        num_formats = buf.read_int16()
-        formats = []
-        for i in range(num_formats):
-            formats.append(buf.read_int16())
+        num_formats = struct.unpack_from("!h", payload, offset)[0]
+        formats = struct.unpack_from(f"!{num_formats}h", payload, offset + 2)
+        offset += 2 + 2 * num_formats
         # ... then the actual param values
-        num_params = buf.read_int16()
+        num_params = struct.unpack_from("!h", payload, offset)[0]
+        offset += 2
         if num_formats < num_params:
-            if formats:
-                formats = [formats[0]] * num_params
-            else:
-                formats = [0] * num_params
-        params = []
-        for i in range(num_params):
-            nb = buf.read_int32()
-            v = buf.read_bytes(nb)
-            if formats[i] == 0:
-                decoded = v.decode("utf-8")
-                if decoded.startswith("{") and decoded.endswith("}"):
-                    params.append(decoded[1:-1].split(","))
-                else:
-                    params.append(decoded)
-            else:
-                # TODO: I shouldn't be always assuming these are always
-                # ints but I can live with it for now
-                params.append(int.from_bytes(v, "big"))
+            formats = (formats[0] if formats else 0,) * num_params
+        try:
+            oids = ctx.param_oids(stmt)
+        except Exception as e:
+            self.send_error(e, ctx)
+            return
+        oids = tuple(oids[:num_params]) + (0,) * (num_params - len(oids))
+        decoder = pgtypes.param_decoder(oids, tuple(formats[:num_params]))
+        params, offset = decoder.decode(payload, offset)
         logger.debug("Bind params: %s", params)
         # now expected result formats
-        num_result_formats = buf.read_int16()
-        result_formats = []
-        for i in range(num_result_formats):
-            result_formats.append(buf.read_int16())
+        num_result_formats = struct.unpack_from("!h", payload, offset)[0]
+        result_formats = list(
+            struct.unpack_from(f"!{num_result_formats}h", payload, offset + 2)
+        )
         ctx.add_portal(portal, stmt, params, result_formats)
         self.send_bind_complete()
 
-    def handle_describe(self, ctx: BVContext, payload: bytes):
+    def handle_describe(self, ctx: BVContext, payload: memoryview):
         logger.debug("Handling describe")
-        ba = bytearray(payload)
-        describe_type = ba[0]
+        describe_type = payload[0]
         query_result = None
         if describe_type == ord("P"):
-            portal = ba[1 : len(ba) - 1].decode("utf-8")
+            portal = _cstring(payload, 1)[0]
             try:
                 query_result = ctx.describe_portal(portal)
             except Exception as e:
-                self.send_error(e, ctx)
+                self.send_error(ctx.statement_error(e), ctx)
                 return
         elif describe_type == ord("S"):
-            stmt = ba[1 : len(ba) - 1].decode("utf-8")
+            stmt = _cstring(payload, 1)[0]
             try:
                 query_result = ctx.describe_statement(stmt)
+                param_types = ctx.parameter_types(stmt)
             except Exception as e:
                 self.send_error(e, ctx)
                 return
+            self.send_parameter_description(param_types)
         else:
             raise Exception(f"Unknown describe type: {describe_type}")
         if query_result.has_results():
             self.send_row_description(query_result)
+        else:
+            self.send_no_data()
 
-    def handle_execute(self, ctx: BVContext, payload: bytes):
+    def handle_execute(self, ctx: BVContext, payload: memoryview):
         logger.debug("Handling execute")
-        if ctx.has_error:
-            logger.info("Skipping execute due to previous error")
-            return
-        ba = bytearray(payload)
-        portal_idx = ba.index(NULL_BYTE)
-        portal = ba[:portal_idx].decode("utf-8")
-        limit = struct.unpack("!i", ba[portal_idx + 1 : portal_idx + 5])[0]
-        query_result = None
+        portal, offset = _cstring(payload)
+        limit = struct.unpack_from("!i", payload, offset)[0]
         try:
-            query_result = ctx.execute_portal(portal)
+            cursor = ctx.portal_cursor(portal)
+            query_result = cursor.query_result
+            if query_result.has_results():
+                row_count = self.send_data_rows(query_result, limit, cursor)
         except Exception as e:
-            self.send_error(e, ctx)
+            self.send_error(ctx.statement_error(e), ctx)
+            ctx.close_cursor(portal)
             return
         if query_result.has_results():
-            row_count = self.send_data_rows(query_result, limit)
+            if limit > 0 and not cursor.exhausted:
+                self.send_portal_suspended()
+                return
             self.send_command_complete("SELECT %d\x00" % row_count)
         else:
             status = query_result.status()
             self.send_command_complete(f"{status}\x00")
+        ctx.close_cursor(portal)
 
-    def handle_close(self, ctx: BVContext, payload: bytes):
+    def handle_close(self, ctx: BVContext, payload: memoryview):
         logger.debug("Handling close")
         close_type = payload[0]
         if close_type == ord("S"):
-            ctx.close_statement(payload[1:-1].decode("utf-8"))
+            ctx.close_statement(_cstring(payload, 1)[0])
         elif close_type == ord("P"):
-            ctx.close_portal(payload[1:-1].decode("utf-8"))
+            ctx.close_portal(_cstring(payload, 1)[0])
         else:
             raise Exception(f"Unknown close type: {close_type}")
         self.send_close_complete()
-        self.send_ready_for_query(ctx)
 
     def send_row_description(self, query_result: QueryResult):
         buf = BVBuffer()
@@ -542,46 +1103,114 @@ class BuenaVistaHandler(socketserver.StreamRequestHandler):
         )
         self.wfile.write(sig + out)
 
-    def send_data_rows(self, query_result: QueryResult, limit: int = 0) -> int:
-        cnt = 0
-        converters = []
+    def send_data_rows(
+        self,
+        query_result: QueryResult,
+        limit: int = 0,
+        cursor: Optional[PortalCursor] = None,
+    ) -> int:
+        bvtypes, formats, converters = [], [], []
         for i in range(query_result.column_count()):
             bvtype = query_result.column(i)[1]
             pgtype = BVTYPE_TO_PGTYPE.get(bvtype, PG_UNKNOWN)
+            bvtypes.append(bvtype)
             if not query_result.result_format or query_result.result_format[i] == 0:
+                formats.append(0)
                 converters.append((pgtype[1], True))
             else:
+                formats.append(query_result.result_format[i])
                 converters.append((pgtype[2], False))
-        for row in query_result.rows():
-            buf = BVBuffer()
-            for j in range(query_result.column_count()):
-                r = row[j]
-                if r is None:
-                    buf.write_int32(-1)
-                else:
-                    converter, do_encode = converters[j]
-                    v = converter(r)
-                    if do_encode:
-                        v = v.encode("utf-8")
-                    buf.write_int32(len(v))
-                    buf.write_bytes(v)
-            out = buf.get_value()
-            row_sig = struct.pack(
-                "!cih",
-                ServerResponse.DATA_ROW,
-                len(out) + 6,
-                query_result.column_count(),
+        if cursor is None:
+            cursor = PortalCursor(query_result)
+        cnt = 0
+        for columns in cursor.fetch(limit):
+            if columnar and columnar.is_arrow(columns):
+                out = columnar.encode_data_rows(columns, bvtypes, formats, converters)
+            else:
+                out = _encode_data_rows(columns, converters)
+            if out:
+                self.wfile.write(out)
+            cnt += len(columns[0])
+        return cnt
+
+    def send_copy_out(
+        self, query_result: QueryResult, copy_stmt: pgcopy.CopyStatement
+    ) -> int:
+        """Streams the results of a query as the CopyData messages of a COPY ... TO
+        STDOUT, encoding them COPY_CHUNK_ROWS rows at a time."""
+        names, bvtypes, converters = [], [], []
+        for i in range(query_result.column_count()):
+            name, bvtype = query_result.column(i)
+            pgtype = BVTYPE_TO_PGTYPE.get(bvtype, PG_UNKNOWN)
+            if copy_stmt.binary and (len(pgtype) < 3 or pgtype[2] is None):
+                raise Exception(f"COPY BINARY does not support the type of {name}")
+            names.append(name)
+            bvtypes.append(bvtype)
+            converters.append(pgtype[2] if copy_stmt.binary else pgtype[1])
+
+        fmt = 1 if copy_stmt.binary else 0
+        self.wfile.write(
+            struct.pack(
+                f"!cibh{len(names)}h",
+                ServerResponse.COPY_OUT_RESPONSE,
+                7 + 2 * len(names),
+                fmt,
+                len(names),
+                *([fmt] * len(names)),
             )
-            self.wfile.write(row_sig + out)
-            cnt += 1
-            if limit > 0 and cnt >= limit:
-                break
+        )
+        if copy_stmt.csv and copy_stmt.header:
+            self.wfile.write(pgcopy.encode_header(names, copy_stmt))
+
+        # Every row is sent in its own CopyData message, as Postgres does, with
+        # the header of the binary format in front of the first one
+        header_pending = copy_stmt.binary
+        cnt = 0
+        for columns in query_result.batches():
+            num_rows = len(columns[0]) if columns else 0
+            for lo in range(0, num_rows, COPY_CHUNK_ROWS):
+                chunk = [col[lo : lo + COPY_CHUNK_ROWS] for col in columns]
+                if not columnar or not columnar.is_arrow(chunk):
+                    if copy_stmt.binary:
+                        out = pgcopy.encode_binary_tuples(chunk, converters)
+                    else:
+                        out = pgcopy.encode_text_rows(chunk, converters, copy_stmt)
+                elif copy_stmt.binary:
+                    fallbacks = [(c, False) for c in converters]
+                    out = columnar.encode_copy_tuples(chunk, bvtypes, fallbacks)
+                else:
+                    out = columnar.encode_copy_text(
+                        chunk, bvtypes, converters, copy_stmt
+                    )
+                if header_pending and out:
+                    out = pgcopy.with_binary_header(out)
+                    header_pending = False
+                if out:
+                    self.wfile.write(out)
+            cnt += num_rows
+
+        if copy_stmt.binary:
+            trailer = pgcopy.BINARY_TRAILER
+            if header_pending:
+                trailer = pgcopy.BINARY_HEADER + trailer
+            self.send_copy_data(trailer)
+        self.wfile.write(struct.pack("!ci", ServerResponse.COPY_DONE, 4))
         return cnt
 
+    def send_copy_data(self, data: bytes):
+        sig = struct.pack("!ci", ServerResponse.COPY_DATA, len(data) + 4)
+        self.wfile.write(sig + data)
+
     def send_error(self, exception, ctx: Optional[BVContext] = None):
         estr = str(exception)
         logger.error(estr)
         buf = BVBuffer()
+        buf.write_byte(b"S")
+        buf.write_string("ERROR")
+        # Errors that know their SQLSTATE (like QueryCanceled, or those of psycopg)
+        if sqlstate := getattr(exception, "sqlstate", None):
+            buf.write_byte(b"C")
+            buf.write_string(sqlstate)
         buf.write_byte(b"M")
         buf.write_string(estr)
         buf.write_byte(NULL_BYTE)
@@ -593,6 +1222,7 @@ class BuenaVistaHandler(socketserver.StreamRequestHandler):
 
     def send_notice(self):
         self.wfile.write(ServerResponse.NOTICE_RESPONSE)
+        self.wfile.flush()
 
     def send_backend_key_data(self, ctx):
         self.wfile.write(
@@ -609,6 +1239,7 @@ class BuenaVistaHandler(socketserver.StreamRequestHandler):
         logger.debug("Sending ready for query")
         status = ctx.transaction_status() if ctx else TransactionStatus.IDLE
         self.wfile.write(struct.pack("!cic", ServerResponse.READY_FOR_QUERY, 5, status))
+        self.wfile.flush()
 
     def send_parameter_status(self, params: Dict[str, str]):
         for name, value in params.items():
@@ -619,23 +1250,34 @@ class BuenaVistaHandler(socketserver.StreamRequestHandler):
             psig = struct.pack("!ci", ServerResponse.PARAMETER_STATUS, len(out) + 4)
             self.wfile.write(psig + out)
 
+    def send_parameter_description(self, oids: List[int]):
+        out = struct.pack(f"!h{len(oids)}i", len(oids), *oids)
+        self.wfile.write(
+            struct.pack("!ci", ServerResponse.PARAMETER_DESCRIPTION, len(out) + 4) + out
+        )
+
+    def send_no_data(self):
+        self.wfile.write(struct.pack("!ci", ServerResponse.NO_DATA, 4))
+
+    def send_empty_query(self):
+        self.wfile.write(struct.pack("!ci", ServerResponse.EMPTY_QUERY_RESPONSE, 4))
+
     def send_parse_complete(self):
         self.wfile.write(struct.pack("!ci", ServerResponse.PARSE_COMPLETE, 4))
 
     def send_bind_complete(self):
         self.wfile.write(struct.pack("!ci", ServerResponse.BIND_COMPLETE, 4))
 
+    def send_portal_suspended(self):
+        self.wfile.write(struct.pack("!ci", ServerResponse.PORTAL_SUSPENDED, 4))
+
     def send_close_complete(self):
         self.wfile.write(struct.pack("!ci", ServerResponse.CLOSE_COMPLETE, 4))
 
     def send_command_complete(self, tag: str):
-        buf = BVBuffer()
-        buf.write_bytes(
-            struct.pack("!ci", ServerResponse.COMMAND_COMPLETE, len(tag) + 4)
-        )
-        buf.write_bytes(tag.encode())
-        out = buf.get_value()
-        self.wfile.write(out)
+        tag = tag.encode()
+        sig = struct.pack("!ci", ServerResponse.COMMAND_COMPLETE, len(tag) + 4)
+        self.wfile.write(sig + tag)
 
 
 class BuenaVistaServer(socketserver.ThreadingTCPServer):
@@ -657,8 +1299,180 @@ class BuenaVistaServer(socketserver.ThreadingTCPServer):
         self.rewriter = rewriter
         self.extensions = {e.type(): e for e in extensions}
         self.ctxts = {}
+        self.ctxts_lock = threading.Lock()
+        self.auth = auth
+
+    def verify_request(self, request, client_address) -> bool:
+        """Ensure all requests come from localhost until auth is in place"""
+        return _is_local(client_address) or "PG_HOST" in os.environ
+
+
+def _is_local(client_address) -> bool:
+    return client_address[0] in ("127.0.0.1", "::1")
+
+
+class AsyncStreamFile:
+    """A write-only file that forwards the bytes written by a handler running in a
+    worker thread to an asyncio StreamWriter owned by the event loop."""
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        writer: asyncio.StreamWriter,
+        drain_threshold: int = 256 * 1024,
+    ):
+        self.loop = loop
+        self.writer = writer
+        self.drain_threshold = drain_threshold
+        self.pending = 0
+
+    def write(self, data: bytes):
+        # Must not be called from the event loop thread itself. The data is written
+        # later, on the loop, so a view of a buffer that is about to be reused is
+        # copied first
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        self.loop.call_soon_threadsafe(self.writer.write, data)
+        self.pending += len(data)
+        if self.pending >= self.drain_threshold:
+            self.pending = 0
+            asyncio.run_coroutine_threadsafe(self.writer.drain(), self.loop).result()
+
+    def flush(self):
+        pass
+
+
+class AsyncBuenaVistaHandler(BuenaVistaHandler):
+    """Runs the BuenaVistaHandler protocol state machine over asyncio streams.
+
+    Messages are read on the event loop, so an idle connection does not hold a
+    thread; each message is then dispatched to the server's bounded executor."""
+
+    def __init__(
+        self,
+        server: "AsyncBuenaVistaServer",
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ):
+        # Deliberately skips BaseRequestHandler.__init__, which serves a blocking socket
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.client_address = writer.get_extra_info("peername")
+        self.wfile = WriteBuffer(AsyncStreamFile(server.loop, writer))
+        self.r = MessageReader()
+
+    async def run(self, func, *args):
+        return await self.server.loop.run_in_executor(self.server.executor, func, *args)
+
+    async def read_async(self, frame):
+        # Every message already buffered is framed before reading again
+        message = frame()
+        while message is None:
+            data = await self.reader.read(READ_BUFFER_BYTES)
+            if not data:
+                return None
+            self.r.feed(data)
+            message = frame()
+        return message
+
+    async def handle_async(self):
+        ctx = None
+        try:
+            ctx = await self.handle_startup_async(self.server.conn)
+            if ctx:
+                self.register_context(ctx)
+            while ctx:
+                message = await self.read_async(self.r.frame)
+                if message is None or message[0] == ClientCommand.TERMINATE:
+                    break
+                await self.run(self.dispatch, ctx, *message)
+                await self.writer.drain()
+        except ConnectionError as e:
+            logger.info("Client connection closed: %s", e)
+        except Exception as e:
+            logger.exception(e)
+            await self.run(self.send_error, e)
+            await self.run(self.wfile.flush)
+
+        if ctx:
+            await self.run(self.close_context, ctx)
+            ctx = None
+        self.writer.close()
+
+    async def handle_startup_async(self, conn: Connection) -> Optional[BVContext]:
+        while True:
+            startup = await self.read_async(self.r.frame_startup)
+            if startup is None:
+                return None
+            code, payload = startup
+            if code == StartupCode.SSL_REQUEST:
+                await self.run(self.send_notice)
+                continue
+            if code == StartupCode.CANCEL_REQUEST:
+                # Never queue a cancel behind the queries it is meant to stop
+                return self.process_startup(conn, code, payload)
+            return await self.run(self.process_startup, conn, code, payload)
+
+
+class AsyncBuenaVistaServer:
+    """An asyncio-based alternative to BuenaVistaServer.
+
+    Connections are served by a single event loop and the protocol messages they
+    send are executed on a bounded pool of worker threads, so thousands of mostly
+    idle client connections can share a small number of threads."""
+
+    def __init__(
+        self,
+        server_address,
+        conn: Connection,
+        *,
+        rewriter: Optional[Rewriter] = None,
+        extensions: List[Extension] = [],
+        auth: Optional[Dict[str, str]] = None,
+        max_workers: Optional[int] = None,
+    ):
+        self.server_address = server_address
+        self.conn = conn
+        self.rewriter = rewriter
+        self.extensions = {e.type(): e for e in extensions}
+        self.ctxts = {}
+        self.ctxts_lock = threading.Lock()
         self.auth = auth
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="buenavista"
+        )
+        self.loop = None
+        self._server = None
+        self._stopped = None
 
     def verify_request(self, request, client_address) -> bool:
         """Ensure all requests come from localhost until auth is in place"""
-        return client_address[0] == "127.0.0.1" or "PG_HOST" in os.environ
+        return _is_local(client_address) or "PG_HOST" in os.environ
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        if not self.verify_request(None, writer.get_extra_info("peername")):
+            writer.close()
+            return
+        await AsyncBuenaVistaHandler(self, reader, writer).handle_async()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        host, port = self.server_address
+        self._server = await asyncio.start_server(self.handle_connection, host, port)
+        self.server_address = self._server.sockets[0].getsockname()[:2]
+        try:
+            async with self._server:
+                await self._stopped.wait()
+        finally:
+            self.executor.shutdown(wait=False)
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    def shutdown(self):
+        if self.loop and self._stopped:
+            self.loop.call_soon_threadsafe(self._stopped.set)
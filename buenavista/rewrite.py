@@ -1,25 +1,47 @@
-from typing import Any, Callable, Dict, TypeVar
+import functools
+import re
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar, Union
 
 import sqlglot
 import sqlglot.expressions as exp
+from sqlglot.errors import TokenError
+
+from .cache import LRUCache
+from .statements import split_tokens
 
 DecoratedCallable = TypeVar("DecoratedCallable", bound=Callable[..., Any])
 
 
 class Rewriter:
-    def __init__(self, read: sqlglot.Dialect, write: sqlglot.Dialect):
+    def __init__(
+        self, read: sqlglot.Dialect, write: sqlglot.Dialect, cache_size: int = 1024
+    ):
         self._relations = {}
         self._read = read
         self._write = write
+        # Rewrites of recently seen SQL text; the dialects are fixed per instance
+        self._cache = LRUCache(maxsize=cache_size)
 
     def relation(self, name: str) -> Callable[[DecoratedCallable], DecoratedCallable]:
         def decorator(func: DecoratedCallable) -> DecoratedCallable:
             self._relations[name] = func
+            self._cache.clear()
             return func
 
         return decorator
 
+    def clear_cache(self):
+        self._cache.clear()
+
     def rewrite(self, sql: str) -> str:
+        ret = self._cache.get(sql)
+        if ret is None:
+            ret = self._rewrite(sql)
+            self._cache.put(sql, ret)
+        return ret
+
+    def _rewrite(self, sql: str) -> str:
         try:
             stmts = self._read.parse(sql)
             ret = []
@@ -30,6 +52,30 @@ class Rewriter:
             # TODO: log this
             return sql
 
+    def split(self, sql: str) -> List[str]:
+        """Splits SQL into the text of its statements, in order.
+
+        The SQL is tokenized once, and each statement is parsed and rewritten from
+        its own tokens as it is split off, so that rewrite() of each statement is
+        a cache hit rather than a second parse."""
+        if ";" not in sql:
+            return [sql] if sql.strip() else []
+        try:
+            tokens = self._read.tokenize(sql)
+        except TokenError:
+            return [sql]
+        ret = []
+        for text, chunk in split_tokens(sql, tokens):
+            if self._cache.get(text) is None:
+                try:
+                    stmt = self._read.parser().parse(chunk, sql)[0]
+                    rewritten = self._write.generate(self.rewrite_one(stmt))
+                except:
+                    rewritten = text
+                self._cache.put(text, rewritten)
+            ret.append(text)
+        return ret
+
     def rewrite_one(self, expression: exp.Expression) -> exp.Expression:
         def _expand(node: exp.Expression):
             if isinstance(node, exp.Table):
@@ -46,6 +92,175 @@ class Rewriter:
         return expression.transform(_expand, copy=True)
 
 
+# The characters that stand for themselves at the start of a regex (unlike ".")
+_PLAIN = re.compile(r"[\w\s:;,'\"=<>!@#%&~`-]")
+# The escapes, character classes, parentheses and bars of a regex
+_ATOM = re.compile(r"\\.|\[\^?\]?[^\]]*\]|[()|]", re.S)
+# The quantifiers that make what they follow optional
+_OPTIONAL = ("?", "*", "{")
+# The non-ASCII letters that match ASCII letters when case is ignored
+_ASCII_FOLDS = "\u0130\u0131\u017f\u212a"
+
+
+def _group_end(pattern: str) -> Optional[int]:
+    """The index of the parenthesis that closes the group the regex starts with, or
+    None if the regex is an alternation at its top level."""
+    depth = 0
+    for m in _ATOM.finditer(pattern):
+        c = m.group()
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if depth == 0:
+                return m.start()
+        elif c == "|" and depth <= 1:
+            return None
+    return len(pattern)
+
+
+def _first_chars(pattern: str, flags: int) -> Optional[str]:
+    """The contents of a character class that holds every character a match of the
+    regex can start with, or None if that is not obvious from the regex."""
+    if flags & re.VERBOSE or _group_end("(" + pattern + ")") is None:
+        # Whitespace is insignificant, or the regex is an alternation
+        return None
+    elif pattern[:1] == "(" and pattern[1:2] != "?":
+        # A capturing group starts with what its contents start with
+        end = _group_end(pattern)
+        if end is None or end == len(pattern) or pattern[end + 1 : end + 2] in _OPTIONAL:
+            return None
+        return _first_chars(pattern[1:end], flags)
+    elif pattern[:2] in (r"\A", r"\b", r"\B"):
+        # Assertions match before the first character
+        return _first_chars(pattern[2:], flags)
+    elif pattern[:2] in (r"\s", r"\w", r"\d"):
+        first, rest = pattern[:2], pattern[2:]
+    elif pattern[:1] == "\\" and pattern[1:2] and not pattern[1].isalnum():
+        # An escaped symbol; other escapes are classes or special characters
+        first, rest = re.escape(pattern[1]), pattern[2:]
+    elif _PLAIN.match(pattern):
+        first, rest = re.escape(pattern[0]), pattern[1:]
+    else:
+        return None
+    if rest[:1] in _OPTIONAL:
+        return None
+    elif flags & re.IGNORECASE and first.isalpha():
+        if not first.isascii():
+            return None
+        # The other case, and the non-ASCII letters that match ASCII ones
+        first += first.swapcase() + "".join(
+            c for c in _ASCII_FOLDS if re.match(first, c, re.IGNORECASE)
+        )
+    return first
+
+
+class TextRules:
+    """A registry of rules that rewrite the text of SQL statements.
+
+    Each rule has a trigger, a literal string or a regex, and a replacement for the
+    text it matches. The triggers of all the rules are compiled into one
+    alternation regex, so a statement is scanned once however many rules there
+    are, and every rule that matches anywhere in it is applied. Where the triggers
+    of two rules match at the same position, the rule registered first wins.
+    Statement rules, which replace a whole statement, are checked first, and no
+    other rule applies to a statement they replace. The number of times each
+    rule was applied is kept for profiling.
+
+    Regex triggers must not use backreferences, as the groups of every rule are
+    numbered together in the combined regex.
+    """
+
+    def __init__(self):
+        # (name, pattern, replacement function, whether it replaces a statement)
+        self._rules: List[Tuple[str, re.Pattern, Callable[[re.Match], str], bool]] = []
+        self._hits: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._matchers: Optional[Tuple[re.Pattern, re.Pattern]] = None
+
+    def literal(self, name: str, text: str, replacement: str, ignore_case=False):
+        """Replaces every occurrence of the text."""
+        flags = re.IGNORECASE if ignore_case else 0
+        self._add(name, re.escape(text), lambda m: replacement, flags)
+
+    def regex(
+        self,
+        name: str,
+        pattern: str,
+        replacement: Union[str, Callable[[re.Match], str]],
+        flags: int = 0,
+    ):
+        """Replaces every match of the pattern with a template that may refer to its
+        groups (as in re.sub), or with what a function of the match returns."""
+        if isinstance(replacement, str):
+            template = replacement
+            replacement = lambda m: m.expand(template)
+        self._add(name, pattern, replacement, flags)
+
+    def statement(self, name: str, sql: str, replacement: str):
+        """Replaces a statement that is exactly the given SQL."""
+        self._add(name, re.escape(sql) + r"\Z", lambda m: replacement, 0, True)
+
+    def prefix(self, name: str, prefix: str, replacement: str):
+        """Replaces any statement that starts with the prefix."""
+        self._add(name, re.escape(prefix) + r".*", lambda m: replacement, re.S, True)
+
+    def _add(self, name: str, pattern: str, replace, flags: int, whole=False):
+        with self._lock:
+            if name in self._hits:
+                raise ValueError(f"Duplicate rewrite rule: {name}")
+            self._rules.append((name, re.compile(pattern, flags), replace, whole))
+            self._hits[name] = 0
+            self._matchers = None
+
+    def _compile(self) -> Tuple[re.Pattern, re.Pattern]:
+        statements, scanned, firsts = [], [], []
+        for i, (_, pattern, _, whole) in enumerate(self._rules):
+            flags = "".join(
+                c for f, c in ((re.I, "i"), (re.M, "m"), (re.S, "s")) if pattern.flags & f
+            )
+            scoped = f"(?{flags}:{pattern.pattern})" if flags else pattern.pattern
+            # Each rule is a named group, so the match says which rule it was
+            (statements if whole else scanned).append(f"(?P<r{i}>{scoped})")
+            if not whole:
+                firsts.append(_first_chars(pattern.pattern, pattern.flags))
+        # Positions that no rule can match at are skipped with a single check
+        guard = f"(?=[{''.join(dict.fromkeys(firsts))}])" if scanned and all(firsts) else ""
+        scanner = guard + "(?:" + "|".join(scanned or [r"(?!)"]) + ")"
+        self._matchers = (re.compile("|".join(statements or [r"(?!)"])), re.compile(scanner))
+        return self._matchers
+
+    def apply(self, sql: str) -> str:
+        """Applies every rule that matches the SQL, in a single pass over it."""
+        statements, scanner = self._matchers or self._compile()
+        hits: List[str] = []
+        match = statements.match(sql)
+        if match:
+            sql = self._replace(hits, match)
+        else:
+            sql = scanner.sub(functools.partial(self._replace, hits), sql)
+        if hits:
+            # The counts are only locked once per statement that a rule applies to
+            with self._lock:
+                for name in hits:
+                    self._hits[name] += 1
+        return sql
+
+    def _replace(self, hits: List[str], match: re.Match) -> str:
+        # The group of a rule encloses those of its pattern, so it is the last
+        # group to close
+        name, pattern, replace, _ = self._rules[int(match.lastgroup[1:])]
+        hits.append(name)
+        # Rematch with the rule's own pattern, so that its groups are numbered
+        # the way its replacement expects
+        return replace(pattern.match(match.string, match.start()))
+
+    def stats(self) -> Dict[str, int]:
+        """The number of times each rule was applied."""
+        with self._lock:
+            return dict(self._hits)
+
+
 if __name__ == "__main__":
     rewriter = Rewriter(sqlglot.dialects.Presto(), sqlglot.dialects.DuckDB())
 
@@ -0,0 +1,213 @@
+"""Classifies and splits SQL statements from their keyword tokens.
+
+Statements are tokenized (not parsed) so that words inside string literals,
+quoted identifiers and comments are never mistaken for keywords (or for the
+semicolons between statements), and only the keywords at the top level of the
+first statement are inspected.
+"""
+import enum
+import re
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+from sqlglot.errors import TokenError
+from sqlglot.tokens import Token, Tokenizer, TokenType
+
+
+class StatementKind(enum.Enum):
+    QUERY = "query"
+    DML = "dml"
+    DDL = "ddl"
+    TRANSACTION = "transaction"
+    UTILITY = "utility"
+
+
+class Statement(NamedTuple):
+    kind: StatementKind
+    # The command as it appears in a CommandComplete tag, e.g. "CREATE TABLE"
+    command: str
+    # Whether the statement returns rows, or None if that is only known once it runs
+    returns_rows: Optional[bool]
+
+    def tag(self, rowcount: int = 0) -> str:
+        """The CommandComplete tag for the statement."""
+        if self.command == "INSERT":
+            return f"INSERT 0 {rowcount}"
+        elif self.kind == StatementKind.DML or self.command == "SELECT":
+            return f"{self.command} {rowcount}"
+        return self.command
+
+
+QUERY_COMMANDS = {
+    "SELECT",
+    "VALUES",
+    "FROM",
+    "TABLE",
+    "SHOW",
+    "DESCRIBE",
+    "DESC",
+    "SUMMARIZE",
+    "EXPLAIN",
+    "PIVOT",
+    "UNPIVOT",
+}
+DML_COMMANDS = {"INSERT", "UPDATE", "DELETE", "MERGE", "COPY"}
+DDL_COMMANDS = {"CREATE", "DROP", "ALTER", "TRUNCATE", "COMMENT"}
+TRANSACTION_COMMANDS = {
+    "BEGIN": "BEGIN",
+    "START": "BEGIN",
+    "COMMIT": "COMMIT",
+    "END": "COMMIT",
+    "ROLLBACK": "ROLLBACK",
+    "ABORT": "ROLLBACK",
+}
+# Utility statements that never return rows; whether any other statement (e.g.
+# EXECUTE, CALL or PRAGMA) does is only known once it runs
+UTILITY_COMMANDS = {
+    "SET",
+    "RESET",
+    "USE",
+    "PREPARE",
+    "DEALLOCATE",
+    "LOAD",
+    "INSTALL",
+    "ATTACH",
+    "DETACH",
+    "CHECKPOINT",
+    "FORCE",
+    "VACUUM",
+    "ANALYZE",
+    "EXPORT",
+    "IMPORT",
+    "DISCARD",
+    "GRANT",
+    "REVOKE",
+    "LISTEN",
+    "UNLISTEN",
+    "NOTIFY",
+}
+
+# Modifiers that may precede the object type in CREATE statements
+CREATE_MODIFIERS = {"OR", "REPLACE", "TEMP", "TEMPORARY", "PERSISTENT", "UNIQUE"}
+
+_QUOTED = (TokenType.STRING, TokenType.IDENTIFIER)
+_FIRST_WORD = re.compile(r"\w+")
+_NUMBERED_PARAMETER = re.compile(r"^\$(\d+)$")
+
+
+def _keywords(sql: str) -> List[str]:
+    """The uppercased top-level words of the first statement in the SQL."""
+    ret = []
+    depth = 0
+    # Leading parens, e.g. in "(SELECT 1) UNION ...", set the top level
+    top = None
+    for token in Tokenizer().tokenize(sql):
+        if token.token_type == TokenType.L_PAREN:
+            depth += 1
+        elif token.token_type == TokenType.R_PAREN:
+            depth -= 1
+        elif token.token_type == TokenType.SEMICOLON:
+            if ret:
+                break
+        elif top is None or depth == top:
+            top = depth
+            ret.append("" if token.token_type in _QUOTED else token.text.upper())
+    return ret
+
+
+def classify(sql: str) -> Statement:
+    try:
+        words = _keywords(sql)
+    except TokenError:
+        match = _FIRST_WORD.search(sql)
+        words = [match.group(0).upper()] if match else []
+    if not words:
+        return Statement(StatementKind.UTILITY, "", False)
+
+    first = words[0]
+    if first == "WITH":
+        # The statement kind is determined by what follows the CTEs
+        first = next(
+            (w for w in words[1:] if w in QUERY_COMMANDS or w in DML_COMMANDS),
+            "SELECT",
+        )
+
+    if first in QUERY_COMMANDS:
+        return Statement(StatementKind.QUERY, "SELECT", True)
+    elif first in DML_COMMANDS:
+        return Statement(StatementKind.DML, first, "RETURNING" in words)
+    elif first in DDL_COMMANDS:
+        objects = [w for w in words[1:] if w not in CREATE_MODIFIERS]
+        command = f"{first} {objects[0]}" if objects and objects[0] else first
+        return Statement(StatementKind.DDL, command, False)
+    elif first in TRANSACTION_COMMANDS:
+        return Statement(StatementKind.TRANSACTION, TRANSACTION_COMMANDS[first], False)
+    elif first in UTILITY_COMMANDS:
+        return Statement(StatementKind.UTILITY, first, False)
+    return Statement(StatementKind.UTILITY, first, None)
+
+
+def count_parameters(sql: str) -> int:
+    """The number of parameters ($1, $2, ... or ?) that the SQL expects."""
+    try:
+        tokens = Tokenizer().tokenize(sql)
+    except TokenError:
+        return 0
+    numbered, placeholders = 0, 0
+    for token in tokens:
+        if token.token_type == TokenType.PLACEHOLDER:
+            placeholders += 1
+        elif token.token_type == TokenType.VAR:
+            match = _NUMBERED_PARAMETER.match(token.text)
+            if match:
+                numbered = max(numbered, int(match.group(1)))
+    return max(numbered, placeholders)
+
+
+def replace_parameters(sql: str, values: Sequence[str]) -> str:
+    """Replaces the parameters ($1, $2, ... or ?) of the SQL with the SQL text of
+    their values, the first parameter's being values[0]."""
+    tokens = Tokenizer().tokenize(sql)
+    parts, start, placeholders = [], 0, 0
+    for token in tokens:
+        if token.token_type == TokenType.PLACEHOLDER:
+            index = placeholders
+            placeholders += 1
+        elif token.token_type == TokenType.VAR:
+            match = _NUMBERED_PARAMETER.match(token.text)
+            if not match:
+                continue
+            index = int(match.group(1)) - 1
+        else:
+            continue
+        parts += [sql[start : token.start], values[index]]
+        start = token.end + 1
+    parts.append(sql[start:])
+    return "".join(parts)
+
+
+def split_tokens(sql: str, tokens: List[Token]) -> List[Tuple[str, List[Token]]]:
+    """Splits the tokens of the SQL at the semicolons between its statements,
+    returning the text and the tokens of each statement that is not empty."""
+    ret = []
+    chunk = []
+    for token in tokens + [None]:
+        if token is None or token.token_type == TokenType.SEMICOLON:
+            if chunk:
+                # From the first token, skipping any comments before it
+                end = len(sql) if token is None else token.start
+                ret.append((sql[chunk[0].start : end].strip(), chunk))
+            chunk = []
+        else:
+            chunk.append(token)
+    return ret
+
+
+def split_statements(sql: str) -> List[str]:
+    """The text of each of the statements in the SQL, in order."""
+    if ";" not in sql:
+        return [sql] if sql.strip() else []
+    try:
+        tokens = Tokenizer().tokenize(sql)
+    except TokenError:
+        return [sql]
+    return [text for text, _ in split_tokens(sql, tokens)]
@@ -33,7 +33,8 @@ setup(
         "psycopg_pool"
     ],
     extras_require={
-        "duckdb": ["duckdb==0.10.0", "pyarrow"],
-        "postgres": ["psycopg", "psycopg-pool"],
+        "duckdb": ["duckdb==0.10.0", "numpy", "pyarrow"],
+        "postgres": ["psycopg", "psycopg-pool", "numpy", "pandas", "pyarrow"],
+        "http": ["orjson"],
     },
 )
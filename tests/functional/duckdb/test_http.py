@@ -1,12 +1,15 @@
+import threading
+import time
+
 import pytest
 
 import duckdb
 from fastapi import FastAPI
 from fastapi.testclient import TestClient
 
-from buenavista.backends.duckdb import DuckDBConnection
+from buenavista.backends.duckdb import DuckDBConnection, DuckDBSession
 from buenavista.examples.duckdb_http import rewriter
-from buenavista.http import main
+from buenavista.http import context, main
 
 
 @pytest.fixture(scope="session")
@@ -21,6 +24,18 @@ def client(db):
     return TestClient(app)
 
 
+@pytest.fixture
+def queries():
+    return context.QueryRegistry(page_rows=3)
+
+
+@pytest.fixture
+def paged_client(db, queries):
+    app = FastAPI()
+    main.quacko(app, DuckDBConnection(db), rewriter, queries=queries)
+    return TestClient(app)
+
+
 def test_info(client):
     response = client.get("/v1/info")
     assert response.status_code == 200
@@ -33,3 +48,138 @@ def test_select(client):
         headers={"Content-Type": "application/json", "x-trino-user": "test"},
     )
     assert response.status_code == 200
+
+
+def test_sessions(client):
+    client.post(
+        "/v1/statement",
+        json="SELECT 1",
+        headers={"Content-Type": "application/json", "x-trino-user": "stats"},
+    )
+    response = client.get("/v1/sessions")
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["in_use"] == 0
+    assert stats["sessions"] >= 1
+
+
+def test_results_are_paged(paged_client):
+    response = paged_client.post("/v1/statement", content="SELECT * FROM range(7)")
+    result = response.json()
+    assert result["columns"][0]["name"] == "range"
+    pages = [result["data"]]
+    while next_uri := result.get("nextUri"):
+        assert result["stats"]["state"] == "RUNNING"
+        last_uri = next_uri
+        result = paged_client.get(next_uri).json()
+        pages.append(result["data"])
+    assert pages == [[[0], [1], [2]], [[3], [4], [5]], [[6]]]
+    assert result["stats"]["state"] == "FINISHED"
+    assert result["stats"]["processedRows"] == 7
+
+    # A retried request gets the same page, but the query is done with its session
+    assert paged_client.get(last_uri).json()["data"] == [[6]]
+    assert paged_client.get(last_uri[:-1] + "1").status_code == 410
+    assert paged_client.get("/v1/sessions").json()["in_use"] == 0
+
+
+def test_small_results_finish_in_one_response(paged_client):
+    result = paged_client.post("/v1/statement", content="SELECT 1 AS x").json()
+    assert result["data"] == [[1]]
+    assert result["nextUri"] is None
+    assert result["stats"]["state"] == "FINISHED"
+
+
+def test_cancel(paged_client, queries):
+    result = paged_client.post("/v1/statement", content="SELECT * FROM range(7)").json()
+    assert paged_client.get("/v1/sessions").json()["in_use"] == 1
+    assert paged_client.delete(result["nextUri"]).status_code == 204
+    assert paged_client.get("/v1/sessions").json()["in_use"] == 0
+    error = paged_client.get(result["nextUri"]).json()["error"]
+    assert error["errorName"] == "USER_CANCELED"
+    assert queries.get(result["id"]).state == context.CANCELED
+
+
+def test_abandoned_queries_are_canceled(paged_client, queries):
+    result = paged_client.post("/v1/statement", content="SELECT * FROM range(7)").json()
+    queries.abandon_timeout = 0
+    assert queries.reap() == 1
+    assert queries.get(result["id"]) is None
+    assert paged_client.get("/v1/sessions").json()["in_use"] == 0
+    assert paged_client.get(result["nextUri"]).status_code == 410
+
+
+def test_use_is_skipped_when_session_is_on_target(db, monkeypatch):
+    db.execute("CREATE SCHEMA IF NOT EXISTS http_target")
+    app = FastAPI()
+    main.quacko(app, DuckDBConnection(db), rewriter)
+    client = TestClient(app)
+    executed = []
+    execute_sql = DuckDBSession.execute_sql
+
+    def record(self, sql, params=None):
+        executed.append(sql)
+        return execute_sql(self, sql, params)
+
+    monkeypatch.setattr(DuckDBSession, "execute_sql", record)
+    headers = {"x-trino-user": "use", "x-trino-schema": "http_target"}
+
+    def schema():
+        sql = "SELECT current_schema()"
+        return client.post("/v1/statement", content=sql, headers=headers).json()
+
+    assert schema()["data"] == [["http_target"]]
+    assert schema()["data"] == [["http_target"]]
+    assert executed.count("USE http_target") == 1
+
+    # The client switching schemas itself means the next request has to switch back
+    client.post("/v1/statement", content="USE main", headers=headers)
+    assert schema()["data"] == [["http_target"]]
+    assert executed.count("USE http_target") == 2
+
+
+def test_timeout_interrupts_query(db):
+    app = FastAPI()
+    main.quacko(app, DuckDBConnection(db), rewriter, timeout=0.2)
+    client = TestClient(app)
+    headers = {"x-trino-user": "slow"}
+    sql = "SELECT count(*) FROM range(1000000000000)"
+    result = client.post("/v1/statement", content=sql, headers=headers).json()
+    assert result["error"]["errorName"] == "EXCEEDED_TIME_LIMIT"
+    assert result["stats"]["state"] == "FAILED"
+    assert client.get("/v1/sessions").json()["in_use"] == 0
+
+    # The session can still run queries
+    result = client.post("/v1/statement", content="SELECT 1", headers=headers).json()
+    assert result["data"] == [[1]]
+
+
+def test_concurrency_follows_duckdb_threads(db):
+    conn = DuckDBConnection(db)
+    threads = db.execute("SELECT current_setting('threads')").fetchone()[0]
+    assert conn.concurrency() == threads
+
+
+def test_delete_interrupts_running_statement(db, queries):
+    app = FastAPI()
+    main.quacko(app, DuckDBConnection(db), rewriter, queries=queries)
+    client = TestClient(app)
+    headers = {"x-trino-user": "cancel"}
+    sql = "SELECT count(*) FROM range(1000000000000)"
+    results = []
+    post = threading.Thread(
+        target=lambda: results.append(
+            client.post("/v1/statement", content=sql, headers=headers).json()
+        )
+    )
+    post.start()
+    while not queries.queries:
+        time.sleep(0.01)
+    time.sleep(0.2)
+    query_id = next(iter(queries.queries))
+    assert client.delete(f"/v1/statement/executing/{query_id}/0").status_code == 204
+    post.join(10)
+    error = results[0]["error"]
+    assert (error["errorName"], error["sqlState"]) == ("USER_CANCELED", "57014")
+    assert queries.get(query_id).state == context.CANCELED
+    assert client.get("/v1/sessions").json()["in_use"] == 0
@@ -0,0 +1,258 @@
+import duckdb
+import pyarrow as pa
+import pytest
+
+from buenavista.backends.duckdb import DuckDBConnection, ResultCache
+from buenavista.core import BVType
+
+
+@pytest.fixture
+def conn():
+    db = duckdb.connect()
+    db.execute("CREATE TABLE t AS SELECT range AS x FROM range(5)")
+    return DuckDBConnection(db, ResultCache(maxbytes=1 << 20))
+
+
+def _rows(qr):
+    return list(qr.rows())
+
+
+def _fetch(session, sql, params=None):
+    return _rows(session.execute_sql(sql, params))
+
+
+def test_repeated_queries_are_cached(conn):
+    s1, s2 = conn.new_session(), conn.new_session()
+    assert _fetch(s1, "SELECT sum(x) FROM t") == [[10]]
+    assert _fetch(s2, "SELECT sum(x) FROM t") == [[10]]
+    assert conn.result_cache.stats()["hits"] == 1
+    assert _fetch(s1, "SELECT x FROM t WHERE x > ?", [2]) == [[3], [4]]
+    assert _fetch(s1, "SELECT x FROM t WHERE x > ?", [3]) == [[4]]
+    assert conn.result_cache.stats()["hits"] == 1
+
+
+def test_writes_invalidate_the_cache(conn):
+    s1, s2 = conn.new_session(), conn.new_session()
+    assert _fetch(s1, "SELECT count(*) FROM t") == [[5]]
+    s2.execute_sql("INSERT INTO t VALUES (5)")
+    assert _fetch(s1, "SELECT count(*) FROM t") == [[6]]
+    s2.execute_sql("DROP TABLE t")
+    with pytest.raises(duckdb.CatalogException):
+        s1.execute_sql("SELECT count(*) FROM t")
+
+
+class WriteAfterQuery:
+    """Runs a write in another session once the cursor's next query has read its
+    rows, and before they are returned."""
+
+    def __init__(self, cursor, write):
+        self.cursor = cursor
+        self.write = write
+
+    def fetch_record_batch(self, *args):
+        table = self.cursor.fetch_record_batch(*args).read_all()
+        write, self.write = self.write, lambda: None
+        write()
+        return table.to_reader()
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def test_writes_during_a_query_invalidate_its_result(conn):
+    s1, s2 = conn.new_session(), conn.new_session()
+    s1._cursor = WriteAfterQuery(
+        s1._cursor, lambda: s2.execute_sql("INSERT INTO t VALUES (5)")
+    )
+    assert _fetch(s1, "SELECT count(*) FROM t") == [[5]]
+    assert _fetch(s1, "SELECT count(*) FROM t") == [[6]]
+
+
+def test_uncacheable_statements(conn):
+    s = conn.new_session()
+    _fetch(s, "SELECT random() FROM t")
+    s.execute_sql("BEGIN")
+    _fetch(s, "SELECT x FROM t")
+    s.execute_sql("COMMIT")
+    assert conn.result_cache.stats()["entries"] == 0
+
+
+def test_partially_read_results_are_not_cached(conn):
+    s = conn.new_session()
+    qr = s.execute_sql("SELECT x FROM t")
+    next(qr.rows())
+    _fetch(s, "SELECT 1")
+    assert _fetch(s, "SELECT x FROM t") == [[0], [1], [2], [3], [4]]
+    assert conn.result_cache.stats()["hits"] == 0
+
+
+def test_cache_key_includes_search_path(conn):
+    s = conn.new_session()
+    s.execute_sql("CREATE SCHEMA other")
+    s.execute_sql("CREATE TABLE other.t AS SELECT 42 AS x")
+    assert _fetch(s, "SELECT x FROM t LIMIT 1") == [[0]]
+    s.execute_sql("SET search_path = 'other'")
+    assert _fetch(s, "SELECT x FROM t LIMIT 1") == [[42]]
+
+
+def test_statement_cache_is_shared(conn):
+    s1, s2 = conn.new_session(), conn.new_session()
+    _fetch(s1, "SELECT x FROM t")
+    _fetch(s2, "SELECT x FROM t")
+    assert conn.statement_cache.stats()["hits"] == 1
+    sql, stmt = s2.prepare_sql("SET search_path = 'main'")
+    assert sql == "SET search_path = 'main'"
+    assert stmt.command == "SET"
+
+
+def test_prepared_statements():
+    db = duckdb.connect()
+    db.execute("CREATE TABLE t AS SELECT range AS x FROM range(5)")
+    s = DuckDBConnection(db).new_session()
+    sql = "SELECT x FROM t WHERE x > $1"
+    assert _rows(s.execute_prepared("S_1", sql, [2])) == [[3], [4]]
+    parsed = s.prepared.get("S_1")[3]
+    assert parsed is not None
+    assert _rows(s.execute_prepared("S_1", sql, [3])) == [[4]]
+    assert s.prepared.get("S_1")[3] is parsed
+    qr = s.execute_prepared("S_2", "INSERT INTO t VALUES ($1)", [5])
+    assert qr.status() == "INSERT 0 1"
+    # Reusing a name with different SQL replaces the statement
+    assert _rows(s.execute_prepared("S_1", "SELECT count(*) FROM t", None)) == [[6]]
+    s.close_prepared("S_1")
+    assert "S_1" not in s.prepared
+
+
+def test_row_returning_statements(conn):
+    s = conn.new_session()
+    s.execute_sql("CREATE TABLE p AS SELECT 1 AS a, 'x' AS b")
+    assert _fetch(s, "PIVOT p ON b USING sum(a)") == [[1]]
+    assert not s.execute_sql("SET threads = 2").has_results()
+
+
+def test_describe_sql(conn):
+    s = conn.new_session()
+    qr = s.describe_sql("SELECT x, $1::VARCHAR AS y FROM t WHERE x > $2")
+    assert [qr.column(i)[0] for i in range(qr.column_count())] == ["x", "y"]
+    assert list(qr.rows()) == []
+    assert s.describe_sql("INSERT INTO t VALUES ($1)").status() == "INSERT 0 0"
+    assert s.describe_sql("PRAGMA version") is None
+
+
+def test_describe_sql_does_not_run_the_query(conn):
+    calls = []
+
+    def bump(x):
+        calls.append(x)
+        return x
+
+    conn.db.create_function("bump", bump, ["BIGINT"], "BIGINT", side_effects=True)
+    s = conn.new_session()
+    sql = "SELECT bump(x) AS b, $1 AS y FROM t WHERE x > $2"
+    qr = s.describe_sql(sql, ["a", 1])
+    assert qr.column(0)[0] == "b" and qr.column(1) == ("y", BVType.TEXT)
+    assert list(qr.rows()) == [] and calls == []
+    assert _fetch(s, sql, ["a", 1]) == [[2, "a"], [3, "a"], [4, "a"]]
+    assert calls == [2, 3, 4]
+
+
+def test_pooled_sessions_are_reset(conn):
+    s = conn.create_session()
+    s.execute_sql("BEGIN")
+    s.execute_sql("INSERT INTO t VALUES (5)")
+    s.execute_prepared("S_1", "SELECT 1")
+    conn.close_session(s)
+    assert conn.create_session() is s
+    assert not s.in_transaction()
+    assert "S_1" not in s.prepared
+    assert _fetch(s, "SELECT count(*) FROM t") == [[5]]
+    # Session settings can't be reset, so the session is closed instead
+    s.execute_sql("SET search_path = 'main'")
+    conn.close_session(s)
+    assert conn.create_session() is not s
+
+
+def test_pooled_sessions_roll_back_bulk_loads(conn):
+    s = conn.create_session()
+    s.bulk_load("t").append(pa.table({"x": [5]}))
+    conn.close_session(s)
+    assert conn.create_session() is s
+    s.execute_sql("BEGIN")
+    s.execute_sql("INSERT INTO t VALUES (6)")
+    s.execute_sql("COMMIT")
+    assert _fetch(s, "SELECT x FROM t WHERE x >= 5") == [[6]]
+
+
+# The rewrites of the Postgres SQL that clients send, as the if/elif chain they
+# replaced made them
+REWRITES = [
+    ("SELECT 1", "SELECT 1"),
+    ("SET threads = 4", "SET threads = 4"),
+    ("SET enable_seqscan = off", ""),
+    ("SHOW search_path", "SELECT current_setting('search_path') as search_path"),
+    (
+        "SHOW TRANSACTION ISOLATION LEVEL",
+        "SELECT 'read committed' as transaction_isolation",
+    ),
+    ("BEGIN READ ONLY", "BEGIN"),
+    (
+        "SELECT setting FROM pg_catalog.pg_settings WHERE name='max_index_keys'",
+        "SELECT 32 as setting",
+    ),
+    ("PREPARE q FROM SELECT 1", "PREPARE q AS SELECT 1"),
+    ("SELECT 'foo'::regclass", "SELECT 'foo'::string"),
+    ("SELECT 'foo'::REGCLASS", "SELECT 'foo'::string"),
+    ("SELECT CAST('foo' AS REGCLASS)", "SELECT CAST('foo' AS STRING)"),
+    ("SELECT typname::regtype FROM t", "SELECT typname FROM t"),
+    ("SELECT proname::regproc FROM t", "SELECT proname FROM t"),
+    (
+        "SELECT pg_get_expr(ad.adbin, ad.adrelid, true) FROM pg_attrdef ad",
+        "SELECT pg_get_expr(ad.adbin, ad.adrelid) FROM pg_attrdef ad",
+    ),
+    ("SELECT pg_catalog.current_schemas(true)", "SELECT current_schemas(true)"),
+    ("SELECT pg_catalog.CURRENT_SCHEMAS(false)", "SELECT CURRENT_SCHEMAS(false)"),
+    (
+        "SELECT * FROM pg_catalog.generate_series(1, 3)",
+        "SELECT * FROM generate_series(1, 3)",
+    ),
+    (
+        "SELECT * FROM generate_series(1, array_upper(current_schemas(false), 1)) s",
+        "SELECT * FROM generate_series(1, "
+        "json_array_length(current_schemas(false))::BIGINT)  s",
+    ),
+    (
+        "SELECT * FROM generate_series(1, ARRAY_UPPER (x, 1))",
+        "SELECT * FROM generate_series(1, json_array_length(x, 1))",
+    ),
+    ("SELECT * FROM t WHERE a LIKE b", "SELECT * FROM t WHERE a LIKE ' '"),
+    (
+        'SELECT c.relname, pg_catalog.PG_GET_USERBYID(c.relowner) AS "Owner" '
+        "FROM pg_catalog.pg_class c",
+        "SELECT c.relname, 'NA' as Owner FROM pg_catalog.pg_class c",
+    ),
+    (
+        'SELECT d.datname AS "Name", pg_catalog.PG_GET_USERBYID(d.datdba) AS "Owner"'
+        "\nFROM pg_catalog.pg_database d\nORDER BY 1;",
+        'SELECT d.datname AS "Name", \'NA\' AS "Owner", \'UTF-8\' AS "Encoding", \n'
+        '            \'en_US.utf8\' AS "Collate", \'en_US.utf8\' AS "Ctype", '
+        '\'\' AS "Access privileges" FROM pg_catalog.pg_database\n'
+        "             AS d ORDER BY 1",
+    ),
+    # Unlike the chain, which stopped at the first rewrite that applied, every
+    # rule that matches is applied
+    (
+        "SELECT typname::regtype, proname::regproc FROM t",
+        "SELECT typname, proname FROM t",
+    ),
+]
+
+
+@pytest.mark.parametrize("sql, rewritten", REWRITES)
+def test_rewrite_sql(conn, sql, rewritten):
+    assert conn.new_session().rewrite_sql(sql) == rewritten
+
+
+def test_sessions_share_settings(conn):
+    s1, s2 = conn.new_session(), conn.new_session()
+    assert s1.config_params is s2.config_params
+    assert "search_path" in s1.config_params
@@ -2,8 +2,8 @@ import pytest
 from typing import Dict
 from unittest.mock import MagicMock
 
-from buenavista.core import Session
-from buenavista.postgres import BVContext, TransactionStatus
+from buenavista.core import QueryResult, Session
+from buenavista.postgres import BVContext, PortalCursor, TransactionStatus
 
 
 @pytest.fixture
@@ -27,6 +27,7 @@ def test_bv_context_init(bv_context, mock_session):
     assert bv_context.stmts == {}
     assert bv_context.portals == {}
     assert bv_context.result_cache == {}
+    assert bv_context.cursors == {}
     assert bv_context.has_error is False
 
 
@@ -79,3 +80,64 @@ def test_bv_context_sync(bv_context):
     bv_context.mark_error()
     bv_context.sync()
     assert bv_context.has_error is False
+
+
+def test_portal_cursor_resumes_after_limit():
+    qr = MagicMock(spec=QueryResult)
+    qr.batches.return_value = iter([[[1, 2, 3], ["a", "b", "c"]], [[4], ["d"]]])
+    cursor = PortalCursor(qr)
+    assert list(cursor.fetch(2)) == [[[1, 2], ["a", "b"]]]
+    assert not cursor.exhausted
+    assert list(cursor.fetch(2)) == [[[3], ["c"]], [[4], ["d"]]]
+    assert not cursor.exhausted
+    assert list(cursor.fetch(2)) == []
+    assert cursor.exhausted
+
+
+def test_bv_context_keeps_portal_cursor(bv_context, mock_session):
+    qr = MagicMock(spec=QueryResult)
+    qr.has_results.return_value = False
+    mock_session.execute_prepared.return_value = qr
+    bv_context.add_statement("stmt1", "SELECT 1", [])
+    bv_context.add_portal("portal1", "stmt1", [], [])
+    cursor = bv_context.portal_cursor("portal1")
+    assert bv_context.portal_cursor("portal1") is cursor
+    mock_session.execute_prepared.assert_called_once_with("stmt1", "SELECT 1", [])
+
+    bv_context.sync()
+    assert "portal1" not in bv_context.cursors
+
+
+def test_bv_context_unnamed_statements_are_not_prepared(bv_context, mock_session):
+    qr = MagicMock(spec=QueryResult)
+    qr.has_results.return_value = False
+    mock_session.execute_sql.return_value = qr
+    bv_context.add_statement("", "SELECT 1", [])
+    bv_context.add_portal("", "", [], [])
+    assert bv_context.execute_portal("") is qr
+    mock_session.execute_prepared.assert_not_called()
+
+
+def test_bv_context_close_statement_closes_prepared(bv_context, mock_session):
+    bv_context.add_statement("stmt1", "SELECT 1", [])
+    bv_context.close_statement("stmt1")
+    mock_session.close_prepared.assert_called_once_with("stmt1")
+
+
+def test_bv_context_describe_does_not_execute(bv_context, mock_session):
+    description = MagicMock(spec=QueryResult)
+    description.has_results.return_value = True
+    description.column_count.return_value = 2
+    description.result_format = None
+    mock_session.describe_sql.return_value = description
+    bv_context.add_statement("stmt1", "SELECT $1, $2", [23])
+    assert bv_context.describe_statement("stmt1") is description
+    assert bv_context.parameter_types("stmt1") == [23, 705]
+    bv_context.add_portal("portal1", "stmt1", ["1", "2"], [1])
+    qr = bv_context.describe_portal("portal1")
+    assert qr.result_format == [1, 1]
+    assert description.result_format is None
+    mock_session.describe_sql.assert_any_call("SELECT $1, $2", None)
+    mock_session.describe_sql.assert_called_with("SELECT $1, $2", ["1", "2"])
+    mock_session.execute_sql.assert_not_called()
+    mock_session.execute_prepared.assert_not_called()
@@ -0,0 +1,218 @@
+import datetime
+import io
+import struct
+import uuid
+
+import pyarrow as pa
+import pytest
+
+from buenavista.columnar import decode_copy_tuples, encode_copy_tuples
+from buenavista.core import BVType
+from buenavista.pgcopy import parse_copy
+from buenavista.postgres import BuenaVistaHandler
+
+
+class ArrowQueryResult:
+    def __init__(self, table: pa.Table, bvtypes, result_format=None, arrow=True):
+        self.table = table
+        self.arrow = arrow
+        self.bvtypes = bvtypes
+        self.result_format = result_format
+
+    def column_count(self):
+        return self.table.num_columns
+
+    def column(self, index: int):
+        return self.table.schema[index].name, self.bvtypes[index]
+
+    def rows(self):
+        return iter([list(r.values()) for r in self.table.to_pylist()])
+
+    def batches(self, size: int = 1024):
+        for rb in self.table.to_batches(max_chunksize=3):
+            if self.arrow:
+                yield rb.columns
+            else:
+                yield [c.to_pylist() for c in rb.columns]
+
+
+@pytest.fixture
+def table():
+    return pa.table(
+        {
+            "i": pa.array([1, None, 3, 42, 5], pa.int64()),
+            "n": pa.array([7, 8, None, 10, 11], pa.int32()),
+            "f": pa.array([1.0, 2.5, None, 0.1, 1e20], pa.float64()),
+            "s": pa.array(["a", "", None, "héllo", "z"], pa.string()),
+            "b": pa.array([True, False, None, True, False], pa.bool_()),
+            "d": pa.array([datetime.date(2021, 1, 1)] * 4 + [None], pa.date32()),
+            "t": pa.array(
+                [
+                    datetime.datetime(2021, 1, 1, 12, 30),
+                    datetime.datetime(2021, 1, 1, 12, 30, 0, 5),
+                    None,
+                    datetime.datetime(1999, 12, 31),
+                    datetime.datetime(2000, 1, 1),
+                ],
+                pa.timestamp("us"),
+            ),
+        }
+    )
+
+
+BVTYPES = [
+    BVType.BIGINT,
+    BVType.INTEGER,
+    BVType.FLOAT,
+    BVType.TEXT,
+    BVType.BOOL,
+    BVType.DATE,
+    BVType.TIMESTAMP,
+]
+
+
+def _send(qr, limit=0):
+    handler = BuenaVistaHandler.__new__(BuenaVistaHandler)
+    handler.wfile = io.BytesIO()
+    cnt = handler.send_data_rows(qr, limit)
+    return cnt, handler.wfile.getvalue()
+
+
+@pytest.mark.parametrize("limit", [0, 2, 4, 10])
+def test_text_rows_match_row_encoder(table, limit):
+    expected = _send(ArrowQueryResult(table, BVTYPES, arrow=False), limit)
+    assert _send(ArrowQueryResult(table, BVTYPES), limit) == expected
+
+
+def test_binary_rows_match_row_encoder(table):
+    # The per-value converters cannot handle naive timestamps in binary
+    table = table.drop_columns(["t"])
+    fmts = [1] * table.num_columns
+    expected = _send(ArrowQueryResult(table, BVTYPES[:-1], fmts, arrow=False))
+    assert _send(ArrowQueryResult(table, BVTYPES[:-1], fmts)) == expected
+
+
+def test_binary_timestamps_use_pg_epoch():
+    table = pa.table(
+        {"t": pa.array([datetime.datetime(2000, 1, 1, 0, 0, 1)], pa.timestamp("us"))}
+    )
+    cnt, out = _send(ArrowQueryResult(table, [BVType.TIMESTAMP], [1]))
+    assert cnt == 1
+    assert out == b"D\x00\x00\x00\x12\x00\x01\x00\x00\x00\x08" + (
+        1000000
+    ).to_bytes(8, "big")
+
+
+def _copy(qr, sql):
+    handler = BuenaVistaHandler.__new__(BuenaVistaHandler)
+    handler.wfile = io.BytesIO()
+    cnt = handler.send_copy_out(qr, parse_copy(sql))
+    return cnt, handler.wfile.getvalue()
+
+
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + bytes(8)
+
+COPY_SQL = [
+    "COPY t TO STDOUT",
+    "COPY t TO STDOUT (FORMAT csv, HEADER)",
+    "COPY t TO STDOUT CSV DELIMITER ';' NULL 'NA' QUOTE '''' ESCAPE '\\'",
+    "COPY t TO STDOUT WITH DELIMITER ' '",
+]
+
+
+@pytest.mark.parametrize("sql", COPY_SQL)
+def test_copy_text_matches_row_encoder(table, monkeypatch, sql):
+    monkeypatch.setattr("buenavista.postgres.COPY_CHUNK_ROWS", 2)
+    special = pa.array(["a\tb", 'q"u;o\'te', "back\\slash", "new\nline", "NA"] * 3)
+    table = table.append_column("x", special[: table.num_rows])
+    bvtypes = BVTYPES + [BVType.TEXT]
+    expected = _copy(ArrowQueryResult(table, bvtypes, arrow=False), sql)
+    assert _copy(ArrowQueryResult(table, bvtypes), sql) == expected
+
+
+def _messages(out):
+    ret, i = [], 0
+    while i < len(out):
+        n = int.from_bytes(out[i + 1 : i + 5], "big")
+        ret.append((out[i : i + 1], out[i + 5 : i + 1 + n]))
+        i += 1 + n
+    return ret
+
+
+def test_copy_text_escapes():
+    table = pa.table({"s": ["a\tb", None, "x\\y"], "c": ["1,2", "", None]})
+    qr = ArrowQueryResult(table, [BVType.TEXT, BVType.TEXT])
+    cnt, out = _copy(qr, "COPY t TO STDOUT")
+    assert cnt == 3
+    assert _messages(out) == [
+        (b"H", b"\x00\x00\x02\x00\x00\x00\x00"),
+        (b"d", b"a\\tb\t1,2\n"),
+        (b"d", b"\\N\t\n"),
+        (b"d", b"x\\\\y\t\\N\n"),
+        (b"c", b""),
+    ]
+    _, out = _copy(qr, "COPY t TO STDOUT (FORMAT csv)")
+    assert [m[1] for m in _messages(out)[1:-1]] == [
+        b'a\tb,"1,2"\n',
+        b',""\n',
+        b"x\\y,\n",
+    ]
+
+
+def test_copy_binary_matches_row_encoder(table, monkeypatch):
+    monkeypatch.setattr("buenavista.postgres.COPY_CHUNK_ROWS", 2)
+    table = table.drop_columns(["t"])
+    sql = "COPY t TO STDOUT (FORMAT binary)"
+    expected = _copy(ArrowQueryResult(table, BVTYPES[:-1], arrow=False), sql)
+    cnt, out = _copy(ArrowQueryResult(table, BVTYPES[:-1]), sql)
+    assert (cnt, out) == expected
+    assert cnt == 5
+    # The header is sent along with the first tuple and the trailer on its own
+    messages = _messages(out)
+    assert len(messages) == 8
+    assert messages[1][1].startswith(PGCOPY_HEADER + b"\x00\x06")
+    assert messages[6] == (b"d", b"\xff\xff")
+
+
+def test_copy_binary_without_rows():
+    table = pa.table({"i": pa.array([], pa.int64())})
+    cnt, out = _copy(ArrowQueryResult(table, [BVType.BIGINT]), "COPY t TO STDOUT BINARY")
+    assert cnt == 0
+    assert _messages(out)[1:] == [(b"d", PGCOPY_HEADER + b"\xff\xff"), (b"c", b"")]
+
+
+COPY_OIDS = [20, 23, 701, 25, 16, 1082, 1114]
+
+
+def _copy_tuples(table):
+    columns = [c.combine_chunks() for c in table.columns]
+    data = encode_copy_tuples(columns, BVTYPES, [None] * len(columns))
+    return [payload for _, payload in _messages(data)]
+
+
+def test_decode_copy_tuples_roundtrip(table):
+    columns, rest = decode_copy_tuples(_copy_tuples(table), COPY_OIDS)
+    assert rest == b""
+    assert pa.table(columns, names=table.column_names) == table
+
+
+def test_decode_copy_tuples_split_across_messages(table):
+    data = b"".join(_copy_tuples(table))
+    first, rest = decode_copy_tuples([data[:20], data[20:70]], COPY_OIDS)
+    assert rest and len(first[0]) < table.num_rows
+    second, rest = decode_copy_tuples([rest, data[70:]], COPY_OIDS)
+    assert rest == b""
+    decoded = [pa.concat_arrays([a, b]) for a, b in zip(first, second)]
+    assert pa.table(decoded, names=table.column_names) == table
+
+
+def test_decode_copy_tuples_python_values():
+    u = uuid.uuid4()
+    messages = [
+        struct.pack("!hi16si", 2, 16, u.bytes, 7) + b"\x01[1, 2]",
+        struct.pack("!hii", 2, -1, -1),
+    ]
+    columns, rest = decode_copy_tuples(messages, [2950, 3802])
+    assert rest == b""
+    assert columns[0] == [u, None]
+    assert columns[1].to_pylist() == ["[1, 2]", None]
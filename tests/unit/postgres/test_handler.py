@@ -1,11 +1,23 @@
+import io
+import struct
+
 import pytest
 from unittest.mock import MagicMock, patch
 
-from buenavista.core import BVType, Connection, SimpleQueryResult
+from buenavista.core import (
+    BVType,
+    Connection,
+    QueryResult,
+    Session,
+    SimpleQueryResult,
+)
 from buenavista.postgres import (
     BuenaVistaHandler,
     BVBuffer,
     BVContext,
+    ClientCommand,
+    MessageReader,
+    PortalCursor,
     TransactionStatus,
 )
 from buenavista.rewrite import Rewriter
@@ -29,8 +41,9 @@ def mock_handler():
 
 
 def test_handle_startup(mock_handler):
-    mock_handler.r.read_uint32.side_effect = [8, 196608]
-    mock_handler.r.read_bytes.return_value = b"user\x00test\x00database\x00testdb\x00"
+    payload = b"user\x00test\x00database\x00testdb\x00\x00"
+    data = struct.pack("!II", 8 + len(payload), 196608) + payload
+    mock_handler.r = MessageReader(io.BytesIO(data).readinto)
     ctx = mock_handler.handle_startup(mock_handler.server.conn)
     assert isinstance(ctx, BVContext)
     assert ctx.session is not None
@@ -41,8 +54,32 @@ def test_handle_query(mock_handler):
     ctx = MagicMock(spec=BVContext)
     ctx.execute_sql.return_value = SimpleQueryResult("col1", 1, BVType.INTEGER)
     ctx.transaction_status.return_value = TransactionStatus.IDLE
+    ctx.split_query.return_value = ["SELECT 1"]
     mock_handler.handle_query(ctx, b"SELECT 1;\x00")
-    ctx.execute_sql.assert_called_once_with("SELECT 1;")
+    ctx.split_query.assert_called_once_with("SELECT 1;")
+    ctx.execute_sql.assert_called_once_with("SELECT 1")
+
+
+def test_handle_query_runs_each_statement_until_an_error(mock_handler):
+    session = MagicMock(spec=Session)
+    session.in_transaction.return_value = False
+    session.execute_sql.side_effect = [
+        SimpleQueryResult("a", 1, BVType.INTEGER),
+        Exception("boom"),
+        SimpleQueryResult("c", 3, BVType.INTEGER),
+    ]
+    ctx = BVContext(session, None, {})
+    mock_handler.wfile = io.BytesIO()
+    mock_handler.handle_query(ctx, b"SELECT 1; SELECT ';'; SELECT 3\x00")
+    assert [c.args[0] for c in session.execute_sql.call_args_list] == [
+        "SELECT 1",
+        "SELECT ';'",
+    ]
+    assert _response_types(mock_handler.wfile.getvalue()) == b"TDCEZ"
+
+    mock_handler.wfile = io.BytesIO()
+    mock_handler.handle_query(ctx, b" ; \x00")
+    assert _response_types(mock_handler.wfile.getvalue()) == b"IZ"
 
 
 def test_handle_parse(mock_handler):
@@ -52,3 +89,130 @@ def test_handle_parse(mock_handler):
 
 
 # Add more test cases for other methods in the BuenaVistaHandler class
+
+
+def test_handle_execute_suspends_portal(mock_handler):
+    ctx = MagicMock(spec=BVContext)
+    ctx.has_error = False
+    qr = MagicMock(spec=QueryResult)
+    qr.has_results.return_value = True
+    qr.column_count.return_value = 1
+    qr.column.return_value = ("col1", BVType.INTEGER)
+    qr.result_format = None
+    qr.batches.return_value = iter([[[1, 2, 3]]])
+    ctx.portal_cursor.return_value = PortalCursor(qr)
+
+    mock_handler.handle_execute(ctx, b"p1\x00\x00\x00\x00\x02")
+    writes = [c.args[0] for c in mock_handler.wfile.write.call_args_list]
+    assert writes[-1] == b"s\x00\x00\x00\x04"
+    ctx.close_cursor.assert_not_called()
+
+    mock_handler.wfile.reset_mock()
+    mock_handler.handle_execute(ctx, b"p1\x00\x00\x00\x00\x02")
+    writes = [c.args[0] for c in mock_handler.wfile.write.call_args_list]
+    assert writes[-1] == b"C\x00\x00\x00\x0dSELECT 1\x00"
+    ctx.close_cursor.assert_called_once_with("p1")
+
+
+def test_handle_describe_statement(mock_handler):
+    ctx = MagicMock(spec=BVContext)
+    ctx.describe_statement.return_value = SimpleQueryResult("col1", 1, BVType.INTEGER)
+    ctx.parameter_types.return_value = [23, 705]
+    mock_handler.handle_describe(ctx, b"Sstmt1\x00")
+    ctx.describe_statement.assert_called_once_with("stmt1")
+    writes = [c.args[0] for c in mock_handler.wfile.write.call_args_list]
+    assert writes[0] == b"t\x00\x00\x00\x0e\x00\x02\x00\x00\x00\x17\x00\x00\x02\xc1"
+    assert writes[1][:1] == b"T"
+
+
+def test_handle_describe_portal_without_rows(mock_handler):
+    ctx = MagicMock(spec=BVContext)
+    qr = MagicMock(spec=QueryResult)
+    qr.has_results.return_value = False
+    ctx.describe_portal.return_value = qr
+    mock_handler.handle_describe(ctx, b"P\x00")
+    mock_handler.wfile.write.assert_called_once_with(b"n\x00\x00\x00\x04")
+
+
+def test_handle_bind_decodes_params_by_oid(mock_handler):
+    ctx = MagicMock(spec=BVContext)
+    ctx.param_oids.return_value = [23, 701, 25]
+    payload = (
+        b"p1\x00s1\x00"
+        + b"\x00\x03\x00\x01\x00\x01\x00\x00"
+        + b"\x00\x03"
+        + b"\x00\x00\x00\x04\xff\xff\xff\xfe"
+        + b"\x00\x00\x00\x08?\xf8\x00\x00\x00\x00\x00\x00"
+        + b"\x00\x00\x00\x02hi"
+        + b"\x00\x01\x00\x01"
+    )
+    mock_handler.handle_bind(ctx, payload)
+    ctx.add_portal.assert_called_once_with("p1", "s1", [-2, 1.5, "hi"], [1])
+
+
+def _response_types(data: bytes) -> bytes:
+    types, offset = [], 0
+    while offset < len(data):
+        types.append(data[offset : offset + 1])
+        offset += 1 + struct.unpack_from("!I", data, offset + 1)[0]
+    return b"".join(types)
+
+
+def test_pipelined_messages_after_an_error_are_discarded_until_sync(mock_handler):
+    session = MagicMock(spec=Session)
+    session.in_transaction.return_value = False
+    ctx = BVContext(session, None, {})
+    ctx.authenticated = True
+    mock_handler.wfile = io.BytesIO()
+    parse = b"s1\x00SELECT 1\x00\x00\x00"
+    for type_code, payload in [
+        (ClientCommand.CLOSE, b"Snope\x00"),
+        (ClientCommand.BIND, b"p1\x00nope\x00\x00\x00\x00\x00\x00\x00"),
+        (ClientCommand.PARSE, parse),
+        (ClientCommand.EXECUTE, b"p1\x00\x00\x00\x00\x00"),
+        (ClientCommand.SYNC, None),
+        (ClientCommand.PARSE, parse),
+        (ClientCommand.CLOSE, b"Ss1\x00"),
+        (ClientCommand.SYNC, None),
+    ]:
+        mock_handler.dispatch(ctx, type_code, payload)
+        if type_code == ClientCommand.SYNC:
+            assert ctx.stmts == {}
+    # CloseComplete, the error, then ReadyForQuery once per Sync
+    assert _response_types(mock_handler.wfile.getvalue()) == b"3EZ13Z"
+
+
+def test_sync_outside_a_transaction_closes_suspended_portals(mock_handler):
+    session = MagicMock(spec=Session)
+    session.in_transaction.return_value = False
+    qr = MagicMock(spec=QueryResult)
+    qr.has_results.return_value = True
+    qr.column_count.return_value = 1
+    qr.column.return_value = ("col1", BVType.INTEGER)
+    qr.batches.return_value = iter([[[1, 2, 3]]])
+    session.execute_prepared.return_value = qr
+    ctx = BVContext(session, None, {})
+    ctx.authenticated = True
+    ctx.add_statement("s1", "SELECT col1 FROM t", [])
+    ctx.add_portal("", "s1", {}, [])
+    mock_handler.wfile = io.BytesIO()
+    for type_code, payload in [
+        (ClientCommand.EXECUTE, b"\x00\x00\x00\x00\x02"),
+        (ClientCommand.SYNC, None),
+        (ClientCommand.EXECUTE, b"\x00\x00\x00\x00\x02"),
+        (ClientCommand.SYNC, None),
+    ]:
+        mock_handler.dispatch(ctx, type_code, payload)
+    # The second Execute fails instead of running the portal again
+    assert _response_types(mock_handler.wfile.getvalue()) == b"DDsZEZ"
+    session.execute_prepared.assert_called_once()
+    assert ctx.portals == {}
+
+
+def test_close_context_aborts_copy_in(mock_handler):
+    ctx = BVContext(MagicMock(spec=Session), None, {})
+    ctx.copy_in = copy_in = MagicMock()
+    mock_handler.close_context(ctx)
+    copy_in.abort.assert_called_once_with()
+    assert ctx.copy_in is None
+    mock_handler.server.conn.close_session.assert_called_once_with(ctx.session)
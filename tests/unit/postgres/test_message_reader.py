@@ -0,0 +1,70 @@
+import io
+import struct
+
+from buenavista.postgres import MessageReader
+
+
+def _message(code: bytes, payload: bytes = b"") -> bytes:
+    return code + struct.pack("!I", 4 + len(payload)) + payload
+
+
+class ChunkedStream:
+    """Returns the data in reads of at most chunk bytes."""
+
+    def __init__(self, data: bytes, chunk: int):
+        self.data = data
+        self.chunk = chunk
+        self.reads = 0
+
+    def readinto(self, b) -> int:
+        n = min(len(b), self.chunk, len(self.data))
+        b[:n] = self.data[:n]
+        self.data = self.data[n:]
+        self.reads += 1
+        return n
+
+
+def test_frames_pipelined_messages_from_one_read():
+    data = _message(b"P", b"s\x00SELECT 1\x00\x00\x00") + _message(b"S")
+    stream = ChunkedStream(data, 1024)
+    reader = MessageReader(stream.readinto)
+    code, payload = reader.read()
+    assert code == b"P"
+    assert isinstance(payload, memoryview)
+    assert bytes(payload) == b"s\x00SELECT 1\x00\x00\x00"
+    assert reader.read() == (b"S", None)
+    assert stream.reads == 1
+    assert reader.read() is None
+
+
+def test_frames_messages_split_across_reads():
+    data = b"".join(_message(b"d", bytes([i]) * 10) for i in range(20))
+    reader = MessageReader(ChunkedStream(data, 7).readinto, size=16)
+    for i in range(20):
+        code, payload = reader.read()
+        assert (code, bytes(payload)) == (b"d", bytes([i]) * 10)
+    assert reader.read() is None
+
+
+def test_large_messages_get_a_buffer_of_their_own():
+    big = b"x" * 100
+    data = _message(b"d", big) + _message(b"c")
+    reader = MessageReader(io.BytesIO(data).readinto, size=16)
+    assert bytes(reader.read()[1]) == big
+    assert reader.read() == (b"c", None)
+    assert reader.read() is None
+    assert len(reader.buf) == 16
+
+
+def test_feed_and_startup_messages():
+    reader = MessageReader()
+    startup = struct.pack("!II", 16, 80877102) + struct.pack("!II", 1, 2)
+    data = startup + _message(b"X")
+    reader.feed(data[:5])
+    assert reader.frame_startup() is None
+    reader.feed(data[5:])
+    code, payload = reader.frame_startup()
+    assert code == 80877102
+    assert struct.unpack("!II", payload) == (1, 2)
+    assert reader.frame() == (b"X", None)
+    assert reader.frame() is None
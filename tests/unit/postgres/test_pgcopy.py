@@ -0,0 +1,152 @@
+import struct
+
+import pytest
+
+from buenavista import columnar
+from buenavista.core import BulkLoad
+from buenavista.pgcopy import BINARY_HEADER, BINARY_TRAILER, CopyIn, parse_copy
+
+
+def test_copy_query_to_stdout():
+    copy = parse_copy("COPY (SELECT 1, ')' AS p) TO STDOUT;")
+    assert copy.direction == "to"
+    assert copy.select_sql() == "SELECT 1, ')' AS p"
+    assert (copy.format, copy.delimiter, copy.null) == ("text", "\t", "\\N")
+
+
+def test_copy_table_columns():
+    copy = parse_copy('copy s.t (a, "B") to stdout')
+    assert copy.select_sql() == 'SELECT a, "B" FROM s.t'
+    assert parse_copy("COPY t FROM STDIN").direction == "from"
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "COPY t TO STDOUT WITH (FORMAT csv, HEADER true, DELIMITER ';', NULL 'NA')",
+        "COPY t TO STDOUT CSV HEADER DELIMITER AS ';' NULL AS 'NA'",
+        "COPY t TO STDOUT WITH CSV FORCE QUOTE a, b HEADER DELIMITER ';' NULL 'NA'",
+    ],
+)
+def test_copy_options(sql):
+    copy = parse_copy(sql)
+    assert copy.csv and copy.header
+    assert (copy.delimiter, copy.null, copy.quote, copy.escape) == (";", "NA", '"', '"')
+
+
+def test_copy_binary():
+    assert parse_copy("COPY t TO STDOUT (FORMAT binary)").binary
+    assert parse_copy("COPY t TO STDOUT WITH BINARY").binary
+    with pytest.raises(ValueError):
+        parse_copy("COPY t TO STDOUT (FORMAT parquet)")
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT 1",
+        "COPY t TO 'out.csv' (FORMAT csv)",
+        "COPY t FROM 'in.parquet'",
+        "COPY (SELECT 1) TO STDIN",
+    ],
+)
+def test_not_client_copy(sql):
+    assert parse_copy(sql) is None
+
+
+class ListLoad(BulkLoad):
+    def __init__(self):
+        self.batches = []
+        self.finished = False
+
+    def append(self, batch):
+        self.batches.append(batch)
+        return batch.num_rows
+
+    def finish(self):
+        self.finished = True
+        return sum(b.num_rows for b in self.batches)
+
+
+def _load(sql, oids, chunks, batch_bytes=16):
+    copy = parse_copy(sql)
+    loader = ListLoad()
+    copy_in = CopyIn(copy, loader, columnar.copy_decoder(copy, oids), batch_bytes)
+    for chunk in chunks:
+        copy_in.feed(chunk)
+    count = copy_in.finish()
+    assert loader.finished
+    rows = [list(r.values()) for b in loader.batches for r in b.to_pylist()]
+    assert count == len(rows)
+    return rows, len(loader.batches)
+
+
+def test_copy_in_text():
+    data = b"1\ta\\tb\n2\t\\N\n3\tx\\\\y\n\\.\n"
+    chunks = data.splitlines(keepends=True)
+    rows, nbatches = _load("COPY t FROM STDIN", [23, 25], chunks, 4)
+    assert rows == [["1", "a\tb"], ["2", None], ["3", "x\\y"]]
+    assert nbatches == 3
+
+
+def test_copy_in_text_escaped_delimiter():
+    data = b"1|a\\|b\n2|\\N\n"
+    rows, _ = _load("COPY t FROM STDIN DELIMITER '|'", [23, 25], [data])
+    assert rows == [["1", "a|b"], ["2", None]]
+
+
+def test_copy_in_csv_splits_rows_outside_quotes():
+    data = b'i,s\n1,"a\nb,c"\n2,\n3,""\n'
+    chunks = [data[i : i + 3] for i in range(0, len(data), 3)]
+    rows, _ = _load("COPY t FROM STDIN (FORMAT csv, HEADER)", [23, 25], chunks, 4)
+    assert rows == [["1", "a\nb,c"], ["2", None], ["3", ""]]
+
+
+def test_copy_in_binary():
+    rows = [(1, "a"), (None, "bc"), (3, None)]
+    data = BINARY_HEADER
+    for row in rows:
+        data += struct.pack("!h", 2)
+        for v, fmt in zip(row, ("!i", None)):
+            if v is None:
+                data += struct.pack("!i", -1)
+            else:
+                b = struct.pack(fmt, v) if fmt else v.encode()
+                data += struct.pack("!i", len(b)) + b
+    data += BINARY_TRAILER
+    chunks = [data[i : i + 7] for i in range(0, len(data), 7)]
+    loaded, nbatches = _load("COPY t FROM STDIN BINARY", [23, 25], chunks)
+    assert loaded == [list(r) for r in rows]
+    assert nbatches > 1
+
+
+def test_copy_in_incomplete_binary():
+    with pytest.raises(ValueError):
+        _load("COPY t FROM STDIN BINARY", [23], [BINARY_HEADER + b"\x00\x01\x00"])
+    with pytest.raises(ValueError):
+        _load("COPY t FROM STDIN BINARY", [23], [b"PGCOPY\nxxxxxxxxxxxxxxxxxxx"])
+
+
+def test_copy_in_csv_with_escape_loads_incrementally():
+    data = b'1,"a\\"\nb"\n2,"\\\\"\n3,x\n'
+    chunks = [data[i : i + 3] for i in range(0, len(data), 3)]
+    sql = "COPY t FROM STDIN (FORMAT csv, ESCAPE '\\')"
+    rows, nbatches = _load(sql, [23, 25], chunks, 4)
+    assert rows == [["1", 'a"\nb'], ["2", "\\"], ["3", "x"]]
+    assert nbatches == 3
+
+
+@pytest.mark.parametrize(
+    "sql, data, expected",
+    [
+        ("COPY t FROM STDIN", b"a\n\nb\n", ["a", "", "b"]),
+        ("COPY t FROM STDIN", b"a\\\tb\n\n", ["a\tb", ""]),
+        ("COPY t FROM STDIN (FORMAT csv)", b'a\n\n""\n', ["a", None, ""]),
+    ],
+)
+def test_copy_in_keeps_empty_lines(sql, data, expected):
+    chunks = [data[i : i + 1] for i in range(len(data))]
+    rows, _ = _load(sql, [25], chunks, 1)
+    assert rows == [[v] for v in expected]
+    rows, _ = _load(sql, [25], [data])
+    assert rows == [[v] for v in expected]
@@ -0,0 +1,132 @@
+import datetime
+import decimal
+import struct
+import uuid
+
+import pytest
+
+from buenavista.pgtypes import ParamDecoder, binary_decoder, text_decoder
+
+
+def _values(*values):
+    out = b""
+    for v in values:
+        out += struct.pack("!i", -1) if v is None else struct.pack("!i", len(v)) + v
+    return out
+
+
+@pytest.mark.parametrize(
+    "oid,raw,expected",
+    [
+        (16, b"\x01", True),
+        (21, b"\xff\xfe", -2),
+        (23, struct.pack("!i", -7), -7),
+        (20, struct.pack("!q", 2**40), 2**40),
+        (700, struct.pack("!f", 1.5), 1.5),
+        (701, struct.pack("!d", 0.1), 0.1),
+        (1082, struct.pack("!i", -1), datetime.date(1999, 12, 31)),
+        (1083, struct.pack("!q", 3723000001), datetime.time(1, 2, 3, 1)),
+        (1114, struct.pack("!q", 1), datetime.datetime(2000, 1, 1, 0, 0, 0, 1)),
+        (
+            1184,
+            struct.pack("!q", 0),
+            datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc),
+        ),
+        # -12345.6789: digits 1, 2345, 6789 with weight 1 and dscale 4
+        (
+            1700,
+            struct.pack("!hhHh3h", 3, 1, 0x4000, 4, 1, 2345, 6789),
+            decimal.Decimal("-12345.6789"),
+        ),
+        (1700, struct.pack("!hhHh1h", 1, 1, 0, 0, 10), decimal.Decimal("100000")),
+        (1700, struct.pack("!hhHh1h", 1, -1, 0, 4, 1), decimal.Decimal("0.0001")),
+        (17, b"\x00\xff", b"\x00\xff"),
+        (2950, uuid.UUID(int=5).bytes, uuid.UUID(int=5)),
+        (3802, b"\x01{}", "{}"),
+        # int4[] with dims [2, 2] and a NULL element
+        (
+            1007,
+            struct.pack("!iiIiiii", 2, 1, 23, 2, 1, 2, 1)
+            + _values(b"\x00\x00\x00\x01", None, b"\x00\x00\x00\x03", b"\x00\x00\x00\x04"),
+            [[1, None], [3, 4]],
+        ),
+        (0, b"\x00\x02", 2),
+    ],
+)
+def test_binary_decoders(oid, raw, expected):
+    assert binary_decoder(oid)(raw) == expected
+
+
+@pytest.mark.parametrize(
+    "oid,raw,expected",
+    [
+        (16, b"t", True),
+        (23, b"42", 42),
+        (701, b"2.5", 2.5),
+        (1700, b"1.10", decimal.Decimal("1.10")),
+        (1082, b"2023-01-02", datetime.date(2023, 1, 2)),
+        (1114, b"2023-01-02 03:04:05", datetime.datetime(2023, 1, 2, 3, 4, 5)),
+        (
+            1184,
+            b"2023-01-02 03:04:05+02",
+            datetime.datetime(
+                2023, 1, 2, 3, 4, 5, tzinfo=datetime.timezone(datetime.timedelta(hours=2))
+            ),
+        ),
+        (1082, b"infinity", "infinity"),
+        (1082, b"0044-03-15 BC", "0044-03-15 BC"),
+        (1083, b"12:00:00.25", datetime.time(12, 0, 0, 250000)),
+        (1083, b"24:00:00", "24:00:00"),
+        (
+            1114,
+            b"2024-01-01 12:00:00.5",
+            datetime.datetime(2024, 1, 1, 12, 0, 0, 500000),
+        ),
+        (1114, b"2024-01-01", datetime.datetime(2024, 1, 1)),
+        (1114, b"-infinity", "-infinity"),
+        (
+            1184,
+            b"2024-01-01 12:00:00.123-05:30",
+            datetime.datetime(
+                2024,
+                1,
+                1,
+                12,
+                0,
+                0,
+                123000,
+                tzinfo=datetime.timezone(-datetime.timedelta(hours=5, minutes=30)),
+            ),
+        ),
+        (1184, b"infinity", "infinity"),
+        (17, b"\\x00ff", b"\x00\xff"),
+        (17, b"a\\\\\\001", b"a\\\x01"),
+        (1007, b"{1,NULL,3}", [1, None, 3]),
+        (1009, b'{a,"b,c","q\\"",NULL}', ["a", "b,c", 'q"', None]),
+        (1016, b"{{1,2},{3,4}}", [[1, 2], [3, 4]]),
+        (25, b"{x}", "{x}"),
+        (0, b"{a,b}", ["a", "b"]),
+        (0, b"abc", "abc"),
+    ],
+)
+def test_text_decoders(oid, raw, expected):
+    assert text_decoder(oid)(raw) == expected
+
+
+def test_param_decoder_fixed_width():
+    decoder = ParamDecoder((23, 20, 701), (1, 1, 1))
+    assert decoder.fixed is not None
+    data = b"xx" + _values(
+        struct.pack("!i", 1), struct.pack("!q", 2), struct.pack("!d", 3.0)
+    )
+    assert decoder.decode(data, 2) == ([1, 2, 3.0], len(data))
+    # NULLs fall back to decoding the values one at a time
+    data = _values(struct.pack("!i", 1), None, struct.pack("!d", 3.0))
+    assert decoder.decode(data) == ([1, None, 3.0], len(data))
+
+
+def test_param_decoder_mixed_formats():
+    decoder = ParamDecoder((23, 25, 0), (1, 0, 0))
+    assert decoder.fixed is None
+    data = _values(struct.pack("!i", 1), "héllo".encode(), b"7")
+    assert decoder.decode(data) == ([1, "héllo", "7"], len(data))
@@ -0,0 +1,48 @@
+import io
+
+from buenavista.postgres import WriteBuffer
+
+
+class RecordingFile(io.BytesIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        return super().write(data)
+
+
+def test_write_buffer_coalesces_until_flush():
+    raw = RecordingFile()
+    wb = WriteBuffer(raw, 16)
+    wb.write(b"abc")
+    wb.write(b"def")
+    assert raw.writes == 0
+    wb.flush()
+    assert raw.writes == 1
+    assert raw.getvalue() == b"abcdef"
+    wb.flush()
+    assert raw.writes == 1
+
+
+def test_write_buffer_writes_out_when_full():
+    raw = RecordingFile()
+    wb = WriteBuffer(raw, 8)
+    wb.write(b"abcde")
+    wb.write(b"fghij")
+    assert raw.getvalue() == b"abcde"
+    wb.flush()
+    assert raw.getvalue() == b"abcdefghij"
+    assert raw.writes == 2
+
+
+def test_write_buffer_passes_large_writes_through():
+    raw = RecordingFile()
+    wb = WriteBuffer(raw, 8)
+    wb.write(b"ab")
+    wb.write(b"x" * 20)
+    assert raw.getvalue() == b"ab" + b"x" * 20
+    assert raw.writes == 2
+    wb.close()
+    assert wb.closed
@@ -0,0 +1,39 @@
+import time
+
+from buenavista.cache import LRUCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_lru_cache_bounded_by_bytes():
+    cache = LRUCache(maxbytes=10, sizeof=len)
+    cache.put("a", b"12345")
+    cache.put("b", b"123456")
+    assert "a" not in cache
+    assert cache.nbytes == 6
+    # Values larger than the whole cache are never stored
+    cache.put("c", b"x" * 11)
+    assert "c" not in cache
+    assert cache.pop("b") == b"123456"
+    assert cache.nbytes == 0
+
+
+def test_lru_cache_ttl():
+    cache = LRUCache(ttl=0.01)
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+    time.sleep(0.02)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
@@ -1,4 +1,6 @@
 import pytest
+import threading
+import time
 import uuid
 from typing import Iterator, List, Tuple
 
@@ -6,9 +8,11 @@ from buenavista.core import (
     BVType,
     QueryResult,
     Session,
+    SessionPool,
     Connection,
     Extension,
     SimpleQueryResult,
+    to_pylist,
 )
 
 
@@ -69,6 +73,98 @@ def test_connection_init():
     assert connection._sessions == {}
 
 
+# ----------------------- SessionPool -----------------------
+class DummySession(Session):
+    def __init__(self, reusable=True):
+        super().__init__()
+        self.reusable = reusable
+        self.resets = 0
+        self.closed = False
+
+    def reset(self) -> bool:
+        self.resets += 1
+        return self.reusable
+
+    def close(self):
+        self.closed = True
+
+
+class DummyConnection(Connection):
+    def __init__(self, pool):
+        super().__init__()
+        self.created = []
+        self.session_pool = pool
+        self.session_pool.start(self.new_session)
+
+    def new_session(self) -> Session:
+        self.created.append(DummySession())
+        return self.created[-1]
+
+
+def test_session_pool_prewarms_and_reuses_sessions():
+    conn = DummyConnection(SessionPool(min_size=2))
+    assert len(conn.created) == 2
+    s1 = conn.create_session()
+    assert s1 in conn.created
+    conn.close_session(s1)
+    assert s1.resets == 1 and not s1.closed
+    assert conn.create_session() is s1
+    assert len(conn.created) == 2
+    assert conn.session_pool.stats()["hits"] == 2
+
+
+def test_session_pool_closes_sessions_that_cannot_be_reset():
+    conn = DummyConnection(SessionPool())
+    s1 = conn.create_session()
+    s1.reusable = False
+    conn.close_session(s1)
+    assert s1.closed
+    s2 = conn.create_session()
+    assert s2 is not s1
+    conn.close_session(s2, reuse=False)
+    assert s2.closed and s2.resets == 0
+    assert conn.session_pool.stats()["size"] == 0
+
+
+def test_session_pool_waits_for_released_sessions():
+    conn = DummyConnection(SessionPool(max_size=1, timeout=5))
+    s1 = conn.create_session()
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(conn.create_session()))
+    waiter.start()
+    time.sleep(0.05)
+    assert acquired == []
+    conn.close_session(s1)
+    waiter.join(1)
+    assert acquired == [s1]
+
+
+def test_session_pool_times_out():
+    conn = DummyConnection(SessionPool(max_size=1, timeout=0.01))
+    conn.create_session()
+    with pytest.raises(TimeoutError):
+        conn.create_session()
+    assert conn.session_pool.stats()["timeouts"] == 1
+
+
+def test_session_pool_reaps_idle_sessions():
+    conn = DummyConnection(SessionPool(min_size=1, max_idle=0))
+    sessions = [conn.create_session() for _ in range(3)]
+    for s in sessions:
+        conn.close_session(s)
+    # The longest-idle sessions are closed, down to min_size
+    assert [s.closed for s in sessions] == [True, True, False]
+    assert conn.session_pool.stats() == {
+        "size": 1,
+        "idle": 1,
+        "in_use": 0,
+        "hits": 1,
+        "misses": 2,
+        "timeouts": 0,
+        "reaped": 2,
+    }
+
+
 # ----------------------- Extension -----------------------
 def test_extension_check_json():
     payload = '{"key": "value"}'
@@ -111,3 +207,12 @@ def test_simple_query_result_rows():
 def test_simple_query_result_status():
     sqr = SimpleQueryResult("test", 42, BVType.INTEGER)
     assert sqr.status() == ""
+
+
+def test_query_result_batches():
+    sqr = SimpleQueryResult("test", 42, BVType.INTEGER)
+    assert list(sqr.batches()) == [[("42",)]]
+
+
+def test_to_pylist():
+    assert to_pylist(("a", None)) == ["a", None]
@@ -0,0 +1,58 @@
+import datetime
+import decimal
+import json
+
+import pyarrow as pa
+
+from buenavista.core import BVType
+from buenavista.http import encoding, schemas, type_mapping
+
+
+def _result(**kwargs):
+    return schemas.QueryResult(
+        id="q",
+        info_uri="http://127.0.0.1/info",
+        stats=schemas.StatementStats(state="FINISHED", elapsed_time_millis=0),
+        **kwargs,
+    )
+
+
+def test_encode_result_streams_rows_in_chunks(monkeypatch):
+    monkeypatch.setattr(encoding, "ROWS_PER_CHUNK", 2)
+    cols = [schemas.Column(name="a", type="integer")]
+    data = [(i, "é") for i in range(5)]
+    chunks = list(encoding.encode_result(_result(columns=cols), data))
+    assert len(chunks) == 5
+    decoded = json.loads(b"".join(chunks))
+    assert decoded["columns"][0]["name"] == "a"
+    assert decoded["nextUri"] is None
+    assert decoded["data"] == [[i, "é"] for i in range(5)]
+
+
+def test_encode_result_without_data():
+    decoded = json.loads(b"".join(encoding.encode_result(_result())))
+    assert "data" not in decoded
+    assert decoded["stats"]["state"] == "FINISHED"
+    empty = json.loads(b"".join(encoding.encode_result(_result(), [])))
+    assert empty["data"] == []
+
+
+def test_dumps_falls_back_for_other_types():
+    value = [b"abc", datetime.timedelta(seconds=1.5), decimal.Decimal("1.10")]
+    assert json.loads(encoding.dumps(value)) == ["abc", 1.5, "1.10"]
+
+
+def test_column_converters():
+    decimals = pa.array([decimal.Decimal("0.00"), None], pa.decimal128(5, 2))
+    convert = type_mapping.column_converter(BVType.DECIMAL)
+    assert convert(decimals) == ["0.00", None]
+    assert convert((decimal.Decimal("0.00"), None)) == ["0.00", None]
+
+    dates = pa.array([datetime.date(2020, 1, 2), None])
+    assert type_mapping.column_converter(BVType.DATE)(dates) == ["2020-01-02", None]
+
+    ts = pa.array([datetime.datetime(2020, 1, 2, 3, 4, 5)])
+    convert = type_mapping.column_converter(BVType.TIMESTAMP)
+    assert convert(ts) == ["2020-01-02 03:04:05"]
+    convert = type_mapping.column_converter(BVType.INTEGER)
+    assert convert(pa.array([1, None])) == [1, None]
@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+
+from buenavista.core import Connection, Session
+from buenavista.http.context import SessionPool
+
+
+class DummySession(Session):
+    def close(self):
+        pass
+
+
+class DummyConnection(Connection):
+    def __init__(self):
+        super().__init__()
+        self.closed = []
+
+    def new_session(self) -> Session:
+        return DummySession()
+
+    def close_session(self, session: Session, reuse: bool = True):
+        self.closed.append(session)
+        super().close_session(session, reuse)
+
+
+@pytest.fixture
+def conn():
+    return DummyConnection()
+
+
+def test_sessions_are_reused_per_user(conn):
+    pool = SessionPool(conn)
+    s1 = pool.acquire("alice")
+    pool.release(s1, "alice")
+    assert pool.acquire("alice") is s1
+    assert pool.acquire("bob") is not s1
+    assert pool.stats()["created"] == 2
+    assert pool.stats()["reused"] == 1
+
+
+def test_per_user_limit_times_out(conn):
+    pool = SessionPool(conn, max_per_user=1, timeout=0.01)
+    pool.acquire("alice")
+    with pytest.raises(TimeoutError):
+        pool.acquire("alice")
+    pool.acquire("bob")
+    assert pool.stats()["timeouts"] == 1
+    assert pool.stats()["sessions"] == 2
+
+
+def test_waiters_get_released_sessions(conn):
+    pool = SessionPool(conn, max_sessions=1, timeout=5)
+    s1 = pool.acquire("alice")
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(pool.acquire("alice")))
+    waiter.start()
+    time.sleep(0.05)
+    assert pool.stats()["waiting"] == 1
+    pool.release(s1, "alice")
+    waiter.join(1)
+    assert acquired == [s1]
+
+
+def test_overall_limit_evicts_idle_sessions_of_other_users(conn):
+    pool = SessionPool(conn, max_sessions=1, timeout=0.01)
+    s1 = pool.acquire("alice")
+    pool.release(s1, "alice")
+    s2 = pool.acquire("bob")
+    assert s2 is not s1
+    assert conn.closed == [s1]
+    assert pool.stats()["evicted"] == 1
+
+
+def test_transactions_keep_their_session(conn):
+    pool = SessionPool(conn)
+    s1 = pool.acquire("alice")
+    pool.release(s1, "alice", "txn-1")
+    assert pool.stats()["transactions"] == 1
+    assert pool.acquire("alice") is not s1
+    assert pool.acquire("alice", "txn-1") is s1
+    with pytest.raises(ValueError):
+        pool.acquire("alice", "txn-2")
+
+
+def test_idle_sessions_and_transactions_expire(conn):
+    pool = SessionPool(conn, idle_ttl=0, txn_ttl=0)
+    s1, s2 = pool.acquire("alice"), pool.acquire("alice")
+    pool.release(s1, "alice", "txn-1")
+    pool.release(s2, "alice")
+    assert set(conn.closed) == {s1, s2}
+    stats = pool.stats()
+    assert (stats["sessions"], stats["idle_expired"], stats["txns_expired"]) == (0, 1, 1)
+    with pytest.raises(ValueError):
+        pool.acquire("alice", "txn-1")
@@ -0,0 +1,233 @@
+import contextlib
+import decimal
+import struct
+
+import pandas as pd
+import psycopg
+import pytest
+
+from buenavista.backends import postgres
+from buenavista.backends.postgres import PGConnection, PGSession
+from buenavista.core import BVType
+from buenavista.pgcopy import BINARY_HEADER, BINARY_TRAILER
+
+IDLE = psycopg.pq.TransactionStatus.IDLE
+INTRANS = psycopg.pq.TransactionStatus.INTRANS
+
+
+class DummyCursor:
+    def __init__(self, conn, name=None):
+        self.conn = conn
+        self.name = name
+        self.description = None
+        self.statusmessage = None
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def execute(self, sql, params=None):
+        self.conn.log.append(("execute", self.name, sql))
+        if "error" in sql:
+            raise psycopg.errors.SyntaxError("syntax error")
+        self.description = self.conn.description
+        self.statusmessage = "SELECT %d" % self.conn.num_rows
+        self.rows = [(i,) for i in range(self.conn.num_rows)]
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchmany(self, size):
+        self.conn.log.append(("fetchmany", size))
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        self.conn.log.append(("close", self.name))
+
+    @contextlib.contextmanager
+    def copy(self, sql):
+        self.conn.log.append(("copy", sql))
+        yield DummyCopy(self.conn.copy_data)
+
+
+class DummyCopy:
+    def __init__(self, messages):
+        self.messages = iter(messages)
+
+    def read(self):
+        return next(self.messages, b"")
+
+
+class DummyInfo:
+    def __init__(self):
+        self.transaction_status = IDLE
+
+
+class DummyConnection:
+    def __init__(self, num_rows):
+        self.num_rows = num_rows
+        self.log = []
+        self.info = DummyInfo()
+        self.description = [("i", 23)]
+        self.copy_data = []
+
+    def cursor(self, name=None):
+        return DummyCursor(self, name)
+
+    def cancel(self):
+        self.log.append("cancel")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        outer = self.info.transaction_status == IDLE
+        self.log.append("begin" if outer else "savepoint")
+        self.info.transaction_status = INTRANS
+        try:
+            yield
+        except BaseException:
+            self.log.append("rollback" if outer else "rollback to savepoint")
+            raise
+        finally:
+            if outer:
+                self.info.transaction_status = IDLE
+        self.log.append("commit" if outer else "release savepoint")
+
+
+class DummyParent:
+    def __init__(self):
+        self.released = []
+
+    def release(self, conn):
+        self.released.append(conn)
+
+
+def _session(num_rows=5, batch_size=2):
+    return PGSession(DummyParent(), DummyConnection(num_rows), batch_size)
+
+
+def test_execute_sql_streams_rows_in_batches():
+    session = _session()
+    res = session.execute_sql("SELECT i FROM t")
+    assert res.column(0) == ("i", BVType.INTEGER)
+    assert session.conn.log == ["begin", ("execute", "bv_stream", "SELECT i FROM t")]
+    # The cursor's transaction is not the client's
+    assert session.in_transaction() is False
+
+    assert list(res.rows()) == [(i,) for i in range(5)]
+    assert session.conn.log[2:] == [
+        ("fetchmany", 2),
+        ("fetchmany", 2),
+        ("fetchmany", 2),
+        ("fetchmany", 2),
+        ("close", "bv_stream"),
+        "commit",
+    ]
+
+
+def test_execute_sql_closes_undrained_stream():
+    session = _session()
+    res = session.execute_sql("SELECT i FROM t")
+    assert next(iter(res.rows())) == (0,)
+
+    session.execute_sql("SHOW search_path")
+    log = session.conn.log
+    assert log[log.index(("close", "bv_stream")) + 1] == "rollback"
+    assert log[-1] == ("execute", None, "SHOW search_path")
+
+
+def test_execute_sql_uses_savepoint_in_client_transaction():
+    session = _session()
+    session.conn.info.transaction_status = INTRANS
+    res = session.execute_sql("WITH x AS (SELECT 1) SELECT * FROM x")
+    assert session.in_transaction() is True
+    assert len(list(res.rows())) == 5
+    assert session.conn.log[0] == "savepoint"
+    assert session.conn.log[-1] == "release savepoint"
+
+
+def test_execute_sql_falls_back_for_undeclarable_queries():
+    session = _session()
+    with pytest.raises(psycopg.errors.SyntaxError):
+        session.execute_sql("SELECT error")
+    assert session.conn.log == [
+        "begin",
+        ("execute", "bv_stream", "SELECT error"),
+        ("close", "bv_stream"),
+        "rollback",
+        ("execute", None, "SELECT error"),
+    ]
+
+
+def test_execute_sql_fetches_all_without_batch_size():
+    session = _session(batch_size=0)
+    res = session.execute_sql("SELECT i FROM t")
+    assert list(res.rows()) == [(i,) for i in range(5)]
+    assert res.status() == "SELECT 5"
+    assert session.conn.log == [("execute", None, "SELECT i FROM t")]
+
+
+def test_close_ends_stream_and_releases_connection():
+    session = _session()
+    conn = session.conn
+    session.execute_sql("SELECT i FROM t")
+    session.close()
+    assert conn.log[-3:] == [("close", "bv_stream"), "rollback", ("close", None)]
+    assert session.parent.released == [conn]
+
+
+class DummyConnectionPool:
+    def __init__(self, conninfo):
+        self.conns = [DummyConnection(1)]
+
+    def getconn(self):
+        return self.conns.pop()
+
+    def putconn(self, conn):
+        self.conns.append(conn)
+
+
+def test_connection_creates_and_closes_sessions(monkeypatch):
+    monkeypatch.setattr(postgres, "ConnectionPool", DummyConnectionPool)
+    parent = PGConnection("dbname=test")
+    session = parent.create_session()
+    assert isinstance(session, PGSession)
+    assert parent.get_session(session.id) is session
+    assert session.conn.autocommit and not parent.pool.conns
+    parent.close_session(session)
+    assert parent.get_session(session.id) is None
+    assert len(parent.pool.conns) == 1
+
+
+def test_load_df_function_decodes_binary_copy(monkeypatch):
+    monkeypatch.setattr("buenavista.backends.postgres.COPY_CHUNK_BYTES", 40)
+    session = _session(batch_size=0)
+    session.conn.description = [("s", 25), ("i", 23), ("n", 1700)]
+    # NUMERIC 1.5: two base-10000 digits, weight 0, positive, one decimal digit
+    numeric = struct.pack("!ihhHhhh", 12, 2, 0, 0, 1, 1, 5000)
+    session.conn.copy_data = [
+        BINARY_HEADER + struct.pack("!hi4sii", 3, 4, b"abcd", 4, 5) + numeric,
+        struct.pack("!hiii", 3, -1, -1, -1),
+        struct.pack("!hi2sii", 3, 2, b"xy", 4, 7) + numeric,
+        BINARY_TRAILER,
+    ]
+    df = session.load_df_function("t")
+    assert session.conn.log == [
+        ("execute", None, "SELECT * FROM t LIMIT 0"),
+        ("copy", "COPY t TO STDOUT (FORMAT binary)"),
+    ]
+    assert list(df.columns) == ["s", "i", "n"]
+    assert df["s"].tolist()[::2] == ["abcd", "xy"]
+    assert df["i"].tolist()[::2] == [5, 7]
+    assert df["n"].tolist() == [decimal.Decimal("1.5"), None, decimal.Decimal("1.5")]
+    assert df.isna().sum().tolist() == [1, 1, 1]
+
+
+def test_interrupt_cancels_running_statement():
+    session = _session()
+    session.interrupt()
+    assert session.conn.log == ["cancel"]
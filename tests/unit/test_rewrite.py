@@ -1,7 +1,9 @@
+import re
+
 import pytest
 import sqlglot
 import sqlglot.expressions as exp
-from buenavista.rewrite import Rewriter
+from buenavista.rewrite import Rewriter, TextRules
 
 
 @pytest.fixture
@@ -42,3 +44,89 @@ def test_rewrite_with_exception(rewriter):
     faulty_sql = "SELECT * FRO test_relation"  # Typo in SQL
     rewritten_sql = rewriter.rewrite(faulty_sql)
     assert rewritten_sql == faulty_sql
+
+
+def test_rewrite_is_memoized(rewriter):
+    calls = []
+
+    @rewriter.relation("test_relation")
+    def test_func():
+        calls.append(1)
+        return "SELECT 1 AS a"
+
+    sql = "SELECT * FROM test_relation"
+    assert rewriter.rewrite(sql) == rewriter.rewrite(sql)
+    assert len(calls) == 1
+
+    # Registering a relation invalidates the memoized rewrites
+    @rewriter.relation("other_relation")
+    def other_func():
+        return "SELECT 2 AS b"
+
+    rewriter.rewrite(sql)
+    assert len(calls) == 2
+
+
+def test_split_rewrites_each_statement_once(rewriter):
+    calls = []
+
+    @rewriter.relation("test_relation")
+    def test_func():
+        calls.append(1)
+        return "SELECT 1 AS a"
+
+    sql = "SELECT ';' AS s; SELECT * FROM test_relation;; SELECT * FRO x"
+    stmts = rewriter.split(sql)
+    assert stmts == ["SELECT ';' AS s", "SELECT * FROM test_relation", "SELECT * FRO x"]
+    assert len(calls) == 1
+    assert rewriter.rewrite(stmts[1]) == (
+        "SELECT * FROM (SELECT 1 AS a) /* source: test_relation */"
+    )
+    assert rewriter.rewrite(stmts[2]) == "SELECT * FRO x"
+    assert len(calls) == 1
+    assert rewriter.split("SELECT 1") == ["SELECT 1"]
+    assert rewriter.split(" ; ") == []
+
+
+def test_text_rules_apply_every_matching_rule():
+    rules = TextRules()
+    rules.literal("regclass", "::regclass", "", ignore_case=True)
+    rules.regex("prepare", r"PREPARE\s+(\w+)\s+FROM", r"PREPARE \1 AS")
+    rules.regex("upper", r"pg_catalog\.(lower)", lambda m: m.group(1).upper())
+    rules.statement("begin", "BEGIN READ ONLY", "BEGIN")
+    sql = "PREPARE q FROM SELECT 'a'::REGCLASS, pg_catalog.lower(x), 'b'::regclass"
+    assert rules.apply(sql) == "PREPARE q AS SELECT 'a', LOWER(x), 'b'"
+    assert rules.apply("BEGIN READ ONLY") == "BEGIN"
+    assert rules.apply("BEGIN READ ONLY;") == "BEGIN READ ONLY;"
+    assert rules.apply("SELECT 1") == "SELECT 1"
+    assert rules.stats() == {"regclass": 2, "prepare": 1, "upper": 1, "begin": 1}
+
+
+def test_text_rules_reject_duplicate_names():
+    rules = TextRules()
+    rules.prefix("list", "SELECT d.datname", "SELECT 1")
+    assert rules.apply("SELECT d.datname FROM x\nORDER BY 1") == "SELECT 1"
+    with pytest.raises(ValueError):
+        rules.literal("list", "x", "y")
+
+
+@pytest.mark.parametrize(
+    "pattern, flags, sql, rewritten",
+    [
+        (r"\bcurrent_user\b", 0, "SELECT current_user", "SELECT user"),
+        (r"\Scurrent_user", 0, "SELECT xcurrent_user", "SELECT user"),
+        (r"\x63urrent_user", 0, "SELECT current_user", "SELECT user"),
+        (r"c?urrent_user", 0, "SELECT urrent_user", "SELECT user"),
+        (r"(x|c)urrent_user", 0, "SELECT current_user", "SELECT user"),
+        (r"current_user", re.IGNORECASE, "SELECT Kurrent_user", "SELECT Kurrent_user"),
+        (r"sql_user", re.IGNORECASE, "SELECT ſQL_USER", "SELECT user"),
+        (r"\.current_user", 0, "SELECT pg.current_user", "SELECT pguser"),
+        (r".urrent_user", 0, "SELECT current_user", "SELECT user"),
+        (r"-- x\n", 0, "SELECT 1 -- x\n", "SELECT 1 user"),
+    ],
+)
+def test_text_rules_regexes_match_wherever_they_start(pattern, flags, sql, rewritten):
+    rules = TextRules()
+    rules.literal("other", "::regclass", "")
+    rules.regex("user", pattern, "user", flags)
+    assert rules.apply(sql) == rewritten
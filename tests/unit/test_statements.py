@@ -0,0 +1,69 @@
+import pytest
+
+from buenavista.statements import (
+    StatementKind,
+    classify,
+    count_parameters,
+    replace_parameters,
+    split_statements,
+)
+
+
+@pytest.mark.parametrize(
+    "sql,kind,tag",
+    [
+        ("SELECT 1", StatementKind.QUERY, "SELECT 5"),
+        ("select 'insert ' as x", StatementKind.QUERY, "SELECT 5"),
+        ("SELECT begin_date FROM t", StatementKind.QUERY, "SELECT 5"),
+        ("/* c */ (SELECT 1) UNION (SELECT 2)", StatementKind.QUERY, "SELECT 5"),
+        ("SHOW search_path", StatementKind.QUERY, "SELECT 5"),
+        ("INSERT INTO t VALUES (1)", StatementKind.DML, "INSERT 0 5"),
+        ('WITH "insert" AS (SELECT 1) DELETE FROM t', StatementKind.DML, "DELETE 5"),
+        ("update t set x = 'commit'", StatementKind.DML, "UPDATE 5"),
+        ("CREATE OR REPLACE TEMP VIEW v AS SELECT 1", StatementKind.DDL, "CREATE VIEW"),
+        ("drop table t", StatementKind.DDL, "DROP TABLE"),
+        ("START TRANSACTION", StatementKind.TRANSACTION, "BEGIN"),
+        ("end", StatementKind.TRANSACTION, "COMMIT"),
+        ("ROLLBACK", StatementKind.TRANSACTION, "ROLLBACK"),
+        ("LOAD httpfs", StatementKind.UTILITY, "LOAD"),
+        ("SET search_path = 'main'", StatementKind.UTILITY, "SET"),
+        ("", StatementKind.UTILITY, ""),
+    ],
+)
+def test_classify(sql, kind, tag):
+    stmt = classify(sql)
+    assert stmt.kind == kind
+    assert stmt.tag(5) == tag
+
+
+def test_classify_returns_rows():
+    assert classify("SELECT 1").returns_rows is True
+    assert classify("INSERT INTO t VALUES (1)").returns_rows is False
+    assert classify("INSERT INTO t VALUES (1) RETURNING *").returns_rows is True
+    assert classify("EXECUTE p").returns_rows is None
+    assert classify("PIVOT t ON b USING sum(a)").returns_rows is True
+    assert classify("SET threads = 1").returns_rows is False
+    assert classify("FROBNICATE t").returns_rows is None
+    assert classify("BEGIN; SELECT 1").command == "BEGIN"
+
+
+def test_count_parameters():
+    assert count_parameters("SELECT 1") == 0
+    assert count_parameters("SELECT $2, '$3' FROM t WHERE x = $1") == 2
+    assert count_parameters("SELECT ?, ?") == 2
+
+
+def test_split_statements():
+    assert split_statements("SELECT 1") == ["SELECT 1"]
+    assert split_statements("  ") == []
+    assert split_statements("SELECT 'a;b'; -- x;\n INSERT INTO t VALUES (1);;") == [
+        "SELECT 'a;b'",
+        "INSERT INTO t VALUES (1)",
+    ]
+    assert split_statements("; /* only a comment */ ;") == []
+
+
+def test_replace_parameters():
+    sql = "SELECT $2, '$1' FROM t WHERE x = $1"
+    assert replace_parameters(sql, ["1", "NULL"]) == "SELECT NULL, '$1' FROM t WHERE x = 1"
+    assert replace_parameters("SELECT ?, ?", ["1", "2"]) == "SELECT 1, 2"